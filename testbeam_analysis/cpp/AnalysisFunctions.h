@@ -10,6 +10,7 @@
 #include <stdexcept>
 #include <algorithm>
 #include <sstream>
+#include <vector>
 
 #include "defines.h"
 
@@ -252,6 +253,64 @@ void mapCluster(int64_t*& rEventArray, const unsigned int& rEventArraySize, Clus
 }
 
 
+// Merges several sorted event number arrays in one traversal (k-way merge). Every event number occurs as often as in the array with the most occurrences.
+// The arrays are concatenated in rEventArrays, array i is stored from rOffsets[i] to rOffsets[i + 1]. Returns the number of result event numbers.
+unsigned int getMaxEventsInArrays(int64_t*& rEventArrays, int64_t*& rOffsets, const unsigned int& rNarrays, int64_t*& rResult, const unsigned int& rSizeArrayResult)
+{
+	std::vector<int64_t> tIndices(rOffsets, rOffsets + rNarrays);  // actual read index for every array
+	unsigned int tActualResultIndex = 0;
+
+	while (true) {
+		// Find the smallest actual event number
+		bool tFound = false;
+		int64_t tActualEventNumber = 0;
+		for (unsigned int i = 0; i < rNarrays; ++i) {
+			if (tIndices[i] < rOffsets[i + 1] && (!tFound || rEventArrays[tIndices[i]] < tActualEventNumber)) {
+				tActualEventNumber = rEventArrays[tIndices[i]];
+				tFound = true;
+			}
+		}
+		if (!tFound)  // all arrays are merged
+			break;
+
+		// Count the occurrences in every array and advance the read indices
+		unsigned int tMaxOccurrence = 0;
+		for (unsigned int i = 0; i < rNarrays; ++i) {
+			unsigned int tOccurrence = 0;
+			for (; tIndices[i] < rOffsets[i + 1] && rEventArrays[tIndices[i]] == tActualEventNumber; ++tIndices[i])
+				++tOccurrence;
+			tMaxOccurrence = std::max(tMaxOccurrence, tOccurrence);
+		}
+
+		if (tActualResultIndex + tMaxOccurrence > rSizeArrayResult)
+			throw std::out_of_range("The result event number array is too small");
+		for (unsigned int j = 0; j < tMaxOccurrence; ++j)
+			rResult[tActualResultIndex++] = tActualEventNumber;
+	}
+	return tActualResultIndex;
+}
+
+
+// Fast mapping of the cluster of several arrays to event numbers in one traversal, see mapCluster.
+// The cluster arrays are concatenated in rClusterInfo, array i is stored from rOffsets[i] to rOffsets[i + 1].
+// The cluster of array i are mapped to rMappedClusterInfo[i * rEventArraySize] to rMappedClusterInfo[(i + 1) * rEventArraySize - 1].
+void mapClusterArrays(int64_t*& rEventArray, const unsigned int& rEventArraySize, ClusterInfo*& rClusterInfo, int64_t*& rOffsets, const unsigned int& rNarrays, ClusterInfo*& rMappedClusterInfo)
+{
+	std::vector<int64_t> tIndices(rOffsets, rOffsets + rNarrays);  // actual read index for every array
+	for (unsigned int i = 0; i < rEventArraySize; ++i) {
+		for (unsigned int k = 0; k < rNarrays; ++k) {
+			// Find first cluster with a fitting event number
+			while ((tIndices[k] < rOffsets[k + 1]) && (rClusterInfo[tIndices[k]].eventNumber < rEventArray[i]))  // Catch up to actual event number rEventArray[i]
+				++tIndices[k];
+			if ((tIndices[k] < rOffsets[k + 1]) && (rClusterInfo[tIndices[k]].eventNumber == rEventArray[i])) {
+				rMappedClusterInfo[(int64_t) k * rEventArraySize + i] = rClusterInfo[tIndices[k]];
+				++tIndices[k];
+			}
+		}
+	}
+}
+
+
 // loop over the refHit, Hit arrays and compare the hits of same event number. If they are similar (within an error) correlation is assumed. If more than nBadEvents are not correlated, broken correlation is assumed.
 // True/False is returned for correlated/not correlated data. The iRefHit index is the index of the first not correlated hit.
 bool _checkForNoCorrelation(unsigned int& iRefHit, unsigned int& iHit, const int64_t*& rEventArray, const double*& rRefCol, double*& rCol, const double*& rRefRow, double*& rRow, uint8_t*& rCorrelated, const unsigned int& nHits, const double& rError, const unsigned int& nBadEvents)
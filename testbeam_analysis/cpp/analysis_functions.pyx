@@ -11,7 +11,7 @@ cimport numpy as cnp
 cnp.import_array()  # if array is used it has to be imported, otherwise possible runtime error
 
 
-cdef extern from "AnalysisFunctions.h":
+cdef extern from "AnalysisFunctions.h" nogil:
     cdef cppclass ClusterInfo:
         ClusterInfo()
     cdef cppclass HitInfo:
@@ -24,41 +24,72 @@ cdef extern from "AnalysisFunctions.h":
     void histogram_2d(int * & x, int * & y, const unsigned int & rSize, const unsigned int & rNbinsX, const unsigned int & rNbinsY, uint32_t * & rResult) except +
     void histogram_3d(int * & x, int * & y, int * & z, const unsigned int & rSize, const unsigned int & rNbinsX, const unsigned int & rNbinsY, const unsigned int & rNbinsZ, uint16_t * & rResult) except +
     void mapCluster(int64_t * & rEventArray, const unsigned int & rEventArraySize, ClusterInfo * & rClusterInfo, const unsigned int & rClusterInfoSize, ClusterInfo * & rMappedClusterInfo) except +
+    unsigned int getMaxEventsInArrays(int64_t * & rEventArrays, int64_t * & rOffsets, const unsigned int & rNarrays, int64_t * & rResult, const unsigned int & rSizeArrayResult) except +
+    void mapClusterArrays(int64_t * & rEventArray, const unsigned int & rEventArraySize, ClusterInfo * & rClusterInfo, int64_t * & rOffsets, const unsigned int & rNarrays, ClusterInfo * & rMappedClusterInfo) except +
     unsigned int fixEventAlignment(const int64_t * & rEventArray, const double * & rRefCol, double * & rCol, const double * & rRefRow, double * & rRow, const uint16_t * & rRefCharge, uint16_t * & rCharge, uint8_t * & rCorrelated, const unsigned int & nHits, const double & rError, const unsigned int & nBadEvents, const unsigned int & correltationSearchRange, const unsigned int & nGoodEvents, const unsigned int & goodEventsSearchRange) except +
 
 
 def get_n_cluster_in_events(cnp.ndarray[cnp.int64_t, ndim=1] event_numbers, cnp.ndarray[cnp.int64_t, ndim=1] result_event_numbers, cnp.ndarray[cnp.uint32_t, ndim=1] result_cluster_count):
-    return getNclusterInEvents(< int64_t*& > event_numbers.data, < const unsigned int&> event_numbers.shape[0], < int64_t*& > result_event_numbers.data, < unsigned int*& > result_cluster_count.data)
+    cdef unsigned int result
+    with nogil:
+        result = getNclusterInEvents(< int64_t*& > event_numbers.data, < const unsigned int&> event_numbers.shape[0], < int64_t*& > result_event_numbers.data, < unsigned int*& > result_cluster_count.data)
+    return result
 
 
 def get_events_in_both_arrays(cnp.ndarray[cnp.int64_t, ndim=1] array_one, cnp.ndarray[cnp.int64_t, ndim=1] array_two, cnp.ndarray[cnp.int64_t, ndim=1] array_result):
-    return getEventsInBothArrays( < int64_t*& > array_one.data, < const unsigned int&> array_one.shape[0], < int64_t*& > array_two.data, < const unsigned int&> array_two.shape[0], < int64_t*& > array_result.data)
+    cdef unsigned int result
+    with nogil:
+        result = getEventsInBothArrays( < int64_t*& > array_one.data, < const unsigned int&> array_one.shape[0], < int64_t*& > array_two.data, < const unsigned int&> array_two.shape[0], < int64_t*& > array_result.data)
+    return result
 
 
 def get_max_events_in_both_arrays(cnp.ndarray[cnp.int64_t, ndim=1] array_one, cnp.ndarray[cnp.int64_t, ndim=1] array_two, cnp.ndarray[cnp.int64_t, ndim=1] array_result):
-    return getMaxEventsInBothArrays(< int64_t*& > array_one.data, < const unsigned int&> array_one.shape[0], < int64_t*& > array_two.data, < const unsigned int&> array_two.shape[0], < int64_t*& > array_result.data, < const unsigned int&> array_result.shape[0])
+    cdef unsigned int result
+    with nogil:
+        result = getMaxEventsInBothArrays(< int64_t*& > array_one.data, < const unsigned int&> array_one.shape[0], < int64_t*& > array_two.data, < const unsigned int&> array_two.shape[0], < int64_t*& > array_result.data, < const unsigned int&> array_result.shape[0])
+    return result
+
+
+def get_max_events_in_arrays(cnp.ndarray[cnp.int64_t, ndim=1] event_arrays, cnp.ndarray[cnp.int64_t, ndim=1] offsets, cnp.ndarray[cnp.int64_t, ndim=1] array_result):
+    cdef unsigned int result
+    with nogil:
+        result = getMaxEventsInArrays(< int64_t*& > event_arrays.data, < int64_t*& > offsets.data, < const unsigned int&> (offsets.shape[0] - 1), < int64_t*& > array_result.data, < const unsigned int&> array_result.shape[0])
+    return result
 
 
 def get_in1d_sorted(cnp.ndarray[cnp.int64_t, ndim=1] array_one, cnp.ndarray[cnp.int64_t, ndim=1] array_two, cnp.ndarray[cnp.uint8_t, ndim=1] array_result):
-    in1d_sorted( < int64_t*& > array_one.data, < const unsigned int&> array_one.shape[0], < int64_t*& > array_two.data, < const unsigned int&> array_two.shape[0], < uint8_t*& > array_result.data)
+    with nogil:
+        in1d_sorted( < int64_t*& > array_one.data, < const unsigned int&> array_one.shape[0], < int64_t*& > array_two.data, < const unsigned int&> array_two.shape[0], < uint8_t*& > array_result.data)
     return (array_result == 1)
 
 
 def hist_1d(cnp.ndarray[cnp.int32_t, ndim=1] x, const unsigned int & n_x, cnp.ndarray[cnp.uint32_t, ndim=1] array_result):
-    histogram_1d( < int*& > x.data, < const unsigned int&> x.shape[0], < const unsigned int&> n_x, < uint32_t*& > array_result.data) 
+    with nogil:
+        histogram_1d( < int*& > x.data, < const unsigned int&> x.shape[0], < const unsigned int&> n_x, < uint32_t*& > array_result.data)
 
 
 def hist_2d(cnp.ndarray[cnp.int32_t, ndim=1] x, cnp.ndarray[cnp.int32_t, ndim=1] y, const unsigned int & n_x, const unsigned int & n_y, cnp.ndarray[cnp.uint32_t, ndim=1] array_result):
-    histogram_2d(< int*& > x.data, < int*& > y.data, < const unsigned int&> x.shape[0], < const unsigned int&> n_x, < const unsigned int&> n_y, < uint32_t*& > array_result.data)
+    with nogil:
+        histogram_2d(< int*& > x.data, < int*& > y.data, < const unsigned int&> x.shape[0], < const unsigned int&> n_x, < const unsigned int&> n_y, < uint32_t*& > array_result.data)
 
 
 def hist_3d(cnp.ndarray[cnp.int32_t, ndim=1] x, cnp.ndarray[cnp.int32_t, ndim=1] y, cnp.ndarray[cnp.int32_t, ndim=1] z, const unsigned int & n_x, const unsigned int & n_y, const unsigned int & n_z, cnp.ndarray[cnp.uint16_t, ndim=1] array_result, throw_exception=True):
-    histogram_3d( < int*& > x.data, < int*& > y.data, < int*& > z.data, < const unsigned int&> x.shape[0], < const unsigned int&> n_x, < const unsigned int&> n_y, < const unsigned int&> n_z, < uint16_t*& > array_result.data)
+    with nogil:
+        histogram_3d( < int*& > x.data, < int*& > y.data, < int*& > z.data, < const unsigned int&> x.shape[0], < const unsigned int&> n_x, < const unsigned int&> n_y, < const unsigned int&> n_z, < uint16_t*& > array_result.data)
 
 
 def map_cluster(cnp.ndarray[cnp.int64_t, ndim=1] event_array, cnp.ndarray[numpy_cluster_info, ndim=1] cluster_hit_info, cnp.ndarray[numpy_cluster_info, ndim=1] mapped_cluster_hit_info):
-    mapCluster(< int64_t*& > event_array.data, < const unsigned int&> event_array.shape[0], < ClusterInfo * & > cluster_hit_info.data, < const unsigned int & > cluster_hit_info.shape[0], < ClusterInfo * & > mapped_cluster_hit_info.data)
+    with nogil:
+        mapCluster(< int64_t*& > event_array.data, < const unsigned int&> event_array.shape[0], < ClusterInfo * & > cluster_hit_info.data, < const unsigned int & > cluster_hit_info.shape[0], < ClusterInfo * & > mapped_cluster_hit_info.data)
+
+
+def map_cluster_arrays(cnp.ndarray[cnp.int64_t, ndim=1] event_array, cnp.ndarray[numpy_cluster_info, ndim=1] cluster_hit_info, cnp.ndarray[cnp.int64_t, ndim=1] offsets, cnp.ndarray[numpy_cluster_info, ndim=2] mapped_cluster_hit_info):
+    with nogil:
+        mapClusterArrays(< int64_t*& > event_array.data, < const unsigned int&> event_array.shape[0], < ClusterInfo * & > cluster_hit_info.data, < int64_t*& > offsets.data, < const unsigned int&> (offsets.shape[0] - 1), < ClusterInfo * & > mapped_cluster_hit_info.data)
 
 
 def fix_event_alignment(cnp.ndarray[cnp.int64_t, ndim=1] event_array, cnp.ndarray[cnp.float_t, ndim=1] ref_column, cnp.ndarray[cnp.float_t, ndim=1] column, cnp.ndarray[cnp.float_t, ndim=1] ref_row, cnp.ndarray[cnp.float_t, ndim=1] row, cnp.ndarray[cnp.uint16_t, ndim=1] ref_charge, cnp.ndarray[cnp.uint16_t, ndim=1] charge, cnp.ndarray[cnp.uint8_t, ndim=1] correlated, const double & error, const unsigned int & n_bad_events, const unsigned int & correlation_search_range, const unsigned int & n_good_events, const unsigned int & good_events_search_range):
-    return fixEventAlignment( < const int64_t*& > event_array.data, < const double*& > ref_column.data, < double*& > column.data, < const double*& > ref_row.data, < double*& > row.data, < const uint16_t*& > ref_charge.data, < uint16_t*& > charge.data, < uint8_t*& > correlated.data, < const unsigned int&> event_array.shape[0], < const double&> error, < const unsigned int&> n_bad_events, < const unsigned int&> correlation_search_range, < const unsigned int&> n_good_events, < const unsigned int&> good_events_search_range)
+    cdef unsigned int result
+    with nogil:
+        result = fixEventAlignment( < const int64_t*& > event_array.data, < const double*& > ref_column.data, < double*& > column.data, < const double*& > ref_row.data, < double*& > row.data, < const uint16_t*& > ref_charge.data, < uint16_t*& > charge.data, < uint8_t*& > correlated.data, < const unsigned int&> event_array.shape[0], < const double&> error, < const unsigned int&> n_bad_events, < const unsigned int&> correlation_search_range, < const unsigned int&> n_good_events, < const unsigned int&> good_events_search_range)
+    return result
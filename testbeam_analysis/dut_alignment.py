@@ -4,14 +4,17 @@ from __future__ import division
 import logging
 import re
 import os
+import shutil
+import tempfile
 import progressbar
 import warnings
 from collections import Iterable
 
 import matplotlib.pyplot as plt
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 import tables as tb
 import numpy as np
+from numba import njit
 from scipy.optimize import curve_fit, minimize_scalar, leastsq, basinhopping, OptimizeWarning, minimize
 from matplotlib.backends.backend_pdf import PdfPages
 
@@ -19,15 +22,16 @@ from testbeam_analysis.tools import analysis_utils
 from testbeam_analysis.tools import plot_utils
 from testbeam_analysis.tools import geometry_utils
 from testbeam_analysis.tools import data_selection
+from testbeam_analysis.tools import smc
 
 # Imports for track based alignment
-from testbeam_analysis.track_analysis import fit_tracks
+from testbeam_analysis.track_analysis import fit_tracks, _fit_tracks_loop
 from testbeam_analysis.result_analysis import calculate_residuals
 
 warnings.simplefilter("ignore", OptimizeWarning)  # Fit errors are handled internally, turn of warnings
 
 
-def correlate_cluster(input_cluster_files, output_correlation_file, n_pixels, pixel_size=None, dut_names=None, plot=True, chunk_size=4999999):
+def correlate_cluster(input_cluster_files, output_correlation_file, n_pixels, pixel_size=None, dut_names=None, plot=True, band_width=None, input_alignment_file=None, chunk_size=4999999):
     '''"Calculates the correlation histograms from the cluster arrays.
     The 2D correlation array of pairs of two different devices are created on event basis.
     All permutations are considered (all clusters of the first device are correlated with all clusters of the second device).
@@ -49,63 +53,110 @@ def correlate_cluster(input_cluster_files, output_correlation_file, n_pixels, pi
         Names of the DUTs. If None, the DUT index will be used.
     plot : bool
         If True, create additional output plots.
+    band_width : uint
+        If not None, only a band of +- band_width reference pixels around the expected correlation line is histogrammed
+        and correlations outside of the band are counted as overflow. Reduces the memory of the correlation histograms
+        for large sensors. prealignment() uses the band histograms directly, analysis_utils.get_correlation_histogram() expands them.
+    input_alignment_file : string
+        Filename of the alignment file with a pre-alignment that defines the expected correlation line.
+        If None, the DUTs are assumed to be centered and to have the same orientation. Only used if band_width is set.
     chunk_size : uint
         Chunk size of the data when reading from file.
     '''
     logging.info('=== Correlating the index of %d DUTs ===', len(input_cluster_files))
 
-    with tb.open_file(output_correlation_file, mode="w") as out_file_h5:
-        n_duts = len(input_cluster_files)
-
-        # Result arrays to be filled
-        column_correlations = []
-        row_correlations = []
+    n_duts = len(input_cluster_files)
+    if band_width is not None:
+        band_pixel_size = pixel_size if pixel_size is not None else [(1.0, 1.0)] * n_duts  # Same pixel size for all DUTs
+        if input_alignment_file:
+            with tb.open_file(input_alignment_file, mode="r") as in_file_h5:
+                prealignment = in_file_h5.root.PreAlignment[:]
+        else:
+            prealignment = None
+        column_band_starts, row_band_starts = [], []
         for dut_index in range(1, n_duts):
+            column_band_starts.append(analysis_utils.get_correlation_band_start(n_pixel_dut=n_pixels[dut_index][0],
+                                                                                n_pixel_ref=n_pixels[0][0],
+                                                                                pixel_size_dut=band_pixel_size[dut_index][0],
+                                                                                pixel_size_ref=band_pixel_size[0][0],
+                                                                                band_width=band_width,
+                                                                                offset=prealignment[dut_index]['column_c0'] if prealignment is not None else 0.0,
+                                                                                slope=prealignment[dut_index]['column_c1'] if prealignment is not None else None))
+            row_band_starts.append(analysis_utils.get_correlation_band_start(n_pixel_dut=n_pixels[dut_index][1],
+                                                                             n_pixel_ref=n_pixels[0][1],
+                                                                             pixel_size_dut=band_pixel_size[dut_index][1],
+                                                                             pixel_size_ref=band_pixel_size[0][1],
+                                                                             band_width=band_width,
+                                                                             offset=prealignment[dut_index]['row_c0'] if prealignment is not None else 0.0,
+                                                                             slope=prealignment[dut_index]['row_c1'] if prealignment is not None else None))
+    else:
+        column_band_starts, row_band_starts = [None] * (n_duts - 1), [None] * (n_duts - 1)
+
+    # Result arrays to be filled
+    column_correlations = []
+    row_correlations = []
+    overflows = []
+    for dut_index in range(1, n_duts):
+        if band_width is not None:
+            shape_column = (n_pixels[dut_index][0], 2 * band_width + 1)
+            shape_row = (n_pixels[dut_index][1], 2 * band_width + 1)
+        else:
             shape_column = (n_pixels[dut_index][0], n_pixels[0][0])
             shape_row = (n_pixels[dut_index][1], n_pixels[0][1])
-            column_correlations.append(np.zeros(shape_column, dtype=np.int))
-            row_correlations.append(np.zeros(shape_row, dtype=np.int))
-
-        start_indices = [None] * n_duts  # Store the loop indices for speed up
-
-        with tb.open_file(input_cluster_files[0], mode='r') as in_file_h5:  # Open DUT0 cluster file
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=in_file_h5.root.Cluster.shape[0], term_width=80)
-            progress_bar.start()
-
-            pool = Pool()  # Provide worker pool
-            for cluster_dut_0, start_indices[0] in analysis_utils.data_aligned_at_events(in_file_h5.root.Cluster, start_index=start_indices[0], chunk_size=chunk_size):  # Loop over the cluster of DUT0 in chunks
-                actual_event_numbers = cluster_dut_0[:]['event_number']
-
-                # Create correlation histograms to the reference device for all other devices
-                # Do this in parallel to safe time
-
-                dut_results = []
-                for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
-                    dut_results.append(pool.apply_async(_correlate_cluster, kwds={'cluster_dut_0': cluster_dut_0,
-                                                                                  'cluster_file': cluster_file,
-                                                                                  'start_index': start_indices[dut_index],
-                                                                                  'start_event_number': actual_event_numbers[0],
-                                                                                  'stop_event_number': actual_event_numbers[-1] + 1,
-                                                                                  'column_correlation': column_correlations[dut_index - 1],
-                                                                                  'row_correlation': row_correlations[dut_index - 1],
-                                                                                  'chunk_size': chunk_size
-                                                                                  }
-                                                        ))
-                # Collect results when available
-                for dut_index, dut_result in enumerate(dut_results, start=1):
-                    (start_indices[dut_index], column_correlations[dut_index - 1], row_correlations[dut_index - 1]) = dut_result.get()
-
-                progress_bar.update(start_indices[0])
-
-            pool.close()
-            pool.join()
+        column_correlations.append(np.zeros(shape_column, dtype=np.int))
+        row_correlations.append(np.zeros(shape_row, dtype=np.int))
+        overflows.append(np.zeros(2, dtype=np.int64))
+
+    # Split the DUT0 events into ranges to use all cores also for few DUTs
+    n_ranges = max(1, int(np.ceil(cpu_count() / max(1, n_duts - 1))))
+    event_ranges = _get_event_ranges(input_cluster_files[0], n_ranges)
+
+    # Each worker correlates one DUT with DUT0 for one event range and returns the histograms once
+    pool = smc.get_pool()
+    dut_results = []
+    for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
+        for start_index, start_event_number, stop_event_number in event_ranges:
+            dut_results.append((dut_index, pool.apply_async(_correlate_cluster, kwds={'cluster_file_dut_0': input_cluster_files[0],
+                                                                                      'cluster_file': cluster_file,
+                                                                                      'start_index_dut_0': start_index,
+                                                                                      'start_event_number': start_event_number,
+                                                                                      'stop_event_number': stop_event_number,
+                                                                                      'shape_column': column_correlations[dut_index - 1].shape,
+                                                                                      'shape_row': row_correlations[dut_index - 1].shape,
+                                                                                      'column_band_start': column_band_starts[dut_index - 1],
+                                                                                      'row_band_start': row_band_starts[dut_index - 1],
+                                                                                      'chunk_size': chunk_size
+                                                                                      }
+                                                            )))
+
+    progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(dut_results), term_width=80)
+    progress_bar.start()
+
+    # Sum the partial histograms when available
+    for index, (dut_index, dut_result) in enumerate(dut_results, start=1):
+        column_correlation, row_correlation, overflow = dut_result.get()
+        column_correlations[dut_index - 1] += column_correlation
+        row_correlations[dut_index - 1] += row_correlation
+        overflows[dut_index - 1] += overflow
+        progress_bar.update(index)
 
+    with tb.open_file(output_correlation_file, mode="w") as out_file_h5:
         # Store the correlation histograms
         for dut_index in range(n_duts - 1):
             out_col = out_file_h5.create_carray(out_file_h5.root, name='CorrelationColumn_%d_0' % (dut_index + 1), title='Column Correlation between DUT%d and DUT%d' % (dut_index + 1, 0), atom=tb.Atom.from_dtype(column_correlations[dut_index].dtype), shape=column_correlations[dut_index].shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
             out_row = out_file_h5.create_carray(out_file_h5.root, name='CorrelationRow_%d_0' % (dut_index + 1), title='Row Correlation between DUT%d and DUT%d' % (dut_index + 1, 0), atom=tb.Atom.from_dtype(row_correlations[dut_index].dtype), shape=row_correlations[dut_index].shape, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
             out_col.attrs.filenames = [str(input_cluster_files[0]), str(input_cluster_files[dut_index])]
             out_row.attrs.filenames = [str(input_cluster_files[0]), str(input_cluster_files[dut_index])]
+            if band_width is not None:  # Store the band definition to be able to expand the band histograms
+                out_col.attrs.band_width = band_width
+                out_col.attrs.band_start = column_band_starts[dut_index]
+                out_col.attrs.n_pixel_ref = n_pixels[0][0]
+                out_col.attrs.overflow = int(overflows[dut_index][0])
+                out_row.attrs.band_width = band_width
+                out_row.attrs.band_start = row_band_starts[dut_index]
+                out_row.attrs.n_pixel_ref = n_pixels[0][1]
+                out_row.attrs.overflow = int(overflows[dut_index][1])
+                logging.info('Correlations of DUT%d outside of the band: %d (column), %d (row)', dut_index + 1, overflows[dut_index][0], overflows[dut_index][1])
             out_col[:] = column_correlations[dut_index]
             out_row[:] = row_correlations[dut_index]
         progress_bar.finish()
@@ -158,85 +209,45 @@ def merge_cluster_data(input_cluster_files, output_merged_file, n_pixels, pixel_
     for index, _ in enumerate(input_cluster_files):
         description.append(('zerr_dut_%d' % index, np.float))
 
-    start_indices_merging_loop = [None] * len(input_cluster_files)  # Store the merging loop indices for speed up
-    start_indices_data_loop = [None] * len(input_cluster_files)  # Additional store indices for the data loop
-    actual_start_event_number = None  # Defines the first event number of the actual chunk for speed up. Cannot be deduced from DUT0, since this DUT could have missing event numbers.
-
-    # Merge the cluster data from different DUTs into one table
-    with tb.open_file(output_merged_file, mode='w') as out_file_h5:
-        merged_cluster_table = out_file_h5.create_table(out_file_h5.root, name='MergedCluster', description=np.zeros((1,), dtype=description).dtype, title='Merged cluster on event number', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-        with tb.open_file(input_cluster_files[0], mode='r') as in_file_h5:  # Open DUT0 cluster file
-            progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=in_file_h5.root.Cluster.shape[0], term_width=80)
-            progress_bar.start()
-            for actual_cluster_dut_0, start_indices_data_loop[0] in analysis_utils.data_aligned_at_events(in_file_h5.root.Cluster, start_index=start_indices_data_loop[0], start_event_number=actual_start_event_number, stop_event_number=None, chunk_size=chunk_size):  # Loop over the cluster of DUT0 in chunks
-                actual_event_numbers = actual_cluster_dut_0[:]['event_number']
-
-                # First loop: calculate the minimum event number indices needed to merge all cluster from all files to this event number index
-                common_event_numbers = actual_event_numbers
-                for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
-                    with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open DUT0 cluster file
-                        for actual_cluster, start_indices_merging_loop[dut_index] in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start_index=start_indices_merging_loop[dut_index], start_event_number=actual_start_event_number, stop_event_number=actual_event_numbers[-1] + 1, chunk_size=chunk_size, fail_on_missing_events=False):  # Loop over the cluster in the actual cluster file in chunks
-                            common_event_numbers = analysis_utils.get_max_events_in_both_arrays(common_event_numbers, actual_cluster[:]['event_number'])
-                merged_cluster_array = np.zeros(shape=(common_event_numbers.shape[0],), dtype=description)  # resulting array to be filled
-                for index, _ in enumerate(input_cluster_files):
-                    # for no hit: column = row = charge = nan
-                    merged_cluster_array['x_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['y_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['z_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['charge_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['xerr_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['yerr_dut_%d' % (index)] = np.nan
-                    merged_cluster_array['zerr_dut_%d' % (index)] = np.nan
-
-                # Set the event number
-                merged_cluster_array['event_number'] = common_event_numbers[:]
-
-                # Fill result array with DUT 0 data
-                actual_cluster_dut_0 = analysis_utils.map_cluster(common_event_numbers, actual_cluster_dut_0)
-                # Select real hits, values with nan are virtual hits
-                selection = ~np.isnan(actual_cluster_dut_0['mean_column'])
-                # Convert indices to positions, origin defined in the center of the sensor
-                merged_cluster_array['x_dut_0'][selection] = pixel_size[0][0] * (actual_cluster_dut_0['mean_column'][selection] - 0.5 - (0.5 * n_pixels[0][0]))
-                merged_cluster_array['y_dut_0'][selection] = pixel_size[0][1] * (actual_cluster_dut_0['mean_row'][selection] - 0.5 - (0.5 * n_pixels[0][1]))
-                merged_cluster_array['z_dut_0'][selection] = 0.0
-                xerr = np.zeros(selection.shape)
-                yerr = np.zeros(selection.shape)
-                zerr = np.zeros(selection.shape)
-                xerr[selection] = actual_cluster_dut_0['err_column'][selection] * pixel_size[0][0]
-                yerr[selection] = actual_cluster_dut_0['err_row'][selection] * pixel_size[0][1]
-                merged_cluster_array['xerr_dut_0'][selection] = xerr[selection]
-                merged_cluster_array['yerr_dut_0'][selection] = yerr[selection]
-                merged_cluster_array['zerr_dut_0'][selection] = zerr[selection]
-                merged_cluster_array['charge_dut_0'][selection] = actual_cluster_dut_0['charge'][selection]
-                merged_cluster_array['n_hits_dut_0'][selection] = actual_cluster_dut_0['n_hits'][selection]
-
-                # Fill result array with other DUT data
-                # Second loop: get the cluster from all files and merge them to the common event number
-                for dut_index, cluster_file in enumerate(input_cluster_files[1:], start=1):  # Loop over the other cluster files
-                    with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open other DUT cluster file
-                        for actual_cluster_dut, start_indices_data_loop[dut_index] in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start_index=start_indices_data_loop[dut_index], start_event_number=common_event_numbers[0], stop_event_number=common_event_numbers[-1] + 1, chunk_size=chunk_size, fail_on_missing_events=False):  # Loop over the cluster in the actual cluster file in chunks
-                            actual_cluster_dut = analysis_utils.map_cluster(common_event_numbers, actual_cluster_dut)
-                            # Select real hits, values with nan are virtual hits
-                            selection = ~np.isnan(actual_cluster_dut['mean_column'])
-                            # Convert indices to positions, origin in the center of the sensor, remaining DUTs
-                            merged_cluster_array['x_dut_%d' % (dut_index)][selection] = pixel_size[dut_index][0] * (actual_cluster_dut['mean_column'][selection] - 0.5 - (0.5 * n_pixels[dut_index][0]))
-                            merged_cluster_array['y_dut_%d' % (dut_index)][selection] = pixel_size[dut_index][1] * (actual_cluster_dut['mean_row'][selection] - 0.5 - (0.5 * n_pixels[dut_index][1]))
-                            merged_cluster_array['z_dut_%d' % (dut_index)][selection] = 0.0
-                            xerr = np.zeros(selection.shape)
-                            yerr = np.zeros(selection.shape)
-                            zerr = np.zeros(selection.shape)
-                            xerr[selection] = actual_cluster_dut['err_column'][selection] * pixel_size[dut_index][0]
-                            yerr[selection] = actual_cluster_dut['err_row'][selection] * pixel_size[dut_index][1]
-                            merged_cluster_array['xerr_dut_%d' % (dut_index)][selection] = xerr[selection]
-                            merged_cluster_array['yerr_dut_%d' % (dut_index)][selection] = yerr[selection]
-                            merged_cluster_array['zerr_dut_%d' % (dut_index)][selection] = zerr[selection]
-                            merged_cluster_array['charge_dut_%d' % (dut_index)][selection] = actual_cluster_dut['charge'][selection]
-                            merged_cluster_array['n_hits_dut_%d' % (dut_index)][selection] = actual_cluster_dut['n_hits'][selection]
-
-                merged_cluster_table.append(merged_cluster_array)
-                actual_start_event_number = common_event_numbers[-1] + 1  # Set the starting event number for the next chunked read
-                progress_bar.update(start_indices_data_loop[0])
-            progress_bar.finish()
+    # Split the DUT0 events into ranges that are merged in parallel, the first range also takes the cluster of the other DUTs before the first DUT0 event
+    event_ranges = _get_event_ranges(input_cluster_files[0], n_ranges=cpu_count())
+    event_ranges[0] = (event_ranges[0][0], None, event_ranges[0][2])
+    # The cluster of the other DUTs between two ranges belong to the next DUT0 event like in a serial merge,
+    # thus the other DUTs start right after the last DUT0 event of the previous range
+    with tb.open_file(input_cluster_files[0], mode='r') as in_file_h5:
+        start_event_numbers_other_duts = [None] + [in_file_h5.root.Cluster.read(start=start_index - 1, stop=start_index, field='event_number')[0] + 1 for start_index, _, _ in event_ranges[1:]]
+
+    pool = smc.get_pool() if len(event_ranges) > 1 else None  # The whole event range is merged in this process
+    results = []
+    for (start_index, start_event_number, stop_event_number), start_event_number_other_duts in zip(event_ranges, start_event_numbers_other_duts):
+        kwargs = {'input_cluster_files': input_cluster_files,
+                  'description': description,
+                  'n_pixels': n_pixels,
+                  'pixel_size': pixel_size,
+                  'start_index_dut_0': start_index,
+                  'start_event_number': start_event_number,
+                  'start_event_number_other_duts': start_event_number_other_duts,
+                  'stop_event_number': stop_event_number,
+                  'chunk_size': chunk_size}
+        results.append(pool.apply_async(_merge_cluster_data, kwds=kwargs) if pool is not None else _merge_cluster_data(**kwargs))
+
+    progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=len(results), term_width=80)
+    progress_bar.start()
+
+    # Concatenate the merged event ranges in order, the first temporary file becomes the output file
+    shutil.move(results[0].get() if pool is not None else results[0], output_merged_file)
+    progress_bar.update(1)
+    with tb.open_file(output_merged_file, mode='r+') as out_file_h5:
+        merged_cluster_table = out_file_h5.root.MergedCluster
+        for index, result in enumerate(results[1:], start=2):
+            merged_file = result.get()
+            with tb.open_file(merged_file, mode='r') as in_file_h5:
+                for i in range(0, in_file_h5.root.MergedCluster.nrows, chunk_size):
+                    merged_cluster_table.append(in_file_h5.root.MergedCluster.read(start=i, stop=i + chunk_size))
+            os.remove(merged_file)
+            progress_bar.update(index)
+        analysis_utils.create_event_index(merged_cluster_table)  # Index event numbers for fast access
+    progress_bar.finish()
 
 
 def prealignment(input_correlation_file, output_alignment_file, z_positions, pixel_size, s_n=0.1, fit_background=False, reduce_background=False, dut_names=None, no_fit=False, non_interactive=True, iterations=3, plot=True, gui=False):
@@ -296,6 +307,9 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
 
     figs = [] if gui else None
 
+    if not no_fit:
+        smc.get_pool()  # The correlation fits run in the worker pool, start it before files are opened to not inherit them
+
     with tb.open_file(input_correlation_file, mode="r") as in_file_h5:
         n_duts = len(in_file_h5.list_nodes("/")) // 2 + 1  # no correlation for reference DUT0
         result = np.zeros(shape=(n_duts,), dtype=[('DUT', np.uint8), ('column_c0', np.float), ('column_c0_error', np.float), ('column_c1', np.float), ('column_c1_error', np.float), ('column_sigma', np.float), ('column_sigma_error', np.float), ('row_c0', np.float), ('row_c0_error', np.float), ('row_c1', np.float), ('row_c1_error', np.float), ('row_sigma', np.float), ('row_sigma_error', np.float), ('z', np.float)])
@@ -320,14 +334,23 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
             else:
                 pixel_size_dut, pixel_size_ref = pixel_size[dut_idx][1], pixel_size[ref_idx][1]
 
-            data = node[:]
-
-            n_pixel_dut, n_pixel_ref = data.shape[0], data.shape[1]
+            if 'band_start' in node.attrs and not reduce_background:  # Use the band directly, the reference index of the band entries is band_start + band index
+                data = node[:]
+                band_start = node.attrs.band_start
+                n_pixel_dut, n_pixel_ref = data.shape[0], node.attrs.n_pixel_ref
+            else:  # The background reduction needs the full correlation histogram
+                data = analysis_utils.get_correlation_histogram(node)
+                band_start = None
+                n_pixel_dut, n_pixel_ref = data.shape[0], data.shape[1]
 
             # Initialize arrays with np.nan (invalid), adding 0.5 to change from index to position
             # matrix index 0 is cluster index 1 ranging from 0.5 to 1.4999, which becomes position 0.0 to 0.999 with center at 0.5, etc.
             x_ref = (np.linspace(0.0, n_pixel_ref, num=n_pixel_ref, endpoint=False, dtype=np.float) + 0.5)
             x_dut = (np.linspace(0.0, n_pixel_dut, num=n_pixel_dut, endpoint=False, dtype=np.float) + 0.5)
+            if band_start is not None:  # One row of reference positions per DUT index
+                x_data = band_start[:, np.newaxis] + np.arange(data.shape[1], dtype=np.float64) + 0.5
+            else:
+                x_data = x_ref
             coeff_fitted = [None] * n_pixel_dut
             mean_fitted = np.empty(shape=(n_pixel_dut,), dtype=np.float)  # Peak of the Gauss fit
             mean_fitted.fill(np.nan)
@@ -348,18 +371,17 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
 
             if no_fit:
                 # calculate half hight
-                median = np.median(data)
+                median = _get_correlation_median(data=data, band_start=band_start, n_pixel_ref=n_pixel_ref)
                 median_max = np.median(np.max(data, axis=1))
-                half_median_data = (data > ((median + median_max) / 2))
                 # calculate maximum per column
                 max_select = np.argmax(data, axis=1)
-                hough_data = np.zeros_like(data)
-                hough_data[np.arange(data.shape[0]), max_select] = 1
                 # select maximums if larger than half hight
-                hough_data = hough_data & half_median_data
-                # transpose for correct angle
-                hough_data = hough_data.T
-                accumulator, theta, rho, theta_edges, rho_edges = analysis_utils.hough_transform(hough_data, theta_res=0.1, rho_res=1.0, return_edges=True)
+                dut_indices = np.nonzero(data[np.arange(n_pixel_dut), max_select] > ((median + median_max) / 2))[0]
+                ref_indices = max_select[dut_indices]
+                if band_start is not None:
+                    ref_indices = ref_indices + band_start[dut_indices]
+                # reference index as y for correct angle
+                accumulator, theta, rho, theta_edges, rho_edges = analysis_utils.hough_transform_points(x_idxs=dut_indices, y_idxs=ref_indices, shape=(n_pixel_ref, n_pixel_dut), theta_res=0.1, rho_res=1.0, return_edges=True)
                 rho_idx, th_idx = np.unravel_index(accumulator.argmax(), accumulator.shape)
                 rho_val, theta_val = rho[rho_idx], theta[th_idx]
                 slope_idx, offset_idx = -np.cos(theta_val) / np.sin(theta_val), rho_val / np.sin(theta_val)
@@ -375,7 +397,8 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
                 result[dut_idx]['z'] = z_positions[dut_idx]
 
                 plot_utils.plot_hough(x=x_dut,
-                                      data=hough_data,
+                                      dut_indices=dut_indices,
+                                      ref_indices=ref_indices,
                                       accumulator=accumulator,
                                       offset=offset_idx,
                                       slope=slope_idx,
@@ -394,7 +417,7 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
 
             else:
                 # fill the arrays from above with values
-                _fit_data(x=x_ref, data=data, s_n=s_n, coeff_fitted=coeff_fitted, mean_fitted=mean_fitted, mean_error_fitted=mean_error_fitted, sigma_fitted=sigma_fitted, chi2=chi2, fit_background=fit_background, reduce_background=reduce_background)
+                _fit_data(x=x_data, data=data, s_n=s_n, coeff_fitted=coeff_fitted, mean_fitted=mean_fitted, mean_error_fitted=mean_error_fitted, sigma_fitted=sigma_fitted, chi2=chi2, fit_background=fit_background)
 
                 # Convert fit results to metric units for alignment fit
                 # Origin is center of pixel matrix
@@ -456,12 +479,11 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
                 result[dut_idx][table_prefix + '_sigma'], result[dut_idx][table_prefix + '_sigma_error'] = mean_sigma, mean_sigma_error
 
                 # Calculate the index of the beam center based on valid indices
-                plot_index = np.average(x_selected - 1, weights=np.sum(data, axis=1)[np.array(x_selected - 1, dtype=np.int)])
+                plot_index = np.average(x_selected - 1, weights=n_cluster[np.array(x_selected - 1, dtype=np.int)])
                 # Find nearest valid index to the calculated index
                 idx = (np.abs(x_selected - 1 - plot_index)).argmin()
                 plot_index = np.array(x_selected - 1, dtype=np.int)[idx]
 
-                x_fit = np.linspace(start=x_ref.min(), stop=x_ref.max(), num=500, endpoint=True)
                 indices_lower = np.arange(plot_index)
                 indices_higher = np.arange(plot_index, n_pixel_dut)
                 alternating_indices = np.vstack((np.hstack([indices_higher, indices_lower[::-1]]), np.hstack([indices_lower[::-1], indices_higher]))).reshape((-1,), order='F')
@@ -473,6 +495,8 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
                         plot_correlation_fit = True
                         break
                 if plot_correlation_fit:
+                    x_plot = x_data[plot_index] if x_data.ndim == 2 else x_data
+                    x_fit = np.linspace(start=x_plot.min(), stop=x_plot.max(), num=500, endpoint=True)
                     if np.all(np.isnan(coeff_fitted[plot_index][3:6])):
                         y_fit = analysis_utils.gauss_offset(x_fit, *coeff_fitted[plot_index][[0, 1, 2, 6]])
                         fit_label = "Gauss-Offset"
@@ -480,7 +504,7 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
                         y_fit = analysis_utils.double_gauss_offset(x_fit, *coeff_fitted[plot_index])
                         fit_label = "Gauss-Gauss-Offset"
 
-                    plot_utils.plot_correlation_fit(x=x_ref,
+                    plot_utils.plot_correlation_fit(x=x_plot,
                                                     y=data[plot_index, :],
                                                     x_fit=x_fit,
                                                     y_fit=y_fit,
@@ -534,18 +558,122 @@ def prealignment(input_correlation_file, output_alignment_file, z_positions, pix
         return figs
 
 
-def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_fitted, chi2, fit_background, reduce_background):
+def _get_correlation_median(data, band_start, n_pixel_ref):
+    ''' Returns the median of the full correlation histogram. For band correlation histograms the entries outside of the band are zero
+    and are not expanded. '''
+    if band_start is None:
+        return np.median(data)
+    ref_index = band_start[:, np.newaxis] + np.arange(data.shape[1])
+    values = np.sort(data[np.logical_and(ref_index >= 0, ref_index < n_pixel_ref)], axis=None)
+    n_entries = data.shape[0] * n_pixel_ref
+    n_zeros = n_entries - values.shape[0]  # The entries are not negative, thus the zeros outside of the band are sorted first
+    middle = [values[index - n_zeros] if index >= n_zeros else 0 for index in ((n_entries - 1) // 2, n_entries // 2)]
+    return (middle[0] + middle[1]) / 2.0
 
-    def calc_limits_from_fit(x, coeff):
-        ''' Calculates the fit limits from the last successfull fit.'''
-        limits = [
-            [0.1 * coeff[0], x.min(), 0.5 * coeff[2], 0.01 * coeff[3], x.min(), 0.5 * coeff[5], 0.5 * coeff[6]],
-            [10.0 * coeff[0], x.max(), 2.0 * coeff[2], 10.0 * coeff[3], x.max(), 2.0 * coeff[5], 2.0 * coeff[6]]
-        ]
-        # Fix too small sigma, sigma < 1 is unphysical
-        if limits[1][2] < 1.:
-            limits[1][2] = 10.
-        return limits
+
+def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_fitted, chi2, fit_background):
+    ''' Fits the correlation of each DUT index with a Gauss (+ Gauss for background) + offset and fills the result arrays.
+
+    The DUT indices are fitted independently, the start values are deduced from the moments of each correlation.
+    Gauss + offset fits are done for all DUT indices at once, fits with background Gauss in parallel.
+    x are the reference positions, one row per DUT index for band correlation histograms.
+    '''
+    n_pixel_dut = data.shape[0]
+
+    # Omit correlation fit with no entries / correlation (e.g. sensor edges, masked columns)
+    no_correlation_indices = np.where(np.all(data == 0, axis=1))[0]
+    # Omit correlation fit if sum of correlation entries is < 1 % of total entries devided by number of indices (e.g. columns not in the beam)
+    few_correlation_indices = np.where(np.logical_and(np.any(data != 0, axis=1), data.sum(axis=1) < data.sum() / n_pixel_dut * 0.01))[0]
+    fit_indices = np.where(np.logical_and(np.any(data != 0, axis=1), data.sum(axis=1) >= data.sum() / n_pixel_dut * 0.01))[0]
+
+    if fit_background:  # Fit the DUT indices in parallel, several DUT indices per job to reduce the overhead
+        pool = smc.get_pool()
+        jobs = []
+        for indices in np.array_split(fit_indices, max(1, min(fit_indices.shape[0], 4 * cpu_count()))):
+            if not indices.shape[0]:  # No DUT index to fit (e.g. dead or fully masked DUT)
+                continue
+            jobs.append((indices, pool.apply_async(_fit_correlations, kwds={'x': x[indices] if x.ndim == 2 else x,
+                                                                            'data': data[indices],
+                                                                            's_n': s_n})))
+        fit_results = [(index, fit_result) for indices, job in jobs for index, fit_result in zip(indices, job.get())]
+    else:
+        fit_results = zip(fit_indices, _fit_correlations_gauss_offset(x=x[fit_indices] if x.ndim == 2 else x, data=data[fit_indices]))
+
+    # Set fit results for given index if successful
+    for index, fit_result in fit_results:
+        if fit_result is None:
+            continue
+        coeff, var_matrix = fit_result
+        x_index = x[index] if x.ndim == 2 else x
+        coeff_fitted[index] = coeff
+        mean_fitted[index] = coeff[1]
+        mean_error_fitted[index] = np.sqrt(np.abs(np.diag(var_matrix)))[1]
+        sigma_fitted[index] = np.abs(coeff[2])
+        chi2[index] = analysis_utils.get_chi2(y_data=data[index, :], y_fit=analysis_utils.double_gauss_offset(x_index, *coeff))
+
+    if no_correlation_indices.shape[0]:
+        logging.info('No correlation entries for indices %s. Omit correlation fit.', str(no_correlation_indices.tolist())[1:-1])
+
+    if few_correlation_indices.shape[0]:
+        logging.info('Very few correlation entries for indices %s. Omit correlation fit.', str(few_correlation_indices.tolist())[1:-1])
+
+
+def _get_correlation_start_values(x, y):
+    ''' Deduces the start values (A_1, mu_1, sigma_1, A_2, mu_2, sigma_2, offset) of the correlation fit of one DUT index from the moments of the correlation.
+    The offset start value is the median of the correlation. '''
+    # Correlation peak
+    peak_index = np.argmax(y)
+    # Background of uncorrelated data
+    A_background = np.mean(y)  # noise / background halo
+    mu_background = np.sum(x * y) / np.sum(y)
+    sigma_background = analysis_utils.get_rms_from_histogram(y, x)
+    offset = np.median(y)
+    # Peak position and width from the peak region above half maximum, background subtracted
+    y_signal = y - offset
+    half_maximum = y_signal[peak_index] / 2.0
+    left, right = peak_index, peak_index
+    while left > 0 and y_signal[left - 1] > half_maximum:
+        left -= 1
+    while right < y.shape[0] - 1 and y_signal[right + 1] > half_maximum:
+        right += 1
+    mu_peak = np.average(x[left:right + 1], weights=y_signal[left:right + 1]) if y_signal[peak_index] > 0 else x[peak_index]
+    sigma_peak = (x[right] - x[left] + 1.0) / 2.355  # FWHM to sigma, x is in pixels
+
+    return [max(y_signal[peak_index], 0.0), mu_peak, sigma_peak, A_background, mu_background, sigma_background, offset]
+
+
+def _fit_correlations_gauss_offset(x, data):
+    ''' Fits the correlation of several DUT indices with a Gauss + offset at once and returns a list with the coefficients
+    (A_1, mu_1, sigma_1, A_2, mu_2, sigma_2, offset) and the covariance matrix for each DUT index. A_2, mu_2, sigma_2 are NaN.
+    None is returned for DUT indices where the fit failed. '''
+    if data.shape[0] == 0:
+        return []
+    p0 = np.array([_get_correlation_start_values(x=x[index] if x.ndim == 2 else x, y=data[index]) for index in range(data.shape[0])])
+    coeff, var_matrix, status = analysis_utils.fit_gauss_stack(x=x, data=data, p0=p0[:, [0, 1, 2, 6]], fit_offset=True)
+
+    x_min, x_max = np.min(x, axis=-1), np.max(x, axis=-1)
+    # Correlation should have at least 2 entries to avoid random fluctuation peaks to be selected, the peak has to be within the reference DUT
+    valid = np.logical_and(status == 0, coeff[:, 0] > 2)
+    valid[valid] = np.logical_and(np.logical_and(coeff[valid, 1] >= np.broadcast_to(x_min, valid.shape)[valid], coeff[valid, 1] <= np.broadcast_to(x_max, valid.shape)[valid]),
+                                  coeff[valid, 2] <= np.broadcast_to(x_max - x_min, valid.shape)[valid])
+
+    # Change back coefficents
+    return [(np.insert(coeff[index], 3, [np.nan] * 3), var_matrix[index]) if valid[index] else None for index in range(data.shape[0])]
+
+
+def _fit_correlations(x, data, s_n):
+    ''' Fits the correlation of several DUT indices and returns a list with the coefficients and the covariance matrix for each DUT index.
+    None is returned for DUT indices where the fit failed. '''
+    return [_fit_correlation(x=x[index] if x.ndim == 2 else x, y=data[index], s_n=s_n) for index in range(data.shape[0])]
+
+
+def _fit_correlation(x, y, s_n):
+    ''' Fits the correlation of one DUT index with a Gauss for the correlation peak, a Gauss for the background and an offset.
+    The start values are deduced from the moments of the correlation.
+
+    Returns the coefficients (A_1, mu_1, sigma_1, A_2, mu_2, sigma_2, offset) and the covariance matrix
+    or None if the fit failed.
+    '''
 
     def signal_sanity_check(coeff, s_n, A_peak):
         ''' Sanity check if signal was deducted correctly from background.
@@ -559,115 +687,31 @@ def _fit_data(x, data, s_n, coeff_fitted, mean_fitted, mean_error_fitted, sigma_
             return False
         return True
 
-    n_pixel_dut, n_pixel_ref = data.shape[0], data.shape[1]
-    # Start values for fitting
-    # Correlation peak
-    mu_peak = x[np.argmax(data, axis=1)]
-    A_peak = np.max(data, axis=1)  # signal / correlation peak
-    # Background of uncorrelated data
-    n_entries = np.sum(data, axis=1)
-    A_background = np.mean(data, axis=1)  # noise / background halo
-    mu_background = np.zeros_like(n_entries)
-    mu_background[n_entries > 0] = np.average(data, axis=1, weights=x)[n_entries > 0] * np.sum(x) / n_entries[n_entries > 0]
-
-    coeff = None
-    fit_converged = False  # To signal that las fit was good, thus the results can be taken as start values for next fit
-
-    # for logging
-    no_correlation_indices = []
-    few_correlation_indices = []
-    # get index of the highest background value
-    fit_start_index = np.argmax(A_background)
-    indices_lower = np.arange(fit_start_index)[::-1]
-    indices_higher = np.arange(fit_start_index, n_pixel_dut)
-    stacked_indices = np.hstack([indices_lower, indices_higher])
-
-    for index in stacked_indices:  # Loop over x dimension of correlation histogram
-        if index == fit_start_index:
-            if index > 0 and coeff_fitted[index - 1] is not None:
-                coeff = coeff_fitted[index - 1]
-                fit_converged = True
-            else:
-                fit_converged = False
-        # TODO: start fitting from the beam center to get a higher chance to pick up the correlation peak
-
-        # omit correlation fit with no entries / correlation (e.g. sensor edges, masked columns)
-        if np.all(data[index, :] == 0):
-            no_correlation_indices.append(index)
-            continue
-
-        # omit correlation fit if sum of correlation entries is < 1 % of total entries devided by number of indices
-        # (e.g. columns not in the beam)
-        n_cluster_curr_index = data[index, :].sum()
-        if fit_converged and n_cluster_curr_index < data.sum() / n_pixel_dut * 0.01:
-            few_correlation_indices.append(index)
-            continue
-
-        # Set start parameters and fit limits
-        # Parameters: A_1, mu_1, sigma_1, A_2, mu_2, sigma_2, offset
-        if fit_converged and not reduce_background:  # Set start values from last successfull fit, no large difference expected
-            p0 = coeff  # Set start values from last successfull fit
-            bounds = calc_limits_from_fit(x, coeff)  # Set boundaries from previous converged fit
-        else:  # No (last) successfull fit, try to dedeuce reasonable start values
-            p0 = [A_peak[index], mu_peak[index], 5.0, A_background[index], mu_background[index], analysis_utils.get_rms_from_histogram(data[index, :], x), 0.0]
-            bounds = [[0.0, x.min(), 0.0, 0.0, x.min(), 0.0, 0.0], [2.0 * A_peak[index], x.max(), x.max() - x.min(), 2.0 * A_peak[index], x.max(), np.inf, A_peak[index]]]
-
-        # Fit correlation
-        if fit_background:  # Describe background with addidional gauss + offset
-            try:
-                coeff, var_matrix = curve_fit(analysis_utils.double_gauss_offset, x, data[index, :], p0=p0, bounds=bounds)
-            except RuntimeError:  # curve_fit failed
-                fit_converged = False
-            else:
-                fit_converged = True
-                # do some result checks
-                if not signal_sanity_check(coeff, s_n, A_peak[index]):
-                    logging.debug('No correlation peak found. Try another fit...')
-                    # Use parameters from last fit as start parameters for the refit
-                    y_fit = analysis_utils.double_gauss_offset(x, *coeff)
-                    try:
-                        coeff, var_matrix = refit_advanced(x_data=x, y_data=data[index, :], y_fit=y_fit, p0=coeff)
-                    except RuntimeError:  # curve_fit failed
-                        fit_converged = False
-                    else:
-                        fit_converged = True
-                        # Check result again:
-                        if not signal_sanity_check(coeff, s_n, A_peak[index]):
-                            logging.debug('No correlation peak found after refit!')
-                            fit_converged = False
-
-        else:  # Describe background with offset only.
-            # Change start parameters and boundaries
-            p0_gauss_offset = [p0_val for i, p0_val in enumerate(p0) if i in (0, 1, 2, 6)]
-            bounds_gauss_offset = [0, np.inf]
-            bounds_gauss_offset[0] = [bound_val for i, bound_val in enumerate(bounds[0]) if i in (0, 1, 2, 6)]
-            bounds_gauss_offset[1] = [bound_val for i, bound_val in enumerate(bounds[1]) if i in (0, 1, 2, 6)]
-            try:
-                coeff_gauss_offset, var_matrix = curve_fit(analysis_utils.gauss_offset, x, data[index, :], p0=p0_gauss_offset, bounds=bounds_gauss_offset)
-            except RuntimeError:  # curve_fit failed
-                fit_converged = False
-            else:
-                # Correlation should have at least 2 entries to avoid random fluctuation peaks to be selected
-                if coeff_gauss_offset[0] > 2:
-                    fit_converged = True
-                    # Change back coefficents
-                    coeff = np.insert(coeff_gauss_offset, 3, [np.nan] * 3)  # Parameters: A_1, mu_1, sigma_1, A_2, mu_2, sigma_2, offset
-                else:
-                    fit_converged = False
-
-        # Set fit results for given index if successful
-        if fit_converged:
-            coeff_fitted[index] = coeff
-            mean_fitted[index] = coeff[1]
-            mean_error_fitted[index] = np.sqrt(np.abs(np.diag(var_matrix)))[1]
-            sigma_fitted[index] = np.abs(coeff[2])
-            chi2[index] = analysis_utils.get_chi2(y_data=data[index, :], y_fit=analysis_utils.double_gauss_offset(x, *coeff))
+    A_peak = np.max(y)
+    # Parameters: A_1, mu_1, sigma_1, A_2, mu_2, sigma_2, offset
+    p0 = _get_correlation_start_values(x=x, y=y)
+    p0[6] = 0.0
+    bounds = [[0.0, x.min(), 0.0, 0.0, x.min(), 0.0, 0.0], [2.0 * A_peak, x.max(), x.max() - x.min(), 2.0 * A_peak, x.max(), np.inf, A_peak]]
 
-    if no_correlation_indices:
-        logging.info('No correlation entries for indices %s. Omit correlation fit.', str(no_correlation_indices)[1:-1])
-
-    if few_correlation_indices:
-        logging.info('Very few correlation entries for indices %s. Omit correlation fit.', str(few_correlation_indices)[1:-1])
+    # Fit correlation, describe background with addidional gauss + offset
+    try:
+        coeff, var_matrix = curve_fit(analysis_utils.double_gauss_offset, x, y, p0=p0, bounds=bounds)
+    except RuntimeError:  # curve_fit failed
+        return None
+    # do some result checks
+    if not signal_sanity_check(coeff, s_n, A_peak):
+        logging.debug('No correlation peak found. Try another fit...')
+        # Use parameters from last fit as start parameters for the refit
+        y_fit = analysis_utils.double_gauss_offset(x, *coeff)
+        try:
+            coeff, var_matrix = refit_advanced(x_data=x, y_data=y, y_fit=y_fit, p0=coeff)
+        except RuntimeError:  # curve_fit failed
+            return None
+        # Check result again:
+        if not signal_sanity_check(coeff, s_n, A_peak):
+            logging.debug('No correlation peak found after refit!')
+            return None
+    return coeff, var_matrix
 
 
 def refit_advanced(x_data, y_data, y_fit, p0):
@@ -696,7 +740,7 @@ def apply_alignment(input_hit_file, input_alignment_file, output_hit_file, inver
 
     Note:
     -----
-    This function cannot be easily made faster with multiprocessing since the computation function (apply_alignment_to_chunk) does not
+    This function cannot be easily made faster with multiprocessing since the computation function (geometry_utils.AlignmentTransformer.transform_hits) does not
     contribute significantly to the runtime (< 20 %), but the copy overhead for not shared memory needed for multipgrocessing is higher.
     Also the hard drive IO can be limiting (30 Mb/s read, 20 Mb/s write to the same disk)
 
@@ -745,41 +789,10 @@ def apply_alignment(input_hit_file, input_alignment_file, output_hit_file, inver
             n_duts = alignment.shape[0]
             use_prealignment = False
 
-    def apply_alignment_to_chunk(hits_chunk, dut_index, use_prealignment, alignment, inverse, no_z):
-        if use_prealignment:  # Apply transformation from pre-alignment information
-            (hits_chunk['x_dut_%d' % dut_index],
-             hits_chunk['y_dut_%d' % dut_index],
-             hit_z,
-             hits_chunk['xerr_dut_%d' % dut_index],
-             hits_chunk['yerr_dut_%d' % dut_index],
-             hits_chunk['zerr_dut_%d' % dut_index]) = geometry_utils.apply_alignment(
-                hits_x=hits_chunk['x_dut_%d' % dut_index],
-                hits_y=hits_chunk['y_dut_%d' % dut_index],
-                hits_z=hits_chunk['z_dut_%d' % dut_index],
-                hits_xerr=hits_chunk['xerr_dut_%d' % dut_index],
-                hits_yerr=hits_chunk['yerr_dut_%d' % dut_index],
-                hits_zerr=hits_chunk['zerr_dut_%d' % dut_index],
-                dut_index=dut_index,
-                prealignment=prealignment,
-                inverse=inverse)
-        else:  # Apply transformation from fine alignment information
-            (hits_chunk['x_dut_%d' % dut_index],
-             hits_chunk['y_dut_%d' % dut_index],
-             hit_z,
-             hits_chunk['xerr_dut_%d' % dut_index],
-             hits_chunk['yerr_dut_%d' % dut_index],
-             hits_chunk['zerr_dut_%d' % dut_index]) = geometry_utils.apply_alignment(
-                hits_x=hits_chunk['x_dut_%d' % dut_index],
-                hits_y=hits_chunk['y_dut_%d' % dut_index],
-                hits_z=hits_chunk['z_dut_%d' % dut_index],
-                hits_xerr=hits_chunk['xerr_dut_%d' % dut_index],
-                hits_yerr=hits_chunk['yerr_dut_%d' % dut_index],
-                hits_zerr=hits_chunk['zerr_dut_%d' % dut_index],
-                dut_index=dut_index,
-                alignment=alignment,
-                inverse=inverse)
-        if not no_z:
-            hits_chunk['z_dut_%d' % dut_index] = hit_z
+    if use_prealignment:
+        transformer = geometry_utils.AlignmentTransformer(prealignment=prealignment)
+    else:
+        transformer = geometry_utils.AlignmentTransformer(alignment=alignment)
 
     # Looper over the hits of all DUTs of all hit tables in chunks and apply the alignment
     with tb.open_file(input_hit_file, mode='r') as in_file_h5:
@@ -796,21 +809,24 @@ def apply_alignment(input_hit_file, input_alignment_file, output_hit_file, inver
                 progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=hits.shape[0], term_width=80)
                 progress_bar.start()
 
-                for hits_chunk, index in analysis_utils.data_aligned_at_events(hits, chunk_size=chunk_size):  # Loop over the hits
+                for hits_chunk, index in analysis_utils.data_aligned_at_events(hits, chunk_size=chunk_size, prefetch=1):  # Loop over the hits
                     for dut_index in range(0, n_duts):  # Loop over the DUTs in the hit table
                         if use_duts is not None and dut_index not in use_duts:  # omit DUT
                             continue
 
-                        apply_alignment_to_chunk(hits_chunk=hits_chunk, dut_index=dut_index, use_prealignment=use_prealignment, alignment=prealignment if use_prealignment else alignment, inverse=inverse, no_z=no_z)
+                        transformer.transform_hits(hits=hits_chunk, dut_index=dut_index, inverse=inverse, no_z=no_z)
 
-                    hits_aligned_table.append(hits_chunk)
+                    with analysis_utils.hdf5_lock:  # The next chunk is read at the same time
+                        hits_aligned_table.append(hits_chunk)
                     progress_bar.update(index)
+                if 'event_number' in hits_aligned_table.colnames:
+                    analysis_utils.create_event_index(hits_aligned_table)  # Index event numbers for fast access
                 progress_bar.finish()
 
     logging.debug('File with realigned hits %s', output_hit_file)
 
 
-def alignment(input_track_candidates_file, input_alignment_file, n_pixels, pixel_size, align_duts=None, selection_fit_duts=None, selection_hit_duts=None, selection_track_quality=1, initial_rotation=None, initial_translation=None, max_iterations=10, use_n_tracks=200000, plot=False, chunk_size=100000):
+def alignment(input_track_candidates_file, input_alignment_file, n_pixels, pixel_size, align_duts=None, selection_fit_duts=None, selection_hit_duts=None, selection_track_quality=1, initial_rotation=None, initial_translation=None, initial_alignment_file=None, residual_tolerance=0.02, max_iterations=10, use_n_tracks=200000, method='Iterative', plot=False, chunk_size=100000):
     ''' This function does an alignment of the DUTs and sets translation and rotation values for all DUTs.
     The reference DUT defines the global coordinate system position at 0, 0, 0 and should be well in the beam and not heavily rotated.
 
@@ -860,12 +876,23 @@ def alignment(input_track_candidates_file, input_alignment_file, n_pixels, pixel
         Initial rotation array.
     initial_translation : array
         Initial translation array.
+    initial_alignment_file : string
+        File name of an alignment file with an Alignment table (e.g. of a previous run with the same geometry) that is used as the starting point.
+        The alignment is then only verified and fine-tuned. Cannot be used together with initial_rotation / initial_translation.
+    residual_tolerance : float
+        Only used with initial_alignment_file. If the mean of the residuals of all DUTs to align is below this fraction of the pixel size
+        with the initial alignment, the initial alignment is kept without further iterations.
     max_iterations : uint
         Maximum number of iterations of calc residuals, apply rotation refit loop until constant result is expected.
         Usually the procedure converges rather fast (< 5 iterations)
     use_n_tracks : uint
         Defines the amount of tracks to be used for the alignment. More tracks can potentially make the result
         more precise, but will also increase the calculation time.
+    method : string
+        Available methods are 'Iterative', which deduces the rotation and translation of each DUT from the residuals iteratively,
+        and 'Global', which solves the linearized least squares problem of all track and alignment parameters at once (Millepede approach).
+        The global method aligns the translation in x, y and the rotation around the beam axis and needs only one or two passes over the tracks
+        for a good pre-alignment.
     plot : bool
         If True, create additional output plots.
     chunk_size : uint
@@ -873,6 +900,11 @@ def alignment(input_track_candidates_file, input_alignment_file, n_pixels, pixel
     '''
     logging.info('=== Aligning DUTs ===')
 
+    if method not in ('Iterative', 'Global'):
+        raise ValueError('Unknown alignment method %s' % method)
+    if initial_alignment_file is not None and (initial_rotation or initial_translation):
+        raise ValueError('initial_alignment_file cannot be used together with initial_rotation / initial_translation')
+
     # Open the pre-alignment and create empty alignment info (at the beginning only the z position is set)
     with tb.open_file(input_alignment_file, mode="r") as in_file_h5:  # Open file with alignment data
         prealignment = in_file_h5.root.PreAlignment[:]
@@ -880,6 +912,17 @@ def alignment(input_track_candidates_file, input_alignment_file, n_pixels, pixel
         alignment_parameters = _create_alignment_array(n_duts)
         alignment_parameters['translation_z'] = prealignment['z']
 
+        if initial_alignment_file is not None:
+            with tb.open_file(initial_alignment_file, mode="r") as initial_alignment_file_h5:
+                initial_alignment = initial_alignment_file_h5.root.Alignment[:]
+            if initial_alignment.shape[0] != n_duts:
+                raise ValueError('The initial alignment has %d DUTs, but %d DUTs are pre-aligned' % (initial_alignment.shape[0], n_duts))
+            if not np.allclose(initial_alignment['translation_z'], prealignment['z'], rtol=0.01, atol=1000.):
+                logging.warning('The z positions of the initial alignment differ from the pre-alignment, the initial alignment is used')
+            logging.info('Use initial alignment from %s', initial_alignment_file)
+            for name in ('translation_x', 'translation_y', 'translation_z', 'alpha', 'beta', 'gamma', 'correlation_x', 'correlation_y'):
+                alignment_parameters[name] = initial_alignment[name]
+
         if initial_rotation:
             if isinstance(initial_rotation[0], Iterable):
                 for dut_index in range(n_duts):
@@ -1026,20 +1069,18 @@ def alignment(input_track_candidates_file, input_alignment_file, n_pixels, pixel
             use_n_tracks=use_n_tracks,
             n_duts=n_duts,
             max_iterations=max_iterations,
+            residual_tolerance=residual_tolerance if initial_alignment_file is not None else None,
+            method=method,
             plot=plot,
             chunk_size=chunk_size)
 
     logging.info('Alignment finished successfully!')
 
 
-def _duts_alignment(track_candidates_file, alignment_file, alignment_index, align_duts, selection_fit_duts, selection_hit_duts, selection_track_quality, n_pixels, pixel_size, use_n_tracks, n_duts, max_iterations, plot=True, chunk_size=100000):  # Called for each list of DUTs to align
+def _duts_alignment(track_candidates_file, alignment_file, alignment_index, align_duts, selection_fit_duts, selection_hit_duts, selection_track_quality, n_pixels, pixel_size, use_n_tracks, n_duts, max_iterations, residual_tolerance=None, method='Iterative', plot=True, chunk_size=100000):  # Called for each list of DUTs to align
     # Step 0: Reduce the number of tracks to increase the calculation time
     logging.info('= Alignment step 0: Reduce number of tracks to %d =', use_n_tracks)
-    track_quality_mask = 0
-    for index, dut in enumerate(selection_hit_duts):
-        for quality in range(3):
-            if quality <= selection_track_quality[index]:
-                track_quality_mask |= ((1 << dut) << quality * 8)
+    track_quality_mask = _get_track_quality_mask(selection_hit_duts=selection_hit_duts, selection_track_quality=selection_track_quality)
 
     logging.info('Use track with hits in DUTs %s', str(selection_hit_duts)[1:-1])
     data_selection.select_hits(hit_file=track_candidates_file,
@@ -1059,32 +1100,39 @@ def _duts_alignment(track_candidates_file, alignment_file, alignment_index, alig
                     force_prealignment=True,
                     chunk_size=chunk_size)
 
-    # Stage N: Repeat alignment with constrained residuals until total residual does not decrease anymore
-    _calculate_translation_alignment(track_candidates_file=os.path.splitext(track_candidates_reduced)[0] + '_not_aligned.h5',
-                                     alignment_file=alignment_file,
-                                     fit_duts=align_duts,
-                                     selection_fit_duts=selection_fit_duts,
-                                     selection_hit_duts=selection_hit_duts,
-                                     selection_track_quality=selection_track_quality,
-                                     n_pixels=n_pixels,
-                                     pixel_size=pixel_size,
-                                     n_duts=n_duts,
-                                     max_iterations=max_iterations,
-                                     plot_title_prefix='',
-                                     output_pdf=None,
-                                     chunk_size=chunk_size)
+    if method == 'Global':
+        # Stage N: Solve the linearized alignment of all DUTs at once until the alignment does not change anymore
+        _calculate_global_alignment(track_candidates_file=os.path.splitext(track_candidates_reduced)[0] + '_not_aligned.h5',
+                                    alignment_file=alignment_file,
+                                    fit_duts=align_duts,
+                                    selection_fit_duts=selection_fit_duts,
+                                    selection_hit_duts=selection_hit_duts,
+                                    selection_track_quality=selection_track_quality,
+                                    pixel_size=pixel_size,
+                                    n_duts=n_duts,
+                                    max_iterations=max_iterations,
+                                    residual_tolerance=residual_tolerance,
+                                    chunk_size=chunk_size)
+    else:
+        # Stage N: Repeat alignment with constrained residuals until total residual does not decrease anymore
+        _calculate_translation_alignment(track_candidates_file=os.path.splitext(track_candidates_reduced)[0] + '_not_aligned.h5',
+                                         alignment_file=alignment_file,
+                                         fit_duts=align_duts,
+                                         selection_fit_duts=selection_fit_duts,
+                                         selection_hit_duts=selection_hit_duts,
+                                         selection_track_quality=selection_track_quality,
+                                         pixel_size=pixel_size,
+                                         n_duts=n_duts,
+                                         max_iterations=max_iterations,
+                                         residual_tolerance=residual_tolerance)
 
     # Plot final result
     if plot:
         logging.info('= Alignment step 7: Plot final result =')
         with PdfPages(os.path.join(os.path.dirname(os.path.realpath(track_candidates_file)), 'Alignment_%d.pdf' % alignment_index)) as output_pdf:
-            # Apply final alignment result
-            apply_alignment(input_hit_file=os.path.splitext(track_candidates_reduced)[0] + '_not_aligned.h5',
-                            input_alignment_file=alignment_file,
-                            output_hit_file=os.path.splitext(track_candidates_file)[0] + '_final_tmp_%s.h5' % alignment_index,
-                            chunk_size=chunk_size)
-            fit_tracks(input_track_candidates_file=os.path.splitext(track_candidates_file)[0] + '_final_tmp_%d.h5' % alignment_index,
+            fit_tracks(input_track_candidates_file=os.path.splitext(track_candidates_reduced)[0] + '_not_aligned.h5',
                        input_alignment_file=alignment_file,
+                       align_hits=True,  # Apply final alignment result
                        output_tracks_file=os.path.splitext(track_candidates_file)[0] + '_tracks_final_tmp_%d.h5' % alignment_index,
                        fit_duts=align_duts,  # Only create residuals of selected DUTs
                        selection_fit_duts=selection_fit_duts,  # Only use selected duts
@@ -1099,7 +1147,6 @@ def _duts_alignment(track_candidates_file, alignment_file, alignment_index, alig
                                 pixel_size=pixel_size,
                                 plot=plot,
                                 chunk_size=chunk_size)
-            os.remove(os.path.splitext(track_candidates_file)[0] + '_final_tmp_%d.h5' % alignment_index)
             os.remove(os.path.splitext(track_candidates_file)[0] + '_tracks_final_tmp_%d.h5' % alignment_index)
             os.remove(os.path.splitext(track_candidates_file)[0] + '_tracks_final_tmp_%d.pdf' % alignment_index)
             os.remove(os.path.splitext(track_candidates_file)[0] + '_residuals_final_tmp_%d.h5' % alignment_index)
@@ -1108,61 +1155,73 @@ def _duts_alignment(track_candidates_file, alignment_file, alignment_index, alig
     os.remove(os.path.splitext(track_candidates_file)[0] + '_reduced_%d.h5' % alignment_index)
 
 
-def _calculate_translation_alignment(track_candidates_file, alignment_file, fit_duts, selection_fit_duts, selection_hit_duts, selection_track_quality, n_pixels, pixel_size, n_duts, max_iterations, plot_title_prefix='', output_pdf=None, chunk_size=100000):
+def _calculate_translation_alignment(track_candidates_file, alignment_file, fit_duts, selection_fit_duts, selection_hit_duts, selection_track_quality, pixel_size, n_duts, max_iterations, residual_tolerance=None):
     ''' Main function that fits tracks, calculates the residuals, deduces rotation and translation values from the residuals
     and applies the new alignment to the track hits. The alignment result is scored as a combined
-    residual value of all planes that are being aligned in x and y weighted by the pixel pitch in x and y. '''
+    residual value of all planes that are being aligned in x and y weighted by the pixel pitch in x and y.
+
+    The track candidates are read once and all iterations are done in memory, only the final alignment is stored.
+    If residual_tolerance is given and the residual means of all DUTs are below this fraction of the pixel size in the first iteration,
+    the alignment is kept. '''
     with tb.open_file(alignment_file, mode="r") as in_file_h5:  # Open file with alignment data
         alignment_last_iteration = in_file_h5.root.Alignment[:]
 
+    # Select the track candidates to fit, the selection does not depend on the alignment
+    with tb.open_file(track_candidates_file, mode="r") as in_file_h5:
+        track_candidates = in_file_h5.root.TrackCandidates[:]
+    track_quality_mask = _get_track_quality_mask(selection_hit_duts=selection_hit_duts, selection_track_quality=selection_track_quality)
+    good_track_selection = np.logical_and((track_candidates['track_quality'] & track_quality_mask) == track_quality_mask,
+                                          track_candidates['n_tracks'] > 0)  # n_tracks < 0 means merged cluster
+    track_candidates = track_candidates[good_track_selection]
+    logging.info('Use %d track candidates for the alignment', track_candidates.shape[0])
+
+    pool = smc.get_pool()
+
     total_residual = None
     for iteration in range(max_iterations):
-        if iteration >= max_iterations:
-            raise RuntimeError('Did not converge to good solution in %d iterations. Increase max_iterations', iteration)
-
-        apply_alignment(input_hit_file=track_candidates_file,  # Always apply alignment to starting file
-                        input_alignment_file=alignment_file,
-                        output_hit_file=os.path.splitext(track_candidates_file)[0] + '_no_align_%d_tmp.h5' % iteration,
-                        inverse=False,
-                        force_prealignment=False,
-                        chunk_size=chunk_size)
+        # Step 1: Apply the actual alignment to the track hits
+        logging.info('= Alignment step 1 / iteration %d: Apply alignment to the track hits =', iteration)
+        track_hits = track_candidates.copy()
+        transformer = geometry_utils.AlignmentTransformer(alignment=alignment_last_iteration)
+        for dut_index in range(n_duts):
+            transformer.transform_hits(hits=track_hits, dut_index=dut_index)
 
         # Step 2: Fit tracks for all DUTs
         logging.info('= Alignment step 2 / iteration %d: Fit tracks for all DUTs =', iteration)
-        fit_tracks(input_track_candidates_file=os.path.splitext(track_candidates_file)[0] + '_no_align_%d_tmp.h5' % iteration,
-                   input_alignment_file=alignment_file,
-                   output_tracks_file=os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.h5' % iteration,
-                   fit_duts=fit_duts,  # Only create residuals of selected DUTs
-                   selection_fit_duts=selection_fit_duts,   # Only use selected DUTs for track fit
-                   selection_hit_duts=selection_hit_duts,  # Only use selected duts
-                   exclude_dut_hit=False,  # For constrained residuals
-                   selection_track_quality=selection_track_quality,
-                   force_prealignment=False,
-                   chunk_size=chunk_size)
+        track_fit_hits = np.stack([np.column_stack((track_hits['x_dut_%d' % dut_index],
+                                                    track_hits['y_dut_%d' % dut_index],
+                                                    track_hits['z_dut_%d' % dut_index])) for dut_index in sorted(set(selection_fit_duts))], axis=1)
+        results = pool.map(_fit_tracks_loop, np.array_split(track_fit_hits, cpu_count()))
+        offsets = np.concatenate([result[0] for result in results])
+        slopes = np.concatenate([result[1] for result in results])
+        chi2s = np.concatenate([result[2] for result in results])
 
         # Step 3: Calculate the residuals for each DUT
         logging.info('= Alignment step 3 / iteration %d: Calculate the residuals for each selected DUT =', iteration)
-        calculate_residuals(input_tracks_file=os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.h5' % iteration,
-                            input_alignment_file=alignment_file,
-                            output_residuals_file=os.path.splitext(track_candidates_file)[0] + '_residuals_%d_tmp.h5' % iteration,
-                            n_pixels=n_pixels,
-                            pixel_size=pixel_size,
-                            # smaller devices needs None, otherwise npixels_per_bin=5 and nbins_per_pixel=1 might improve the first step
-                            npixels_per_bin=None,
-                            nbins_per_pixel=None,
-                            plot=False,
-                            chunk_size=chunk_size)
+        residuals = {}
+        for dut_index in fit_duts:
+            residuals[dut_index] = _calculate_residuals(track_hits=track_hits,
+                                                        offsets=offsets,
+                                                        slopes=slopes,
+                                                        chi2s=chi2s,
+                                                        dut_index=dut_index,
+                                                        alignment=alignment_last_iteration,
+                                                        pixel_size=pixel_size)
+
+        if iteration == 0 and residual_tolerance is not None and _residuals_within_tolerance(residual_means=[(residuals[dut_index]['ResidualsX']['fit_coeff'][1], residuals[dut_index]['ResidualsY']['fit_coeff'][1]) for dut_index in fit_duts],
+                                                                                              pixel_size=[pixel_size[dut_index] for dut_index in fit_duts],
+                                                                                              residual_tolerance=residual_tolerance):
+            logging.info('!! Residuals are within the tolerance, keep the initial alignment !!')
+            break
 
         # Step 4: Deduce rotations from the residuals
         logging.info('= Alignment step 4 / iteration %d: Deduce rotations and translations from the residuals =', iteration)
-        alignment_parameters_change, new_total_residual = _analyze_residuals(residuals_file=os.path.splitext(track_candidates_file)[0] + '_residuals_%d_tmp.h5' % iteration,
+        alignment_parameters_change, new_total_residual = _analyze_residuals(residuals=residuals,
                                                                              fit_duts=fit_duts,
                                                                              pixel_size=pixel_size,
                                                                              n_duts=n_duts,
                                                                              translation_only=False,
-                                                                             plot_title_prefix=plot_title_prefix,
-                                                                             relaxation_factor=1.0,  # FIXME: good code practice: nothing hardcoded
-                                                                             output_pdf=output_pdf)
+                                                                             relaxation_factor=1.0)  # FIXME: good code practice: nothing hardcoded
 
         # Create actual alignment (old alignment + the actual relative change)
         new_alignment_parameters = geometry_utils.merge_alignment_parameters(
@@ -1171,42 +1230,232 @@ def _calculate_translation_alignment(track_candidates_file, alignment_file, fit_
             select_duts=fit_duts,
             mode='relative')
 
-        # FIXME: This step does not work well
-#         # Step 5: Try to find better rotation by minimizing the residual in x + y for different angles
-#         logging.info('= Alignment step 5 / iteration %d: Optimize alignment by minimizing residuals =', iteration)
-#         new_alignment_parameters, new_total_residual = _optimize_alignment(tracks_file=os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.h5' % iteration,
-#                                                                            alignment_last_iteration=alignment_last_iteration,
-#                                                                            new_alignment_parameters=new_alignment_parameters,
-#                                                                            pixel_size=pixel_size)
-
-        # Delete not needed files
-        os.remove(os.path.splitext(track_candidates_file)[0] + '_no_align_%d_tmp.h5' % iteration)
-        os.remove(os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.h5' % iteration)
-        os.remove(os.path.splitext(track_candidates_file)[0] + '_tracks_%d_tmp.pdf' % iteration)
-        os.remove(os.path.splitext(track_candidates_file)[0] + '_residuals_%d_tmp.h5' % iteration)
         logging.info('Total residual %1.4e', new_total_residual)
 
         if total_residual is not None and new_total_residual > total_residual:  # True if actual alignment is worse than the alignment from last iteration
             logging.info('!! Best alignment found !!')
-            logging.info('= Alignment step 6 / iteration %d: Use rotation / translation information from previous iteration =', iteration)
-            geometry_utils.store_alignment_parameters(alignment_file,  # Store alignment from last iteration
-                                                      alignment_last_iteration,
-                                                      mode='absolute',
-                                                      select_duts=fit_duts)
-            return
-        else:
-            total_residual = new_total_residual
+            logging.info('= Alignment step 5 / iteration %d: Use rotation / translation information from previous iteration =', iteration)
+            break
+        total_residual = new_total_residual
+
+        alignment_last_iteration = new_alignment_parameters.copy()
+
+    logging.info('= Alignment step 6: Set new rotation / translation information in alignment file =')
+    geometry_utils.store_alignment_parameters(alignment_file,
+                                              alignment_last_iteration,
+                                              mode='absolute',
+                                              select_duts=fit_duts)
+
+
+def _calculate_global_alignment(track_candidates_file, alignment_file, fit_duts, selection_fit_duts, selection_hit_duts, selection_track_quality, pixel_size, n_duts, max_iterations, residual_tolerance=None, chunk_size=100000):
+    ''' Global linear least squares alignment of all DUTs to align at once (Millepede approach).
+
+    For each pass the track candidates are read once in chunks and the normal equations of the track parameters
+    (offset and slope in x and y) and the alignment parameters (translation x, y and the rotation gamma around the beam axis)
+    are accumulated. The tilt angles alpha and beta change the residuals only in second order for tracks perpendicular to the planes
+    and are therefore not changed. The track parameters are eliminated per track (Schur complement), thus only the reduced
+    system of the alignment parameters has to be solved once per pass. The undefined global modes
+    (e.g. shift / shear / rotation of all planes) are removed by taking the minimum norm solution.
+    For a good pre-alignment one or two passes are enough, more passes are only done to correct non-linearities.
+    The hit resolution is assumed to be binary (pixel size / sqrt(12)).
+    If residual_tolerance is given and the residual means of all DUTs are below this fraction of the pixel size in the first pass,
+    the alignment is kept. '''
+    with tb.open_file(alignment_file, mode="r") as in_file_h5:  # Open file with alignment data
+        alignment_last_iteration = in_file_h5.root.Alignment[:]
 
-        alignment_last_iteration = new_alignment_parameters.copy()  # in_file_h5.root.Alignment[:]
+    track_quality_mask = _get_track_quality_mask(selection_hit_duts=selection_hit_duts, selection_track_quality=selection_track_quality)
+    fit_duts = sorted(set(fit_duts))
+    selection_fit_duts = sorted(set(selection_fit_duts))
+    measurement_duts = sorted(set(fit_duts) | set(selection_fit_duts))  # All DUTs with hits used in the global fit
+    n_parameters = 3  # Translation x, y and gamma per DUT
+    parameter_index = np.array([fit_duts.index(dut_index) * n_parameters if dut_index in fit_duts else -1 for dut_index in measurement_duts], dtype=np.int)
+    weights = np.array([(12. / pixel_size[dut_index][0] ** 2, 12. / pixel_size[dut_index][1] ** 2) for dut_index in measurement_duts], dtype=np.float)
 
-        logging.info('= Alignment step 6 / iteration %d: Set new rotation / translation information in alignment file =', iteration)
-        geometry_utils.store_alignment_parameters(alignment_file,
-                                                  new_alignment_parameters,
-                                                  mode='absolute',
-                                                  select_duts=fit_duts)
+    total_residual = None
+    for iteration in range(max_iterations):
+        logging.info('= Alignment step 1 / pass %d: Build normal equations of all DUTs =', iteration)
+        transformer = geometry_utils.AlignmentTransformer(alignment=alignment_last_iteration)
+        rotation_matrices = np.array([geometry_utils.rotation_matrix(alpha=alignment_last_iteration[dut_index]['alpha'],
+                                                                     beta=alignment_last_iteration[dut_index]['beta'],
+                                                                     gamma=alignment_last_iteration[dut_index]['gamma']) for dut_index in measurement_duts])
+        rotation_matrix_derivatives = np.array([_get_rotation_matrix_derivatives(alpha=alignment_last_iteration[dut_index]['alpha'],
+                                                                                 beta=alignment_last_iteration[dut_index]['beta'],
+                                                                                 gamma=alignment_last_iteration[dut_index]['gamma'])[2] for dut_index in measurement_duts])  # Only gamma is aligned
+        dut_positions = np.array([(alignment_last_iteration[dut_index]['translation_x'],
+                                   alignment_last_iteration[dut_index]['translation_y'],
+                                   alignment_last_iteration[dut_index]['translation_z']) for dut_index in measurement_duts], dtype=np.float)
+
+        global_matrix = np.zeros((n_parameters * len(fit_duts), n_parameters * len(fit_duts)), dtype=np.float)
+        global_vector = np.zeros((n_parameters * len(fit_duts),), dtype=np.float)
+        residual_sums = np.zeros((len(measurement_duts), 2), dtype=np.float)
+        residual_squares = np.zeros((len(measurement_duts), 2), dtype=np.float)
+        n_residuals = np.zeros((len(measurement_duts),), dtype=np.int)
+        chi2 = 0.
+        n_tracks = 0
+
+        with tb.open_file(track_candidates_file, mode="r") as in_file_h5:
+            for track_candidates, _ in analysis_utils.data_aligned_at_events(in_file_h5.root.TrackCandidates, chunk_size=chunk_size):
+                good_track_selection = np.logical_and((track_candidates['track_quality'] & track_quality_mask) == track_quality_mask,
+                                                      track_candidates['n_tracks'] > 0)  # n_tracks < 0 means merged cluster
+                track_candidates = track_candidates[good_track_selection]
+                if track_candidates.shape[0] == 0:
+                    continue
+
+                # Seed tracks from the hits with the actual alignment
+                track_fit_hits = np.empty((track_candidates.shape[0], len(selection_fit_duts), 3), dtype=np.float)
+                for index, dut_index in enumerate(selection_fit_duts):
+                    track_fit_hits[:, index, 0], track_fit_hits[:, index, 1], track_fit_hits[:, index, 2] = transformer.transform(hits_x=track_candidates['x_dut_%d' % dut_index],
+                                                                                                                                  hits_y=track_candidates['y_dut_%d' % dut_index],
+                                                                                                                                  hits_z=track_candidates['z_dut_%d' % dut_index],
+                                                                                                                                  dut_index=dut_index)[:3]
+                offsets, slopes, _ = _fit_tracks_loop(track_fit_hits)
+
+                # Hits in the local coordinate system of each DUT
+                local_hits = np.empty((track_candidates.shape[0], len(measurement_duts), 2), dtype=np.float)
+                for index, dut_index in enumerate(measurement_duts):
+                    local_hits[:, index, 0] = track_candidates['x_dut_%d' % dut_index]
+                    local_hits[:, index, 1] = track_candidates['y_dut_%d' % dut_index]
+
+                actual_chi2, actual_n_tracks = _accumulate_global_alignment(local_hits, offsets, slopes, rotation_matrices, rotation_matrix_derivatives, dut_positions, weights, parameter_index,
+                                                                            global_matrix, global_vector, residual_sums, residual_squares, n_residuals)
+                chi2 += actual_chi2
+                n_tracks += actual_n_tracks
+
+        if n_tracks == 0:
+            raise RuntimeError('No tracks available for the global alignment')
+
+        # Score like the iterative alignment: RMS of the residuals in units of the pixel size, DUTs without hits are omitted
+        has_residuals = n_residuals > 0
+        if not np.all(has_residuals):
+            logging.warning('No hits in DUT%s for the global alignment', ', DUT'.join(str(dut_index) for index, dut_index in enumerate(measurement_duts) if not has_residuals[index]))
+        residual_mean = np.full(residual_sums.shape, np.nan)
+        residual_rms = np.full(residual_squares.shape, np.nan)
+        residual_mean[has_residuals] = residual_sums[has_residuals] / n_residuals[has_residuals, np.newaxis]
+        residual_rms[has_residuals] = np.sqrt(np.maximum(residual_squares[has_residuals] / n_residuals[has_residuals, np.newaxis] - np.square(residual_mean[has_residuals]), 0.))
+        new_total_residual = np.sqrt(np.sum([np.square(residual_rms[index, 0] / pixel_size[dut_index][0]) + np.square(residual_rms[index, 1] / pixel_size[dut_index][1]) for index, dut_index in enumerate(measurement_duts) if dut_index in fit_duts and has_residuals[index]]))
+        logging.info('Total residual %1.4e, chi2 / track %1.4e (%d tracks)', new_total_residual, chi2 / n_tracks, n_tracks)
+
+        if total_residual is not None and new_total_residual > total_residual:  # True if actual alignment is worse than the alignment from last pass
+            logging.info('!! Best alignment found !!')
+            alignment_last_iteration = alignment_previous_iteration
+            break
+        total_residual = new_total_residual
+
+        if iteration == 0 and residual_tolerance is not None and _residuals_within_tolerance(residual_means=[residual_mean[measurement_duts.index(dut_index)] for dut_index in fit_duts],
+                                                                                              pixel_size=[pixel_size[dut_index] for dut_index in fit_duts],
+                                                                                              residual_tolerance=residual_tolerance):
+            logging.info('!! Residuals are within the tolerance, keep the initial alignment !!')
+            break
+
+        # Set the spread of the residuals as the correlation value like the iterative alignment
+        for index, dut_index in enumerate(measurement_duts):
+            if dut_index in fit_duts and has_residuals[index]:
+                alignment_last_iteration[dut_index]['correlation_x'] = residual_rms[index, 0]
+                alignment_last_iteration[dut_index]['correlation_y'] = residual_rms[index, 1]
+
+        logging.info('= Alignment step 2 / pass %d: Solve normal equations of %d alignment parameters =', iteration, global_vector.shape[0])
+        parameters_change = _solve_global_alignment(global_matrix, global_vector)
+
+        alignment_previous_iteration = alignment_last_iteration.copy()
+        for index, dut_index in enumerate(fit_duts):
+            alignment_last_iteration[dut_index]['translation_x'] += parameters_change[index * n_parameters]
+            alignment_last_iteration[dut_index]['translation_y'] += parameters_change[index * n_parameters + 1]
+            alignment_last_iteration[dut_index]['gamma'] += parameters_change[index * n_parameters + 2]
+            logging.info('DUT%d: translation change x / y = %1.2f / %1.2f um, rotation change gamma = %1.2e', dut_index, parameters_change[index * n_parameters], parameters_change[index * n_parameters + 1], parameters_change[index * n_parameters + 2])
+
+        # Stop if the change is well below the resolution
+        if np.all([np.abs(parameters_change[index * n_parameters]) < 1e-3 * pixel_size[dut_index][0] and np.abs(parameters_change[index * n_parameters + 1]) < 1e-3 * pixel_size[dut_index][1] for index, dut_index in enumerate(fit_duts)]):
+            logging.info('!! Alignment converged !!')
+            break
+
+    logging.info('= Alignment step 3: Set new rotation / translation information in alignment file =')
+    geometry_utils.store_alignment_parameters(alignment_file,
+                                              alignment_last_iteration,
+                                              mode='absolute',
+                                              select_duts=fit_duts)
 
 
 # Helper functions for the alignment. Not to be used directly.
+def _get_track_quality_mask(selection_hit_duts, selection_track_quality):
+    ''' Returns the track quality bit mask that requires hits with the given track quality in the selected DUTs. '''
+    track_quality_mask = 0
+    for index, dut in enumerate(selection_hit_duts):
+        for quality in range(3):
+            if quality <= selection_track_quality[index]:
+                track_quality_mask |= ((1 << dut) << quality * 8)
+    return track_quality_mask
+
+
+def _residuals_within_tolerance(residual_means, pixel_size, residual_tolerance):
+    ''' Returns True if the residual means in x and y of all DUTs are below the given fraction of the pixel size. '''
+    for (mean_x, mean_y), (pixel_size_x, pixel_size_y) in zip(residual_means, pixel_size):
+        logging.info('Residual mean x / y = %1.2f / %1.2f um', mean_x, mean_y)
+        if not np.abs(mean_x) < residual_tolerance * pixel_size_x or not np.abs(mean_y) < residual_tolerance * pixel_size_y:
+            return False
+    return True
+
+
+def _calculate_residuals(track_hits, offsets, slopes, chi2s, dut_index, alignment, pixel_size):
+    ''' Calculates the residuals of one DUT in the global coordinate system from the track hits and the fitted tracks
+    and fits them like calculate_residuals does with automatic binning.
+
+    Returns a dictionary with the fit results (fit_coeff, fit_cov) of the residuals (ResidualsX, ResidualsY) and the
+    residuals against the track position (XResidualsX, YResidualsY, XResidualsY, YResidualsX). The residual histograms
+    (hist, edges) are added for ResidualsX and ResidualsY.
+    '''
+    # Set the track offsets to the track intersection with the tilted DUT plane
+    dut_position = np.array([alignment[dut_index]['translation_x'], alignment[dut_index]['translation_y'], alignment[dut_index]['translation_z']])
+    rotation_matrix = geometry_utils.rotation_matrix(alpha=alignment[dut_index]['alpha'],
+                                                     beta=alignment[dut_index]['beta'],
+                                                     gamma=alignment[dut_index]['gamma'])
+    dut_plane_normal = rotation_matrix.T.dot(np.eye(3))[2]
+    intersections = geometry_utils.get_line_intersections_with_plane(line_origins=offsets,
+                                                                     line_directions=slopes,
+                                                                     position_plane=dut_position,
+                                                                     normal_plane=dut_plane_normal)
+
+    # Take only tracks where the DUT has a hit
+    selection = np.logical_and(~np.isnan(track_hits['x_dut_%d' % dut_index]), ~np.isnan(chi2s))
+    intersection_x, intersection_y = intersections[selection, 0], intersections[selection, 1]
+    difference_x = track_hits['x_dut_%d' % dut_index][selection] - intersection_x
+    difference_y = track_hits['y_dut_%d' % dut_index][selection] - intersection_y
+
+    # Histogram the residuals with the binning of calculate_residuals, the range is given by the residual peak width
+    edges = []
+    for difference, intersection, actual_pixel_size in ((difference_x, intersection_x, pixel_size[dut_index][0]), (difference_y, intersection_y, pixel_size[dut_index][1])):
+        plot_n_pixels = 6.0
+        hist, hist_edges = np.histogram(difference, bins="auto")
+        edge_center = (hist_edges[1:] + hist_edges[:-1]) / 2.0
+        try:
+            _, center, fwhm, _ = analysis_utils.peak_detect(edge_center, hist)
+        except RuntimeError:
+            try:
+                _, center, fwhm, _ = analysis_utils.simple_peak_detect(edge_center, hist)
+            except RuntimeError:
+                center, fwhm = 0.0, actual_pixel_size * plot_n_pixels
+        width = actual_pixel_size * np.ceil(plot_n_pixels * fwhm / actual_pixel_size)
+        _, residual_edges = np.histogram(difference, range=(center - width, center + width), bins="auto")
+        _, position_edges = np.histogram(intersection, bins="auto")
+        edges.append((residual_edges, position_edges))
+    (x_residual_edges, x_position_edges), (y_residual_edges, y_position_edges) = edges
+
+    residuals = {}
+    for name, difference, residual_edges in (('ResidualsX', difference_x, x_residual_edges), ('ResidualsY', difference_y, y_residual_edges)):
+        hist, _ = np.histogram(difference, bins=residual_edges)
+        fit, cov = analysis_utils.fit_residuals(hist=hist, edges=residual_edges)
+        residuals[name] = {'hist': hist, 'edges': residual_edges, 'fit_coeff': fit, 'fit_cov': cov}
+
+    for name, intersection, position_edges, difference, residual_edges in (('XResidualsX', intersection_x, x_position_edges, difference_x, x_residual_edges),
+                                                                           ('YResidualsY', intersection_y, y_position_edges, difference_y, y_residual_edges),
+                                                                           ('XResidualsY', intersection_x, x_position_edges, difference_y, y_residual_edges),
+                                                                           ('YResidualsX', intersection_y, y_position_edges, difference_x, x_residual_edges)):
+        hist, _, _ = np.histogram2d(intersection, difference, bins=(position_edges, residual_edges))
+        fit, cov = analysis_utils.fit_residuals_vs_position(hist=hist, xedges=position_edges, yedges=residual_edges)
+        residuals[name] = {'fit_coeff': fit, 'fit_cov': cov}
+
+    return residuals
+
+
 def _create_alignment_array(n_duts):
     # Result Translation / rotation table
     description = [('DUT', np.int)]
@@ -1224,68 +1473,67 @@ def _create_alignment_array(n_duts):
     return array
 
 
-def _analyze_residuals(residuals_file, fit_duts, pixel_size, n_duts, translation_only=False, relaxation_factor=1.0, plot_title_prefix='', output_pdf=None):
-    ''' Take the residual plots and deduce rotation and translation angles from them '''
+def _analyze_residuals(residuals, fit_duts, pixel_size, n_duts, translation_only=False, relaxation_factor=1.0, plot_title_prefix='', output_pdf=None):
+    ''' Take the residual fits of each DUT (see _calculate_residuals) and deduce rotation and translation angles from them '''
     alignment_parameters = _create_alignment_array(n_duts)
 
     total_residual = 0  # Sum of all residuals to judge the overall alignment
 
-    with tb.open_file(residuals_file) as in_file_h5:
-        for dut_index in fit_duts:
-            alignment_parameters[dut_index]['DUT'] = dut_index
-            # Global residuals
-            hist_node = in_file_h5.get_node('/ResidualsX_DUT%d' % dut_index)
-            std_x = hist_node._v_attrs.fit_coeff[2]
-
-            # Add resdidual to total residual normalized to pixel pitch in x
-            total_residual = np.sqrt(np.square(total_residual) + np.square(std_x / pixel_size[dut_index][0]))
-
-            if output_pdf is not None:
-                plot_utils.plot_residuals(histogram=hist_node[:],
-                                          edges=hist_node._v_attrs.xedges,
-                                          fit=hist_node._v_attrs.fit_coeff,
-                                          fit_errors=hist_node._v_attrs.fit_cov,
-                                          title='Residuals for DUT%d' % dut_index,
-                                          x_label='X residual [um]',
-                                          output_pdf=output_pdf)
-
-            hist_node = in_file_h5.get_node('/ResidualsY_DUT%d' % dut_index)
-            std_y = hist_node._v_attrs.fit_coeff[2]
-
-            # Add resdidual to total residual normalized to pixel pitch in y
-            total_residual = np.sqrt(np.square(total_residual) + np.square(std_y / pixel_size[dut_index][1]))
-
-            if translation_only:
-                return alignment_parameters, total_residual
-
-            if output_pdf is not None:
-                plot_utils.plot_residuals(histogram=hist_node[:],
-                                          edges=hist_node._v_attrs.xedges,
-                                          fit=hist_node._v_attrs.fit_coeff,
-                                          fit_errors=hist_node._v_attrs.fit_cov,
-                                          title='Residuals for DUT%d' % dut_index,
-                                          x_label='Y residual [um]',
-                                          output_pdf=output_pdf)
-
-            # use offset at origin of sensor (center of sensor) to calculate x and y correction
-            # do not use mean/median of 1D residual since it depends on the beam spot position when the device is rotated
-            mu_x = in_file_h5.get_node_attr('/YResidualsX_DUT%d' % dut_index, 'fit_coeff')[0]
-            mu_y = in_file_h5.get_node_attr('/XResidualsY_DUT%d' % dut_index, 'fit_coeff')[0]
-            # use slope to calculate alpha, beta and gamma
-            m_xx = in_file_h5.get_node_attr('/XResidualsX_DUT%d' % dut_index, 'fit_coeff')[1]
-            m_yy = in_file_h5.get_node_attr('/YResidualsY_DUT%d' % dut_index, 'fit_coeff')[1]
-            m_xy = in_file_h5.get_node_attr('/XResidualsY_DUT%d' % dut_index, 'fit_coeff')[1]
-            m_yx = in_file_h5.get_node_attr('/YResidualsX_DUT%d' % dut_index, 'fit_coeff')[1]
-
-            alpha, beta, gamma = analysis_utils.get_rotation_from_residual_fit(m_xx=m_xx, m_xy=m_xy, m_yx=m_yx, m_yy=m_yy)
-
-            alignment_parameters[dut_index]['correlation_x'] = std_x
-            alignment_parameters[dut_index]['translation_x'] = -mu_x
-            alignment_parameters[dut_index]['correlation_y'] = std_y
-            alignment_parameters[dut_index]['translation_y'] = -mu_y
-            alignment_parameters[dut_index]['alpha'] = alpha * relaxation_factor
-            alignment_parameters[dut_index]['beta'] = beta * relaxation_factor
-            alignment_parameters[dut_index]['gamma'] = gamma * relaxation_factor
+    for dut_index in fit_duts:
+        alignment_parameters[dut_index]['DUT'] = dut_index
+        # Global residuals
+        residual_x = residuals[dut_index]['ResidualsX']
+        std_x = residual_x['fit_coeff'][2]
+
+        # Add resdidual to total residual normalized to pixel pitch in x
+        total_residual = np.sqrt(np.square(total_residual) + np.square(std_x / pixel_size[dut_index][0]))
+
+        if output_pdf is not None:
+            plot_utils.plot_residuals(histogram=residual_x['hist'],
+                                      edges=residual_x['edges'],
+                                      fit=residual_x['fit_coeff'],
+                                      fit_errors=residual_x['fit_cov'],
+                                      title='Residuals for DUT%d' % dut_index,
+                                      x_label='X residual [um]',
+                                      output_pdf=output_pdf)
+
+        residual_y = residuals[dut_index]['ResidualsY']
+        std_y = residual_y['fit_coeff'][2]
+
+        # Add resdidual to total residual normalized to pixel pitch in y
+        total_residual = np.sqrt(np.square(total_residual) + np.square(std_y / pixel_size[dut_index][1]))
+
+        if translation_only:
+            return alignment_parameters, total_residual
+
+        if output_pdf is not None:
+            plot_utils.plot_residuals(histogram=residual_y['hist'],
+                                      edges=residual_y['edges'],
+                                      fit=residual_y['fit_coeff'],
+                                      fit_errors=residual_y['fit_cov'],
+                                      title='Residuals for DUT%d' % dut_index,
+                                      x_label='Y residual [um]',
+                                      output_pdf=output_pdf)
+
+        # use offset at origin of sensor (center of sensor) to calculate x and y correction
+        # do not use mean/median of 1D residual since it depends on the beam spot position when the device is rotated
+        mu_x = residuals[dut_index]['YResidualsX']['fit_coeff'][0]
+        mu_y = residuals[dut_index]['XResidualsY']['fit_coeff'][0]
+        # use slope to calculate alpha, beta and gamma
+        m_xx = residuals[dut_index]['XResidualsX']['fit_coeff'][1]
+        m_yy = residuals[dut_index]['YResidualsY']['fit_coeff'][1]
+        m_xy = residuals[dut_index]['XResidualsY']['fit_coeff'][1]
+        m_yx = residuals[dut_index]['YResidualsX']['fit_coeff'][1]
+
+        alpha, beta, gamma = analysis_utils.get_rotation_from_residual_fit(m_xx=m_xx, m_xy=m_xy, m_yx=m_yx, m_yy=m_yy)
+
+        alignment_parameters[dut_index]['correlation_x'] = std_x
+        alignment_parameters[dut_index]['translation_x'] = -mu_x
+        alignment_parameters[dut_index]['correlation_y'] = std_y
+        alignment_parameters[dut_index]['translation_y'] = -mu_y
+        alignment_parameters[dut_index]['alpha'] = alpha * relaxation_factor
+        alignment_parameters[dut_index]['beta'] = beta * relaxation_factor
+        alignment_parameters[dut_index]['gamma'] = gamma * relaxation_factor
 
     return alignment_parameters, total_residual
 
@@ -1425,14 +1673,293 @@ def _optimize_alignment(tracks_file, alignment_last_iteration, new_alignment_par
     return alignment_result, total_residuals_after  # Return alignment result and total residual
 
 
+def _get_rotation_matrix_derivatives(alpha, beta, gamma):
+    ''' Returns the derivatives of the rotation matrix R = R_x(alpha) R_y(beta) R_z(gamma) with respect to alpha, beta and gamma. '''
+    rotation_matrix_x = geometry_utils.rotation_matrix_x(alpha=alpha)
+    rotation_matrix_y = geometry_utils.rotation_matrix_y(beta=beta)
+    rotation_matrix_z = geometry_utils.rotation_matrix_z(gamma=gamma)
+    return np.array([np.dot(np.array([[0., 0., 0.], [0., -np.sin(alpha), np.cos(alpha)], [0., -np.cos(alpha), -np.sin(alpha)]]), np.dot(rotation_matrix_y, rotation_matrix_z)),
+                     np.dot(rotation_matrix_x, np.dot(np.array([[-np.sin(beta), 0., -np.cos(beta)], [0., 0., 0.], [np.cos(beta), 0., -np.sin(beta)]]), rotation_matrix_z)),
+                     np.dot(rotation_matrix_x, np.dot(rotation_matrix_y, np.array([[-np.sin(gamma), np.cos(gamma), 0.], [-np.cos(gamma), -np.sin(gamma), 0.], [0., 0., 0.]])))])
+
+
+def _solve_global_alignment(global_matrix, global_vector, rcond=1e-6):
+    ''' Solves the reduced normal equations of the global alignment.
+
+    The matrix is scaled to unit diagonal and the eigenvalues below rcond times the largest eigenvalue are removed.
+    These are the undefined modes of the alignment (shift, shear, rotation and twist of all planes) and the minimum norm solution leaves them unchanged.
+    '''
+    diagonal = np.diag(global_matrix)
+    scale = np.zeros_like(diagonal)
+    scale[diagonal > 0.] = 1. / np.sqrt(diagonal[diagonal > 0.])  # Parameters without data are not changed
+    eigenvalues, eigenvectors = np.linalg.eigh(global_matrix * scale[:, np.newaxis] * scale[np.newaxis, :])
+    selection = eigenvalues > rcond * np.max(eigenvalues)
+    logging.info('Removed %d undefined alignment modes', np.count_nonzero(~selection))
+    solution = np.dot(eigenvectors[:, selection], np.dot(eigenvectors[:, selection].T, global_vector * scale) / eigenvalues[selection])
+    return solution * scale
+
+
+@njit(nogil=True)
+def _accumulate_global_alignment(local_hits, offsets, slopes, rotation_matrices, rotation_matrix_derivatives, dut_positions, weights, parameter_index, global_matrix, global_vector, residual_sums, residual_squares, n_residuals):
+    ''' Adds the tracks to the reduced normal equations of the alignment parameters.
+
+    The alignment parameters of each DUT are the translation in x and y and the rotation gamma with the derivative of the rotation matrix
+    given in rotation_matrix_derivatives. Each track is described by its offset and slope in x and y at z = 0. The derivatives of the local intersections with the DUT planes
+    with respect to the track parameters (local) and the alignment parameters (global) are accumulated and the local parameters
+    are eliminated per track: C_global -= H C_local^-1 H^T, b_global -= H C_local^-1 b_local.
+    Only tracks with at least 3 hits and an invertible C_local are used, the terms of a track are added only after the inversion.
+    Returns the chi2 of all tracks and the number of tracks used.
+    '''
+    n_measurements = local_hits.shape[1]
+    n_parameters = 3
+    local_matrix = np.empty((4, 4))
+    local_matrix_inverse = np.empty((4, 4))
+    local_vector = np.empty(4)
+    mixed_matrices = np.empty((n_measurements, n_parameters, 4))  # H per DUT
+    track_global_matrices = np.empty((n_measurements, n_parameters, n_parameters))  # C_global per DUT of one track
+    track_global_vectors = np.empty((n_measurements, n_parameters))  # b_global per DUT of one track
+    track_residuals = np.empty((n_measurements, 2))
+    local_derivatives = np.empty((2, 4))
+    global_derivatives = np.empty((2, n_parameters))
+    temp = np.empty((n_parameters, 4))
+    has_hit = np.empty(n_measurements, dtype=np.bool_)
+    chi2 = 0.
+    n_tracks = 0
+    for i in range(local_hits.shape[0]):
+        if slopes[i, 2] == 0. or not np.isfinite(slopes[i, 2]):
+            continue
+        n_hits = 0
+        for k in range(n_measurements):
+            has_hit[k] = np.isfinite(local_hits[i, k, 0]) and np.isfinite(local_hits[i, k, 1])
+            if has_hit[k]:
+                n_hits += 1
+        if n_hits < 3:
+            continue
+        # Track origin at z = 0 and direction with unit z component
+        d_0, d_1, d_2 = slopes[i, 0] / slopes[i, 2], slopes[i, 1] / slopes[i, 2], 1.
+        o_0, o_1, o_2 = offsets[i, 0] - d_0 * offsets[i, 2], offsets[i, 1] - d_1 * offsets[i, 2], 0.
+
+        local_matrix[:] = 0.
+        local_vector[:] = 0.
+        mixed_matrices[:] = 0.
+        track_global_matrices[:] = 0.
+        track_global_vectors[:] = 0.
+        track_chi2 = 0.
+        for k in range(n_measurements):
+            if not has_hit[k]:
+                continue
+            r = rotation_matrices[k]
+            w_0, w_1, w_2 = o_0 - dut_positions[k, 0], o_1 - dut_positions[k, 1], o_2 - dut_positions[k, 2]
+            n_d = r[0, 2] * d_0 + r[1, 2] * d_1 + r[2, 2] * d_2
+            t = -(r[0, 2] * w_0 + r[1, 2] * w_1 + r[2, 2] * w_2) / n_d
+            u_d = r[0, 0] * d_0 + r[1, 0] * d_1 + r[2, 0] * d_2
+            v_d = r[0, 1] * d_0 + r[1, 1] * d_1 + r[2, 1] * d_2
+            residual_x = local_hits[i, k, 0] - (r[0, 0] * w_0 + r[1, 0] * w_1 + r[2, 0] * w_2 + u_d * t)
+            residual_y = local_hits[i, k, 1] - (r[0, 1] * w_0 + r[1, 1] * w_1 + r[2, 1] * w_2 + v_d * t)
+            weight_x, weight_y = weights[k, 0], weights[k, 1]
+
+            # Derivatives of the local intersection with respect to the track offset and slope in x and y
+            for j in range(2):
+                dt = -r[j, 2] / n_d
+                local_derivatives[0, j] = r[j, 0] + u_d * dt
+                local_derivatives[1, j] = r[j, 1] + v_d * dt
+                dt = -t * r[j, 2] / n_d
+                local_derivatives[0, j + 2] = r[j, 0] * t + u_d * dt
+                local_derivatives[1, j + 2] = r[j, 1] * t + v_d * dt
+            for a in range(4):
+                local_vector[a] += weight_x * local_derivatives[0, a] * residual_x + weight_y * local_derivatives[1, a] * residual_y
+                for b in range(4):
+                    local_matrix[a, b] += weight_x * local_derivatives[0, a] * local_derivatives[0, b] + weight_y * local_derivatives[1, a] * local_derivatives[1, b]
+            track_chi2 += weight_x * residual_x ** 2 + weight_y * residual_y ** 2
+            track_residuals[k, 0] = residual_x
+            track_residuals[k, 1] = residual_y
+
+            if parameter_index[k] < 0:  # DUT is not aligned
+                continue
+            # Derivatives of the local intersection with respect to the DUT position in x and y and the rotation
+            for j in range(2):
+                dt = r[j, 2] / n_d
+                global_derivatives[0, j] = -r[j, 0] + u_d * dt
+                global_derivatives[1, j] = -r[j, 1] + v_d * dt
+            dr = rotation_matrix_derivatives[k]
+            dt = -(dr[0, 2] * w_0 + dr[1, 2] * w_1 + dr[2, 2] * w_2 + t * (dr[0, 2] * d_0 + dr[1, 2] * d_1 + dr[2, 2] * d_2)) / n_d
+            global_derivatives[0, 2] = dr[0, 0] * w_0 + dr[1, 0] * w_1 + dr[2, 0] * w_2 + (dr[0, 0] * d_0 + dr[1, 0] * d_1 + dr[2, 0] * d_2) * t + u_d * dt
+            global_derivatives[1, 2] = dr[0, 1] * w_0 + dr[1, 1] * w_1 + dr[2, 1] * w_2 + (dr[0, 1] * d_0 + dr[1, 1] * d_1 + dr[2, 1] * d_2) * t + v_d * dt
+            for a in range(n_parameters):
+                track_global_vectors[k, a] = weight_x * global_derivatives[0, a] * residual_x + weight_y * global_derivatives[1, a] * residual_y
+                for b in range(n_parameters):
+                    track_global_matrices[k, a, b] = weight_x * global_derivatives[0, a] * global_derivatives[0, b] + weight_y * global_derivatives[1, a] * global_derivatives[1, b]
+                for b in range(4):
+                    mixed_matrices[k, a, b] += weight_x * global_derivatives[0, a] * local_derivatives[0, b] + weight_y * global_derivatives[1, a] * local_derivatives[1, b]
+
+        if not analysis_utils._invert_matrix(local_matrix, local_matrix_inverse):
+            continue
+        chi2 += track_chi2
+        n_tracks += 1
+        for k in range(n_measurements):
+            if not has_hit[k]:
+                continue
+            residual_sums[k, 0] += track_residuals[k, 0]
+            residual_sums[k, 1] += track_residuals[k, 1]
+            residual_squares[k, 0] += track_residuals[k, 0] ** 2
+            residual_squares[k, 1] += track_residuals[k, 1] ** 2
+            n_residuals[k] += 1
+            if parameter_index[k] < 0:
+                continue
+            for a in range(n_parameters):
+                global_vector[parameter_index[k] + a] += track_global_vectors[k, a]
+                for b in range(n_parameters):
+                    global_matrix[parameter_index[k] + a, parameter_index[k] + b] += track_global_matrices[k, a, b]
+
+        # Eliminate the track parameters
+        for k in range(n_measurements):
+            if not has_hit[k] or parameter_index[k] < 0:
+                continue
+            for a in range(n_parameters):  # H_k C^-1
+                for b in range(4):
+                    temp[a, b] = 0.
+                    for c in range(4):
+                        temp[a, b] += mixed_matrices[k, a, c] * local_matrix_inverse[c, b]
+            for a in range(n_parameters):
+                for b in range(4):
+                    global_vector[parameter_index[k] + a] -= temp[a, b] * local_vector[b]
+            for l in range(n_measurements):
+                if not has_hit[l] or parameter_index[l] < 0:
+                    continue
+                for a in range(n_parameters):
+                    for b in range(n_parameters):
+                        value = 0.
+                        for c in range(4):
+                            value += temp[a, c] * mixed_matrices[l, b, c]
+                        global_matrix[parameter_index[k] + a, parameter_index[l] + b] -= value
+    return chi2, n_tracks
+
+
 # Helper functions to be called from multiple processes
-def _correlate_cluster(cluster_dut_0, cluster_file, start_index, start_event_number, stop_event_number, column_correlation, row_correlation, chunk_size):
-    with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open other DUT cluster file
-        for actual_dut_cluster, start_index in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start_index=start_index, start_event_number=start_event_number, stop_event_number=stop_event_number, chunk_size=chunk_size, fail_on_missing_events=False):  # Loop over the cluster in the actual cluster file in chunks
+def _get_event_ranges(cluster_file, n_ranges):
+    ''' Splits the cluster table into about n_ranges event ranges.
+
+    Returns a list of tuples with the start index, the start event number and the stop event number (None for the last range).
+    '''
+    with tb.open_file(cluster_file, mode='r') as in_file_h5:
+        cluster_table = in_file_h5.root.Cluster
+        n_rows = cluster_table.nrows
+        if n_rows == 0:
+            return [(0, None, None)]
+        event_index = analysis_utils.create_event_index(cluster_table)
+        start_indices, start_event_numbers = [], []
+        for range_index in range(n_ranges):
+            event_number = cluster_table.read(start=range_index * n_rows // n_ranges, stop=range_index * n_rows // n_ranges + 1, field='event_number')[0]
+            if start_event_numbers and event_number == start_event_numbers[-1]:  # Event spans several ranges
+                continue
+            start_indices.append(analysis_utils.get_row_of_event(cluster_table, event_number, side='left', event_index=event_index))
+            start_event_numbers.append(event_number)
+    return list(zip(start_indices, start_event_numbers, start_event_numbers[1:] + [None]))
+
+
+def _merge_cluster_data(input_cluster_files, description, n_pixels, pixel_size, start_index_dut_0, start_event_number, start_event_number_other_duts, stop_event_number, chunk_size):
+    ''' Merges the cluster of all DUTs in the DUT0 event range into a temporary file and returns its file name.
+
+    The cluster of the other DUTs are taken from start_event_number_other_duts on up to the last DUT0 event of the range.
+    '''
+    n_duts = len(input_cluster_files)
+    output_file = tempfile.NamedTemporaryFile(delete=False, suffix='.h5')
+    output_file.close()
+    in_files_h5 = []  # One open file per DUT, each cluster table is read exactly once
+    try:
+        for cluster_file in input_cluster_files:
+            in_files_h5.append(tb.open_file(cluster_file, mode='r'))
+        # Cursors over the cluster tables of the other DUTs, the read but not yet merged cluster are buffered
+        cluster_iterators = [None] + [analysis_utils.data_aligned_at_events(in_file_h5.root.Cluster, start_event_number=start_event_number_other_duts, stop_event_number=stop_event_number, chunk_size=chunk_size, fail_on_missing_events=False) for in_file_h5 in in_files_h5[1:]]
+        cluster_buffers = [None] + [in_file_h5.root.Cluster[:0] for in_file_h5 in in_files_h5[1:]]
+
+        # Merge the cluster data from different DUTs into one table
+        with tb.open_file(output_file.name, mode='w') as out_file_h5:
+            merged_cluster_table = out_file_h5.create_table(out_file_h5.root, name='MergedCluster', description=np.zeros((1,), dtype=description).dtype, title='Merged cluster on event number', filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            for actual_cluster_dut_0, _ in analysis_utils.data_aligned_at_events(in_files_h5[0].root.Cluster, start_index=start_index_dut_0, start_event_number=start_event_number, stop_event_number=stop_event_number, chunk_size=chunk_size):  # Loop over the cluster of DUT0 in chunks
+                last_event_number = actual_cluster_dut_0['event_number'][-1]
+
+                # Take the cluster of the other DUTs up to the last event number of the DUT0 chunk, read ahead if needed
+                actual_clusters = [actual_cluster_dut_0]
+                for dut_index in range(1, n_duts):
+                    while cluster_iterators[dut_index] is not None and (cluster_buffers[dut_index].shape[0] == 0 or cluster_buffers[dut_index]['event_number'][-1] <= last_event_number):
+                        try:
+                            actual_cluster, _ = next(cluster_iterators[dut_index])
+                        except StopIteration:
+                            cluster_iterators[dut_index] = None
+                        else:
+                            cluster_buffers[dut_index] = np.concatenate((cluster_buffers[dut_index], actual_cluster))
+                    stop_index = np.searchsorted(cluster_buffers[dut_index]['event_number'], last_event_number, side='right')
+                    actual_clusters.append(cluster_buffers[dut_index][:stop_index])
+                    cluster_buffers[dut_index] = cluster_buffers[dut_index][stop_index:]
+
+                # Calculate the event numbers needed to merge all cluster from all DUTs in one k-way merge and map the cluster of all DUTs to them
+                common_event_numbers = analysis_utils.get_max_events_in_arrays([actual_cluster['event_number'] for actual_cluster in actual_clusters])
+                mapped_clusters = analysis_utils.map_cluster_arrays(common_event_numbers, actual_clusters)
+                merged_cluster_array = np.zeros(shape=(common_event_numbers.shape[0],), dtype=description)  # resulting array to be filled
+                for index in range(n_duts):
+                    # for no hit: column = row = charge = nan
+                    merged_cluster_array['x_dut_%d' % (index)] = np.nan
+                    merged_cluster_array['y_dut_%d' % (index)] = np.nan
+                    merged_cluster_array['z_dut_%d' % (index)] = np.nan
+                    merged_cluster_array['charge_dut_%d' % (index)] = np.nan
+                    merged_cluster_array['xerr_dut_%d' % (index)] = np.nan
+                    merged_cluster_array['yerr_dut_%d' % (index)] = np.nan
+                    merged_cluster_array['zerr_dut_%d' % (index)] = np.nan
 
-            analysis_utils.correlate_cluster_on_event_number(data_1=cluster_dut_0,
-                                                             data_2=actual_dut_cluster,
-                                                             column_corr_hist=column_correlation,
-                                                             row_corr_hist=row_correlation)
+                # Set the event number
+                merged_cluster_array['event_number'] = common_event_numbers[:]
 
-    return start_index, column_correlation, row_correlation
+                # Fill result array with the cluster of all DUTs mapped to the common event number
+                for dut_index, actual_cluster_dut in enumerate(mapped_clusters):
+                    # Select real hits, values with nan are virtual hits
+                    selection = ~np.isnan(actual_cluster_dut['mean_column'])
+                    # Convert indices to positions, origin defined in the center of the sensor
+                    merged_cluster_array['x_dut_%d' % (dut_index)][selection] = pixel_size[dut_index][0] * (actual_cluster_dut['mean_column'][selection] - 0.5 - (0.5 * n_pixels[dut_index][0]))
+                    merged_cluster_array['y_dut_%d' % (dut_index)][selection] = pixel_size[dut_index][1] * (actual_cluster_dut['mean_row'][selection] - 0.5 - (0.5 * n_pixels[dut_index][1]))
+                    merged_cluster_array['z_dut_%d' % (dut_index)][selection] = 0.0
+                    xerr = np.zeros(selection.shape)
+                    yerr = np.zeros(selection.shape)
+                    zerr = np.zeros(selection.shape)
+                    xerr[selection] = actual_cluster_dut['err_column'][selection] * pixel_size[dut_index][0]
+                    yerr[selection] = actual_cluster_dut['err_row'][selection] * pixel_size[dut_index][1]
+                    merged_cluster_array['xerr_dut_%d' % (dut_index)][selection] = xerr[selection]
+                    merged_cluster_array['yerr_dut_%d' % (dut_index)][selection] = yerr[selection]
+                    merged_cluster_array['zerr_dut_%d' % (dut_index)][selection] = zerr[selection]
+                    merged_cluster_array['charge_dut_%d' % (dut_index)][selection] = actual_cluster_dut['charge'][selection]
+                    merged_cluster_array['n_hits_dut_%d' % (dut_index)][selection] = actual_cluster_dut['n_hits'][selection]
+
+                merged_cluster_table.append(merged_cluster_array)
+    finally:
+        for in_file_h5 in in_files_h5:
+            in_file_h5.close()
+    return output_file.name
+
+
+def _correlate_cluster(cluster_file_dut_0, cluster_file, start_index_dut_0, start_event_number, stop_event_number, shape_column, shape_row, column_band_start, row_band_start, chunk_size):
+    ''' Correlates the cluster of one DUT with DUT0 in the event range and returns the correlation histograms and the band overflow '''
+    column_correlation = np.zeros(shape_column, dtype=np.int)
+    row_correlation = np.zeros(shape_row, dtype=np.int)
+    overflow = np.zeros(2, dtype=np.int64)
+    start_index = None
+    with tb.open_file(cluster_file_dut_0, mode='r') as in_file_h5:  # Open DUT0 cluster file
+        with tb.open_file(cluster_file, mode='r') as actual_in_file_h5:  # Open other DUT cluster file
+            for cluster_dut_0, _ in analysis_utils.data_aligned_at_events(in_file_h5.root.Cluster, start_index=start_index_dut_0, start_event_number=start_event_number, stop_event_number=stop_event_number, chunk_size=chunk_size):  # Loop over the cluster of DUT0 in chunks
+                actual_event_numbers = cluster_dut_0['event_number']
+                for actual_dut_cluster, start_index in analysis_utils.data_aligned_at_events(actual_in_file_h5.root.Cluster, start_index=start_index, start_event_number=actual_event_numbers[0], stop_event_number=actual_event_numbers[-1] + 1, chunk_size=chunk_size, fail_on_missing_events=False):  # Loop over the cluster in the actual cluster file in chunks
+
+                    if column_band_start is None:
+                        analysis_utils.correlate_cluster_on_event_number(data_1=cluster_dut_0,
+                                                                         data_2=actual_dut_cluster,
+                                                                         column_corr_hist=column_correlation,
+                                                                         row_corr_hist=row_correlation)
+                    else:
+                        analysis_utils.correlate_cluster_on_event_number_band(data_1=cluster_dut_0,
+                                                                              data_2=actual_dut_cluster,
+                                                                              column_corr_band=column_correlation,
+                                                                              row_corr_band=row_correlation,
+                                                                              column_band_start=column_band_start,
+                                                                              row_band_start=row_band_start,
+                                                                              overflow=overflow)
+
+    return column_correlation, row_correlation, overflow
@@ -73,25 +73,19 @@ def run_analysis(data_files):
     # The following shows a complete test beam analysis by calling the
     # seperate function in correct order
 
-    # Generate noisy pixel mask for all DUTs
-    for i, data_file in enumerate(data_files):
-        hit_analysis.generate_pixel_mask(input_hits_file=data_file,
-                                         n_pixel=n_pixels[i],
-                                         pixel_mask_name='NoisyPixelMask',
-                                         pixel_size=pixel_size[i],
-                                         threshold=0.5,
-                                         dut_name=dut_names[i])
-
-    # Cluster hits from all DUTs
-    for i, data_file in enumerate(data_files):
-        hit_analysis.cluster_hits(input_hits_file=data_file,
-                                  input_noisy_pixel_mask_file=os.path.splitext(data_files[i])[0] + '_noisy_pixel_mask.h5',
-                                  min_hit_charge=0,
-                                  max_hit_charge=1,
-                                  column_cluster_distance=3,
-                                  row_cluster_distance=3,
-                                  frame_cluster_distance=1,
-                                  dut_name=dut_names[i])
+    # Generate noisy pixel mask and cluster hits for all DUTs in parallel
+    hit_analysis.process_hit_files(input_hits_files=data_files,
+                                   mask_kwargs=[{'n_pixel': n_pixels[i],
+                                                 'pixel_mask_name': 'NoisyPixelMask',
+                                                 'pixel_size': pixel_size[i],
+                                                 'threshold': 0.5,
+                                                 'dut_name': dut_names[i]} for i in range(len(data_files))],
+                                   cluster_kwargs=[{'min_hit_charge': 0,
+                                                    'max_hit_charge': 1,
+                                                    'column_cluster_distance': 3,
+                                                    'row_cluster_distance': 3,
+                                                    'frame_cluster_distance': 1,
+                                                    'dut_name': dut_names[i]} for i in range(len(data_files))])
 
     # Generate filenames for cluster data
     input_cluster_files = [os.path.splitext(data_file)[0] + '_clustered.h5'
@@ -122,26 +122,19 @@ def run_analysis(n_events):
         n_pixels=sim.dut_n_pixel,
         pixel_size=sim.dut_pixel_size)
 
-    dut_alignment.apply_alignment(
-        input_hit_file=os.path.join(output_folder, 'Merged.h5'),
-        input_alignment_file=os.path.join(output_folder, 'Alignment.h5'),
-        output_hit_file=os.path.join(output_folder,
-                                             'Tracklets_prealigned.h5'),
-        # If there is already an alignment info in the alignment file this has
-        # to be set
-        force_prealignment=True)
-
     # Find tracks from the tracklets and stores the with quality indicator
     # into track candidates table
     track_analysis.find_tracks(
-        input_tracklets_file=os.path.join(
-            output_folder, 'Tracklets_prealigned.h5'),
+        input_tracklets_file=os.path.join(output_folder, 'Merged.h5'),
         input_alignment_file=os.path.join(output_folder, 'Alignment.h5'),
         output_track_candidates_file=os.path.join(
             output_folder, 'TrackCandidates_prealigned.h5'),
+        min_cluster_distance=False,
+        # Apply the pre-alignment to the merged cluster when reading
+        align_hits=True,
         # If there is already an alignment info in the alignment file this has
-        # to be set)
-        min_cluster_distance=False)
+        # to be set
+        force_prealignment=True)
 
     # Fit the track candidates and create new track table
     track_analysis.fit_tracks(
@@ -46,29 +46,23 @@ def run_analysis():
 
     # The following shows a complete test beam analysis by calling the seperate function in correct order
 
-    # Generate noisy pixel mask for all DUTs
+    # Generate noisy pixel mask and cluster hits for all DUTs in parallel
     threshold = [2, 2, 2, 10, 10, 2, 2, 2]
-    for i, data_file in enumerate(data_files):
-        hit_analysis.generate_pixel_mask(input_hits_file=data_file,
-                                         n_pixel=n_pixels[i],
-                                         pixel_mask_name='NoisyPixelMask',
-                                         pixel_size=pixel_size[i],
-                                         threshold=threshold[i],
-                                         dut_name=dut_names[i])
-
-    # Cluster hits from all DUTs
     column_cluster_distance = [3, 3, 3, 2, 2, 3, 3, 3]
     row_cluster_distance = [3, 3, 3, 3, 3, 3, 3, 3]
     frame_cluster_distance = [0, 0, 0, 0, 0, 0, 0, 0]
-    for i, data_file in enumerate(data_files):
-        hit_analysis.cluster_hits(input_hits_file=data_file,
-                                  input_noisy_pixel_mask_file=os.path.splitext(data_files[i])[0] + '_noisy_pixel_mask.h5',
-                                  min_hit_charge=0,
-                                  max_hit_charge=13,
-                                  column_cluster_distance=column_cluster_distance[i],
-                                  row_cluster_distance=row_cluster_distance[i],
-                                  frame_cluster_distance=frame_cluster_distance[i],
-                                  dut_name=dut_names[i])
+    hit_analysis.process_hit_files(input_hits_files=data_files,
+                                   mask_kwargs=[{'n_pixel': n_pixels[i],
+                                                 'pixel_mask_name': 'NoisyPixelMask',
+                                                 'pixel_size': pixel_size[i],
+                                                 'threshold': threshold[i],
+                                                 'dut_name': dut_names[i]} for i in range(len(data_files))],
+                                   cluster_kwargs=[{'min_hit_charge': 0,
+                                                    'max_hit_charge': 13,
+                                                    'column_cluster_distance': column_cluster_distance[i],
+                                                    'row_cluster_distance': row_cluster_distance[i],
+                                                    'frame_cluster_distance': frame_cluster_distance[i],
+                                                    'dut_name': dut_names[i]} for i in range(len(data_files))])
 
     # Generate filenames for cluster data
     input_cluster_files = [os.path.splitext(data_file)[0] + '_clustered.h5'
@@ -4,6 +4,7 @@ from __future__ import division
 import logging
 import os.path
 import re
+from multiprocessing import cpu_count
 
 import tables as tb
 import numpy as np
@@ -122,7 +123,7 @@ def check_file(input_hits_file, n_pixel, output_check_file=None,
         plot_utils.plot_checks(input_corr_file=output_check_file)
 
 
-def generate_pixel_mask(input_hits_file, n_pixel, pixel_mask_name="NoisyPixelMask", output_mask_file=None, pixel_size=None, threshold=10.0, filter_size=3, dut_name=None, plot=True, chunk_size=10000000):
+def generate_pixel_mask(input_hits_file, n_pixel, pixel_mask_name="NoisyPixelMask", output_mask_file=None, pixel_size=None, threshold=10.0, filter_size=3, dut_name=None, plot=True, n_cores=None, chunk_size=10000000):
     '''Generating pixel mask from the hit table.
 
     Parameters
@@ -149,6 +150,8 @@ def generate_pixel_mask(input_hits_file, n_pixel, pixel_mask_name="NoisyPixelMas
         Name of the DUT. If None, file name of the hit table will be printed.
     plot : bool
         If True, create additional output plots.
+    n_cores : int
+        Number of cores to use. If None, all cores are used for large files.
     chunk_size : int
         Chunk size of the data when reading from file.
     '''
@@ -165,7 +168,8 @@ def generate_pixel_mask(input_hits_file, n_pixel, pixel_mask_name="NoisyPixelMas
     smc.SMC(table_file_in=input_hits_file,
             file_out=output_mask_file,
             func=work,
-            node_desc={'name': 'HistOcc'},
+            node_desc={'name': 'HistOcc', 'shape': n_pixel},
+            n_cores=n_cores,
             chunk_size=chunk_size)
 
     # Create mask from occupancy histogram
@@ -192,7 +196,7 @@ def generate_pixel_mask(input_hits_file, n_pixel, pixel_mask_name="NoisyPixelMas
     return output_mask_file
 
 
-def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel_mask_file=None, input_noisy_pixel_mask_file=None, min_hit_charge=0, max_hit_charge=None, column_cluster_distance=1, row_cluster_distance=1, frame_cluster_distance=1, dut_name=None, plot=True, chunk_size=1000000):
+def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel_mask_file=None, input_noisy_pixel_mask_file=None, min_hit_charge=0, max_hit_charge=None, column_cluster_distance=1, row_cluster_distance=1, frame_cluster_distance=1, dut_name=None, plot=True, n_cores=None, chunk_size=1000000):
     '''Clusters the hits in the data file containing the hit table.
 
     Parameters
@@ -219,6 +223,8 @@ def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel
         Name of the DUT. If None, filename of the output cluster file will be used.
     plot : bool
         If True, create additional output plots.
+    n_cores : int
+        Number of cores to use. If None, all cores are used for large files.
     chunk_size : int
         Chunk size of the data when reading from file.
     '''
@@ -288,34 +294,12 @@ def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel
                                  disabled_pixels=disabled_pixels)
         return cl
 
-    smc.SMC(table_file_in=input_hits_file,
-            file_out=output_cluster_file,
-            func=cluster_func,
-            func_kwargs={'clz': clz,
-                         'calc_cluster_dimensions': calc_cluster_dimensions},
-            node_desc={'name': 'Cluster'},
-            align_at='event_number',
-            chunk_size=chunk_size)
-
-    # Calculate cluster size histogram
+    # Calculate cluster size histogram from the clusters in memory
     def hist_func(cluster):
         n_hits = cluster['n_hits']
         hist = analysis_utils.hist_1d_index(n_hits,
-                                            shape=(np.max(n_hits) + 1,))
-        return hist
-
-    smc.SMC(table_file_in=output_cluster_file,
-            file_out=output_cluster_file[:-3] + '_hist.h5',
-            func=hist_func,
-            node_desc={'name': 'HistClusterSize'},
-            chunk_size=chunk_size)
-
-    # Load infos from cluster size for error determination and plotting
-    with tb.open_file(output_cluster_file[:-3] + '_hist.h5', 'r') as input_file_h5:
-        hight = input_file_h5.root.HistClusterSize[:]
-        n_clusters = hight.sum()
-        n_hits = (hight * np.arange(0, hight.shape[0])).sum()
-        max_cluster_size = hight.shape[0] - 1
+                                            shape=(np.max(n_hits) + 1 if n_hits.shape[0] else 1,))
+        return {'Cluster': cluster, 'HistClusterSize': hist}
 
     # Calculate position error from cluster size
     def get_eff_pitch(hist, cluster_size):
@@ -327,9 +311,9 @@ def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel
         cluster_size : Cluster size to calculate the pitch for
         '''
 
-        return np.sqrt(hight[int(cluster_size)].astype(np.float) / hight.sum())
+        return np.sqrt(hist[int(cluster_size)].astype(np.float) / hist.sum())
 
-    def pos_error_func(clusters):
+    def pos_error_func(clusters, hight):
         # Check if end_of_cluster function was called
         # Under unknown and rare circumstances this might not be the case
         if not np.any(clusters['err_cols']):
@@ -351,11 +335,34 @@ def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel
 
         return clusters
 
-    smc.SMC(table_file_in=output_cluster_file,
+    # One pass over the hits for clusters and cluster size histogram
+    smc.SMC(table_file_in=input_hits_file,
             file_out=output_cluster_file,
-            func=pos_error_func,
+            func=[cluster_func, hist_func],
+            func_kwargs=[{'clz': clz,
+                          'calc_cluster_dimensions': calc_cluster_dimensions},
+                         {}],
+            node_desc={'name': 'Cluster'},
+            align_at='event_number',
+            n_cores=n_cores,
             chunk_size=chunk_size)
 
+    # The position errors need the full cluster size histogram, only the
+    # error columns are updated in place
+    with tb.open_file(output_cluster_file, 'r+') as output_file_h5:
+        hist_cluster_size = output_file_h5.root.HistClusterSize[:]
+        cluster_table = output_file_h5.root.Cluster
+        for start_index in range(0, cluster_table.nrows, chunk_size):
+            stop_index = min(start_index + chunk_size, cluster_table.nrows)
+            clusters = pos_error_func(cluster_table.read(start=start_index, stop=stop_index), hight=hist_cluster_size)
+            cluster_table.modify_columns(start=start_index, stop=stop_index, columns=[clusters['err_cols'], clusters['err_rows']], names=['err_cols', 'err_rows'])
+
+    # Move cluster size histogram to separate file
+    with tb.open_file(output_cluster_file, 'r+') as output_file_h5:
+        with tb.open_file(output_cluster_file[:-3] + '_hist.h5', 'w') as output_hist_file_h5:
+            output_file_h5.root.HistClusterSize._f_copy(newparent=output_hist_file_h5.root)
+        output_file_h5.root.HistClusterSize._f_remove()
+
     # Copy masks to result cluster file
     with tb.open_file(output_cluster_file, 'r+') as output_file_h5:
         # Copy nodes to result file
@@ -374,5 +381,94 @@ def cluster_hits(input_hits_file, output_cluster_file=None, input_disabled_pixel
     return output_cluster_file
 
 
+def process_hit_files(input_hits_files, mask_kwargs=None, cluster_kwargs=None, n_cores=None):
+    '''Generates the pixel masks and clusters the hits of several DUTs in parallel.
+
+    The cores are shared among the DUTs in proportion to the file size. Files with a share of
+    at least two cores are split into tasks by SMC, one file after another. The smaller files
+    run on one core each. All tasks run on one shared pool of worker processes, thus the cores
+    of finished small files are used by the tasks of the large files.
+
+    Parameters
+    ----------
+    input_hits_files : iterable
+        Filenames of the input hits files.
+    mask_kwargs : dict, iterable of dicts
+        Parameters of generate_pixel_mask() without the input hits file. An iterable of dicts gives the parameters for each DUT.
+        The generated mask is used for the clustering. If None, no pixel mask is generated.
+    cluster_kwargs : dict, iterable of dicts
+        Parameters of cluster_hits() without the input hits file and the mask file. An iterable of dicts gives the parameters for each DUT.
+    n_cores : int
+        Number of cores to use. If None, all available cores are used.
+
+    Returns
+    -------
+    List of the output cluster files.
+
+    Example
+    -------
+    process_hit_files(input_hits_files=data_files,
+                      mask_kwargs=[{'n_pixel': n_pixels[i], 'threshold': 0.5} for i in range(len(data_files))],
+                      cluster_kwargs={'column_cluster_distance': 3, 'row_cluster_distance': 3})
+    '''
+    logging.info('=== Processing hits of %d DUTs ===', len(input_hits_files))
+
+    def get_kwargs(kwargs):
+        if kwargs is None or isinstance(kwargs, dict):
+            return [kwargs] * len(input_hits_files)
+        kwargs = list(kwargs)
+        if len(kwargs) != len(input_hits_files):
+            raise ValueError('Number of parameter sets does not match the number of hit files')
+        return kwargs
+
+    mask_kwargs = get_kwargs(mask_kwargs)
+    cluster_kwargs = get_kwargs({} if cluster_kwargs is None else cluster_kwargs)
+
+    if not n_cores:
+        n_cores = cpu_count()
+
+    file_sizes = [os.path.getsize(input_hits_file) for input_hits_file in input_hits_files]
+    # Largest files first, the remaining files fill the idle cores
+    indices = sorted(range(len(input_hits_files)), key=lambda i: file_sizes[i], reverse=True)
+    # Files with a share of at least two cores are split into tasks
+    split_indices = [index for index in indices if file_sizes[index] * n_cores >= 2 * sum(file_sizes)]
+
+    pool = smc.get_pool(n_cores)
+    jobs = {}
+    for index in indices:
+        if index not in split_indices:
+            jobs[index] = smc.apply_async(pool=pool,
+                                          fun=_process_hit_file,
+                                          input_hits_file=input_hits_files[index],
+                                          mask_kwargs=mask_kwargs[index],
+                                          cluster_kwargs=cluster_kwargs[index],
+                                          n_cores=1)
+
+    # The tasks of the large files run on the same pool, the cores not used by the small files run them
+    output_cluster_files = {}
+    for index in split_indices:
+        output_cluster_files[index] = _process_hit_file(input_hits_file=input_hits_files[index],
+                                                        mask_kwargs=mask_kwargs[index],
+                                                        cluster_kwargs=cluster_kwargs[index],
+                                                        n_cores=n_cores)
+
+    for index, job in jobs.items():
+        output_cluster_files[index] = job.get()
+
+    return [output_cluster_files[index] for index in range(len(input_hits_files))]
+
+
+def _process_hit_file(input_hits_file, mask_kwargs, cluster_kwargs, n_cores):
+    ''' Mask generation and clustering of one DUT, called by process_hit_files() '''
+    cluster_kwargs = dict(cluster_kwargs)
+    if mask_kwargs is not None:
+        output_mask_file = generate_pixel_mask(input_hits_file=input_hits_file, n_cores=n_cores, **mask_kwargs)
+        if mask_kwargs.get('pixel_mask_name', 'NoisyPixelMask') == 'DisabledPixelMask':
+            cluster_kwargs['input_disabled_pixel_mask_file'] = output_mask_file
+        else:
+            cluster_kwargs['input_noisy_pixel_mask_file'] = output_mask_file
+    return cluster_hits(input_hits_file=input_hits_file, n_cores=n_cores, **cluster_kwargs)
+
+
 if __name__ == '__main__':
     pass
@@ -71,6 +71,12 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
             alignment = in_file_h5.root.Alignment[:]
             n_duts = alignment.shape[0]
 
+    # Transformation matrices of all DUTs are calculated once
+    if use_prealignment:
+        transformer = geometry_utils.AlignmentTransformer(prealignment=prealignment)
+    else:
+        transformer = geometry_utils.AlignmentTransformer(alignment=alignment)
+
     if output_residuals_file is None:
         output_residuals_file = os.path.splitext(input_tracks_file)[0] + '_residuals.h5'
 
@@ -93,7 +99,7 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                 logging.debug('Calculate residuals for DUT%d', actual_dut)
 
                 initialize = True  # initialize the histograms
-                for tracks_chunk, _ in analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size):
+                for tracks_chunk, _ in analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size, prefetch=1):
                     # select good hits and tracks
                     selection = np.logical_and(~np.isnan(tracks_chunk['x_dut_%d' % actual_dut]), ~np.isnan(tracks_chunk['track_chi2']))
                     tracks_chunk = tracks_chunk[selection]  # Take only tracks where actual dut has a hit, otherwise residual wrong
@@ -107,24 +113,12 @@ def calculate_residuals(input_tracks_file, input_alignment_file, n_pixels, pixel
                     intersection_x, intersection_y, intersection_z = tracks_chunk['offset_0'], tracks_chunk['offset_1'], tracks_chunk['offset_2']
 
                     # Transform to local coordinate system
-                    if use_prealignment:
-                        hit_x_local, hit_y_local, hit_z_local = geometry_utils.apply_alignment(hit_x, hit_y, hit_z,
-                                                                                               dut_index=actual_dut,
-                                                                                               prealignment=prealignment,
-                                                                                               inverse=True)
-                        intersection_x_local, intersection_y_local, intersection_z_local = geometry_utils.apply_alignment(intersection_x, intersection_y, intersection_z,
-                                                                                                                          dut_index=actual_dut,
-                                                                                                                          prealignment=prealignment,
-                                                                                                                          inverse=True)
-                    else:  # Apply transformation from fine alignment information
-                        hit_x_local, hit_y_local, hit_z_local = geometry_utils.apply_alignment(hit_x, hit_y, hit_z,
-                                                                                               dut_index=actual_dut,
-                                                                                               alignment=alignment,
-                                                                                               inverse=True)
-                        intersection_x_local, intersection_y_local, intersection_z_local = geometry_utils.apply_alignment(intersection_x, intersection_y, intersection_z,
-                                                                                                                          dut_index=actual_dut,
-                                                                                                                          alignment=alignment,
-                                                                                                                          inverse=True)
+                    hit_x_local, hit_y_local, hit_z_local = transformer.transform(hit_x, hit_y, hit_z,
+                                                                                  dut_index=actual_dut,
+                                                                                  inverse=True)
+                    intersection_x_local, intersection_y_local, intersection_z_local = transformer.transform(intersection_x, intersection_y, intersection_z,
+                                                                                                             dut_index=actual_dut,
+                                                                                                             inverse=True)
 
                     if not np.allclose(hit_z_local, 0.0) or not np.allclose(intersection_z_local, 0.0):
                         logging.error('Hit z position = %s and z intersection %s', str(hit_z_local[:3]), str(intersection_z_local[:3]))
@@ -726,6 +720,12 @@ def calculate_efficiency(input_tracks_file, input_alignment_file, bin_size, sens
             alignment = in_file_h5.root.Alignment[:]
             n_duts = alignment.shape[0]
 
+    # Transformation matrices of all DUTs are calculated once
+    if use_prealignment:
+        transformer = geometry_utils.AlignmentTransformer(prealignment=prealignment)
+    else:
+        transformer = geometry_utils.AlignmentTransformer(alignment=alignment)
+
     use_duts = use_duts if use_duts is not None else range(n_duts)  # standard setting: fit tracks for all DUTs
 
     if not isinstance(max_chi2, Iterable):
@@ -770,7 +770,7 @@ def calculate_efficiency(input_tracks_file, input_alignment_file, bin_size, sens
 
                 actual_max_chi2 = max_chi2[dut_index]
 
-                for tracks_chunk, _ in analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size):
+                for tracks_chunk, _ in analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size, prefetch=1):
                     # Cut in Chi 2 of the track fit
                     if actual_max_chi2:
                         tracks_chunk = tracks_chunk[tracks_chunk['track_chi2'] <= max_chi2]
@@ -781,24 +781,12 @@ def calculate_efficiency(input_tracks_file, input_alignment_file, bin_size, sens
                     intersection_x, intersection_y, intersection_z = tracks_chunk['offset_0'], tracks_chunk['offset_1'], tracks_chunk['offset_2']
 
                     # Transform to local coordinate system
-                    if use_prealignment:
-                        hit_x_local, hit_y_local, hit_z_local = geometry_utils.apply_alignment(hit_x, hit_y, hit_z,
-                                                                                               dut_index=actual_dut,
-                                                                                               prealignment=prealignment,
-                                                                                               inverse=True)
-                        intersection_x_local, intersection_y_local, intersection_z_local = geometry_utils.apply_alignment(intersection_x, intersection_y, intersection_z,
-                                                                                                                          dut_index=actual_dut,
-                                                                                                                          prealignment=prealignment,
-                                                                                                                          inverse=True)
-                    else:  # Apply transformation from alignment information
-                        hit_x_local, hit_y_local, hit_z_local = geometry_utils.apply_alignment(hit_x, hit_y, hit_z,
-                                                                                               dut_index=actual_dut,
-                                                                                               alignment=alignment,
-                                                                                               inverse=True)
-                        intersection_x_local, intersection_y_local, intersection_z_local = geometry_utils.apply_alignment(intersection_x, intersection_y, intersection_z,
-                                                                                                                          dut_index=actual_dut,
-                                                                                                                          alignment=alignment,
-                                                                                                                          inverse=True)
+                    hit_x_local, hit_y_local, hit_z_local = transformer.transform(hit_x, hit_y, hit_z,
+                                                                                  dut_index=actual_dut,
+                                                                                  inverse=True)
+                    intersection_x_local, intersection_y_local, intersection_z_local = transformer.transform(intersection_x, intersection_y, intersection_z,
+                                                                                                             dut_index=actual_dut,
+                                                                                                             inverse=True)
 
                     # Quickfix that center of sensor is local system is in the center and not at the edge
                     hit_x_local, hit_y_local = hit_x_local + pixel_size[actual_dut][0] / 2. * n_pixels[actual_dut][0], hit_y_local + pixel_size[actual_dut][1] / 2. * n_pixels[actual_dut][1]
@@ -975,6 +963,12 @@ def calculate_purity(input_tracks_file, input_alignment_file, bin_size, sensor_s
                 use_prealignment = True
                 logging.info('Use prealignment data')
 
+    # Transformation matrices of all DUTs are calculated once
+    if use_prealignment:
+        transformer = geometry_utils.AlignmentTransformer(prealignment=prealignment)
+    else:
+        transformer = geometry_utils.AlignmentTransformer(alignment=alignment)
+
     if not isinstance(max_chi2, Iterable):
         max_chi2 = [max_chi2] * n_duts
 
@@ -1011,7 +1005,7 @@ def calculate_purity(input_tracks_file, input_alignment_file, bin_size, sensor_s
 
                 actual_max_chi2 = max_chi2[index]
 
-                for tracks_chunk, _ in analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size):
+                for tracks_chunk, _ in analysis_utils.data_aligned_at_events(node, chunk_size=chunk_size, prefetch=1):
                     # Take only tracks where actual dut has a hit, otherwise residual wrong
                     selection = np.logical_and(~np.isnan(tracks_chunk['x_dut_%d' % actual_dut]), ~np.isnan(tracks_chunk['track_chi2']))
                     selection_hit = ~np.isnan(tracks_chunk['x_dut_%d' % actual_dut])
@@ -1026,32 +1020,15 @@ def calculate_purity(input_tracks_file, input_alignment_file, bin_size, sensor_s
                     intersection_x, intersection_y, intersection_z = tracks_chunk['offset_0'][selection], tracks_chunk['offset_1'][selection], tracks_chunk['offset_2'][selection]
 
                     # Transform to local coordinate system
-                    if use_prealignment:
-                        hit_x_local_dut, hit_y_local_dut, hit_z_local_dut = geometry_utils.apply_alignment(hit_x_dut, hit_y_dut, hit_z_dut,
-                                                                                                           dut_index=actual_dut,
-                                                                                                           prealignment=prealignment,
-                                                                                                           inverse=True)
-                        hit_x_local, hit_y_local, hit_z_local = geometry_utils.apply_alignment(hit_x, hit_y, hit_z,
-                                                                                               dut_index=actual_dut,
-                                                                                               prealignment=prealignment,
-                                                                                               inverse=True)
-                        intersection_x_local, intersection_y_local, intersection_z_local = geometry_utils.apply_alignment(intersection_x, intersection_y, intersection_z,
-                                                                                                                          dut_index=actual_dut,
-                                                                                                                          prealignment=prealignment,
-                                                                                                                          inverse=True)
-                    else:  # Apply transformation from alignment information
-                        hit_x_local_dut, hit_y_local_dut, hit_z_local_dut = geometry_utils.apply_alignment(hit_x_dut, hit_y_dut, hit_z_dut,
-                                                                                                           dut_index=actual_dut,
-                                                                                                           alignment=alignment,
-                                                                                                           inverse=True)
-                        hit_x_local, hit_y_local, hit_z_local = geometry_utils.apply_alignment(hit_x, hit_y, hit_z,
-                                                                                               dut_index=actual_dut,
-                                                                                               alignment=alignment,
-                                                                                               inverse=True)
-                        intersection_x_local, intersection_y_local, intersection_z_local = geometry_utils.apply_alignment(intersection_x, intersection_y, intersection_z,
-                                                                                                                          dut_index=actual_dut,
-                                                                                                                          alignment=alignment,
-                                                                                                                          inverse=True)
+                    hit_x_local_dut, hit_y_local_dut, hit_z_local_dut = transformer.transform(hit_x_dut, hit_y_dut, hit_z_dut,
+                                                                                              dut_index=actual_dut,
+                                                                                              inverse=True)
+                    hit_x_local, hit_y_local, hit_z_local = transformer.transform(hit_x, hit_y, hit_z,
+                                                                                  dut_index=actual_dut,
+                                                                                  inverse=True)
+                    intersection_x_local, intersection_y_local, intersection_z_local = transformer.transform(intersection_x, intersection_y, intersection_z,
+                                                                                                             dut_index=actual_dut,
+                                                                                                             inverse=True)
                     # Quickfix that center of sensor is local system is in the center and not at the edge
                     hit_x_local_dut, hit_y_local_dut = hit_x_local_dut + pixel_size[actual_dut][0] / 2. * n_pixels[actual_dut][0], hit_y_local_dut + pixel_size[actual_dut][1] / 2. * n_pixels[actual_dut][1]
                     hit_x_local, hit_y_local = hit_x_local + pixel_size[actual_dut][0] / 2. * n_pixels[actual_dut][0], hit_y_local + pixel_size[actual_dut][1] / 2. * n_pixels[actual_dut][1]
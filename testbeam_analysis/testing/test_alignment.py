@@ -2,9 +2,12 @@
 '''
 import os
 import shutil
+import tempfile
 import unittest
 
+import mock
 import numpy as np
+import tables as tb
 
 from testbeam_analysis import dut_alignment
 from testbeam_analysis.tools import test_tools
@@ -188,6 +191,101 @@ class TestAlignmentAnalysis(unittest.TestCase):
                                                             atol=5)  # 0.0001 absolute tolerance allowed
         self.assertTrue(data_equal, msg=error_msg)
 
+        # Test 2: Start from the alignment result, the alignment is only verified and has to stay the same
+        shutil.copyfile(analysis_utils.get_data('fixtures/dut_alignment/Alignment.h5',
+                                                output=os.path.join(testing_path,
+                                                                    'fixtures/dut_alignment/Alignment.h5')),
+                        os.path.join(self.output_folder, 'Alignment_warm_start.h5'))
+        dut_alignment.alignment(input_track_candidates_file=analysis_utils.get_data('fixtures/dut_alignment/TrackCandidates_prealigned.h5',
+                                                                                    output=os.path.join(testing_path,
+                                                                                                        'fixtures/dut_alignment/TrackCandidates_prealigned.h5')),
+                                input_alignment_file=os.path.join(self.output_folder, 'Alignment_warm_start.h5'),
+                                n_pixels=[(1152, 576)] * 6,
+                                pixel_size=[(18.4, 18.4)] * 6,
+                                initial_alignment_file=analysis_utils.get_data('fixtures/dut_alignment/Alignment_result.h5',
+                                                                               output=os.path.join(testing_path,
+                                                                                                   'fixtures/dut_alignment/Alignment_result.h5')))
+        data_equal, error_msg = test_tools.compare_h5_files(os.path.join(self.output_folder, 'Alignment_warm_start.h5'),
+                                                            analysis_utils.get_data('fixtures/dut_alignment/Alignment_result.h5',
+                                                                                    output=os.path.join(testing_path,
+                                                                                                        'fixtures/dut_alignment/Alignment_result.h5')),
+                                                            exact=False,
+                                                            rtol=0.01,  # 1 % error allowed
+                                                            atol=5)  # 0.0001 absolute tolerance allowed
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_correlation_fit(self):  # Check the fit of the correlation peaks on fake data with known peak positions
+        np.random.seed(0)
+        n_pixel_dut, n_pixel_ref = 100, 120
+        x_ref = np.arange(n_pixel_ref, dtype=np.float) + 0.5
+        mu = 5.2 + 1.1 * (np.arange(n_pixel_dut) + 0.5)  # Correlation line
+        data = np.random.poisson(2.0 + 20.0 * np.exp(-0.5 * ((x_ref - 60.0) / 30.0) ** 2), size=(n_pixel_dut, n_pixel_ref))  # Uncorrelated background halo
+        data += np.random.poisson(300.0 * np.exp(-0.5 * ((x_ref[np.newaxis, :] - mu[:, np.newaxis]) / 1.5) ** 2))
+        data[10] = 0  # No correlation
+        for fit_background in (False, True):
+            coeff_fitted = [None] * n_pixel_dut
+            mean_fitted, mean_error_fitted, sigma_fitted, chi2 = [np.full(shape=(n_pixel_dut,), fill_value=np.nan) for _ in range(4)]
+            dut_alignment._fit_data(x=x_ref, data=data, s_n=0.1, coeff_fitted=coeff_fitted, mean_fitted=mean_fitted, mean_error_fitted=mean_error_fitted, sigma_fitted=sigma_fitted, chi2=chi2, fit_background=fit_background)
+            self.assertTrue(np.isnan(mean_fitted[10]))
+            selection = np.logical_and(~np.isnan(mean_fitted), mu < n_pixel_ref - 5)  # Peak inside the reference DUT
+            self.assertGreater(np.count_nonzero(selection), 80)
+            self.assertTrue(np.allclose(mean_fitted[selection], mu[selection], atol=0.2))
+            self.assertTrue(np.allclose(sigma_fitted[selection], 1.5, atol=0.3))
+
+            # No correlation at all (e.g. dead or fully masked DUT)
+            mean_fitted[:] = np.nan
+            dut_alignment._fit_data(x=x_ref, data=np.zeros_like(data), s_n=0.1, coeff_fitted=coeff_fitted, mean_fitted=mean_fitted, mean_error_fitted=mean_error_fitted, sigma_fitted=sigma_fitted, chi2=chi2, fit_background=fit_background)
+            self.assertTrue(np.all(np.isnan(mean_fitted)))
+
+    def test_global_alignment(self):  # Create fake tracks with a known misalignment and reconstruct it with one solution of the global alignment normal equations
+        np.random.seed(0)
+        n_tracks, n_duts = 20000, 6
+        z_positions = np.linspace(0., 50000., n_duts)
+        translations = np.column_stack((np.random.normal(0., 20., n_duts), np.random.normal(0., 20., n_duts)))
+        gammas = np.random.normal(0., 0.002, n_duts)
+        pixel_size = (18.4, 18.4)
+
+        # Hits in the local coordinate system of the misaligned planes
+        offsets = np.column_stack((np.random.uniform(-5000., 5000., n_tracks), np.random.uniform(-5000., 5000., n_tracks), np.zeros(n_tracks)))
+        slopes = np.column_stack((np.random.normal(0., 0.001, n_tracks), np.random.normal(0., 0.001, n_tracks), np.ones(n_tracks)))
+        local_hits = np.empty((n_tracks, n_duts, 2))
+        for dut_index in range(n_duts):
+            intersections = offsets + slopes * z_positions[dut_index]
+            rotation_matrix = geometry_utils.rotation_matrix(alpha=0., beta=0., gamma=gammas[dut_index])
+            local_hits[:, dut_index] = np.dot(intersections - np.append(translations[dut_index], z_positions[dut_index]), rotation_matrix)[:, :2]
+        local_hits += np.random.normal(0., pixel_size[0] / np.sqrt(12.), local_hits.shape)
+        local_hits[::10, 2] = np.nan  # Missing hits
+
+        # Nominal geometry as start values
+        rotation_matrices = np.array([np.eye(3)] * n_duts)
+        rotation_matrix_derivatives = np.array([dut_alignment._get_rotation_matrix_derivatives(alpha=0., beta=0., gamma=0.)[2]] * n_duts)
+        dut_positions = np.column_stack((np.zeros(n_duts), np.zeros(n_duts), z_positions))
+        weights = np.full((n_duts, 2), 12. / pixel_size[0] ** 2)
+        parameter_index = np.arange(n_duts) * 3
+        global_matrix, global_vector = np.zeros((3 * n_duts, 3 * n_duts)), np.zeros(3 * n_duts)
+        residual_sums, residual_squares, n_residuals = np.zeros((n_duts, 2)), np.zeros((n_duts, 2)), np.zeros(n_duts, dtype=np.int)
+        chi2, n_tracks_used = dut_alignment._accumulate_global_alignment(local_hits, offsets, slopes / np.sqrt(np.sum(np.square(slopes), axis=1))[:, np.newaxis],
+                                                                          rotation_matrices, rotation_matrix_derivatives, dut_positions, weights, parameter_index,
+                                                                          global_matrix, global_vector, residual_sums, residual_squares, n_residuals)
+        self.assertEqual(n_tracks_used, n_tracks)
+        self.assertTrue(np.all(n_residuals == [n_tracks, n_tracks, n_tracks - n_tracks // 10, n_tracks, n_tracks, n_tracks]))
+        parameters = dut_alignment._solve_global_alignment(global_matrix, global_vector).reshape(n_duts, 3)
+
+        # The alignment is only defined up to a shift, shear, rotation and twist of all planes, thus compare the difference to a linear function in z
+        for index, expected in enumerate((translations[:, 0], translations[:, 1], gammas)):
+            difference = parameters[:, index] - expected
+            difference -= np.polyval(np.polyfit(z_positions, difference, 1), z_positions)
+            self.assertTrue(np.allclose(difference, 0., atol=(0.2, 0.2, 2e-5)[index]))
+
+        # Tracks with undefined track parameters (all planes at the same z) must not change the normal equations
+        global_matrix[:], global_vector[:], residual_sums[:], residual_squares[:], n_residuals[:] = 0., 0., 0., 0., 0
+        chi2, n_tracks_used = dut_alignment._accumulate_global_alignment(local_hits[:100, :3], offsets[:100], slopes[:100] / np.sqrt(np.sum(np.square(slopes[:100]), axis=1))[:, np.newaxis],
+                                                                          rotation_matrices[:3], rotation_matrix_derivatives[:3], np.zeros((3, 3)), weights[:3], parameter_index[:3],
+                                                                          global_matrix, global_vector, residual_sums, residual_squares, n_residuals)
+        self.assertEqual(n_tracks_used, 0)
+        self.assertEqual(chi2, 0.)
+        self.assertTrue(np.all(global_matrix == 0.) and np.all(global_vector == 0.) and np.all(n_residuals == 0))
+
     # FIXME: fails under Linux
     @unittest.SkipTest
     def test_rotation_reconstruction(self):  # Create fake data with known angles and reconstruct the angles from the residuals and check for similarity. Does only work for the abolute annge not with sign.
@@ -288,6 +386,50 @@ class TestAlignmentAnalysis(unittest.TestCase):
                     self.assertTrue(np.allclose(np.abs(gamma_reco), np.abs(gamma), atol=atol, rtol=rtol))
 
 
+
+class TestClusterMerging(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):  # remove created files
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_cluster_merging_event_ranges(self):  # Check that the result of the parallel merging does not depend on the number of event ranges, DUT1 has cluster only between the DUT0 events
+        description = [('event_number', np.int64), ('ID', np.uint16), ('n_hits', np.uint16), ('charge', np.float32), ('seed_column', np.uint16), ('seed_row', np.uint16),
+                       ('mean_column', np.float32), ('mean_row', np.float32), ('err_column', np.float32), ('err_row', np.float32)]  # Cluster table of pixel_clusterizer
+        cluster_files = []
+        for dut_index, event_numbers in enumerate((np.arange(0, 2000, 2), np.arange(1, 2000, 2), np.arange(0, 2000, 2))):
+            cluster = np.zeros(event_numbers.shape[0], dtype=description)
+            cluster['event_number'] = event_numbers
+            cluster['n_hits'] = 1
+            cluster['mean_column'] = event_numbers % 80 + 1
+            cluster['mean_row'] = dut_index + 1
+            cluster_files.append(os.path.join(self.tmp_dir, 'Cluster_DUT%d.h5' % dut_index))
+            with tb.open_file(cluster_files[-1], mode='w') as out_file_h5:
+                out_file_h5.create_table(out_file_h5.root, name='Cluster', obj=cluster)
+
+        merged_cluster = {}
+        for n_ranges in (1, 4, 8):
+            with mock.patch('testbeam_analysis.dut_alignment.cpu_count', return_value=n_ranges):
+                dut_alignment.merge_cluster_data(input_cluster_files=cluster_files,
+                                                 output_merged_file=os.path.join(self.tmp_dir, 'Merged_%d.h5' % n_ranges),
+                                                 n_pixels=[(80, 336)] * 3,
+                                                 pixel_size=[(250, 50)] * 3,
+                                                 chunk_size=97)
+            with tb.open_file(os.path.join(self.tmp_dir, 'Merged_%d.h5' % n_ranges), mode='r') as in_file_h5:
+                merged_cluster[n_ranges] = in_file_h5.root.MergedCluster[:]
+
+        # All events up to the last DUT0 event are merged
+        self.assertEqual(merged_cluster[1].shape[0], 1999)
+        self.assertEqual(np.count_nonzero(~np.isnan(merged_cluster[1]['x_dut_1'])), 999)
+        for n_ranges in (4, 8):
+            for name in merged_cluster[1].dtype.names:
+                self.assertTrue(np.array_equal(merged_cluster[1][name], merged_cluster[n_ranges][name]) or np.allclose(merged_cluster[1][name], merged_cluster[n_ranges][name], equal_nan=True))
+
+
 if __name__ == '__main__':
     import logging
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
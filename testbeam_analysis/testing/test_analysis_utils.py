@@ -1,11 +1,16 @@
 ''' Script to check the correctness of the analysis utils that are written in C++.
 '''
 import os
+import shutil
+import tempfile
+import threading
 
 import unittest
+import mock
 
 import tables as tb
 import numpy as np
+from scipy.optimize import curve_fit
 
 from testbeam_analysis.cpp import data_struct
 from testbeam_analysis.tools import analysis_utils, test_tools
@@ -17,11 +22,11 @@ class TestAnalysisUtils(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        pass
+        cls.tmp_dir = tempfile.mkdtemp()
 
     @classmethod
     def tearDownClass(cls):  # remove created files
-        pass
+        shutil.rmtree(cls.tmp_dir)
 
     def test_analysis_utils_get_events_in_both_arrays(self):  # check compiled get_events_in_both_arrays function
         event_numbers = np.array([[0, 0, 2, 2, 2, 4, 5, 5, 6, 7, 7, 7, 8], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]], dtype=np.int64)
@@ -56,6 +61,20 @@ class TestAnalysisUtils(unittest.TestCase):
         result = analysis_utils.get_max_events_in_both_arrays(event_numbers, event_numbers_2)
         self.assertListEqual([1, 1, 1, 2, 4, 5, 6, 7, 9, 10, 10], result.tolist())
 
+    def test_analysis_utils_get_max_events_in_arrays(self):  # check the k-way merge against the pairwise merge
+        event_numbers = [np.array([1, 1, 2, 4, 5, 6, 7, 10, 10], dtype=np.int64),
+                         np.array([1, 1, 1, 6, 7, 9, 10], dtype=np.int64),
+                         np.array([], dtype=np.int64),
+                         np.array([0, 3, 3, 4, 10, 10, 10, 11], dtype=np.int64)]
+        result = analysis_utils.get_max_events_in_arrays(event_numbers)
+        self.assertListEqual([0, 1, 1, 1, 2, 3, 3, 4, 5, 6, 7, 9, 10, 10, 10, 11], result.tolist())
+        np.random.seed(0)
+        event_numbers = [np.sort(np.random.randint(0, 1000, size=size)).astype(np.int64) for size in (2000, 10, 500, 3000)]
+        result = event_numbers[0]
+        for actual_event_numbers in event_numbers[1:]:
+            result = analysis_utils.get_max_events_in_both_arrays(result, actual_event_numbers)
+        self.assertListEqual(analysis_utils.get_max_events_in_arrays(event_numbers).tolist(), result.tolist())
+
     def test_map_cluster(self):  # check the compiled function against result
         clusters = np.zeros((20, ), dtype=tb.dtype_from_descr(data_struct.ClusterInfoTable))
         result = np.zeros((20, ), dtype=tb.dtype_from_descr(data_struct.ClusterInfoTable))
@@ -78,6 +97,22 @@ class TestAnalysisUtils(unittest.TestCase):
         self.assertTrue(np.all(test_tools.nan_to_num(analysis_utils.map_cluster(common_event_number, clusters)) ==
                                test_tools.nan_to_num(result[:common_event_number.shape[0]])))
 
+    def test_map_cluster_arrays(self):  # check the mapping of several cluster arrays against the single array mapping
+        np.random.seed(0)
+        clusters = []
+        for size in (1000, 0, 300, 2000):
+            cluster = np.zeros((size, ), dtype=tb.dtype_from_descr(data_struct.ClusterInfoTable))
+            cluster['event_number'] = np.sort(np.random.randint(0, 500, size=size))
+            cluster['mean_column'] = np.random.uniform(0.5, 80.5, size=size)
+            cluster['charge'] = np.arange(size)
+            clusters.append(cluster)
+        common_event_number = analysis_utils.get_max_events_in_arrays([cluster['event_number'] for cluster in clusters])
+        mapped_clusters = analysis_utils.map_cluster_arrays(common_event_number, clusters)
+        self.assertEqual(mapped_clusters.shape, (len(clusters), common_event_number.shape[0]))
+        for cluster, mapped_cluster in zip(clusters, mapped_clusters):
+            self.assertTrue(np.all(test_tools.nan_to_num(analysis_utils.map_cluster(common_event_number, cluster)) ==
+                                   test_tools.nan_to_num(mapped_cluster)))
+
     def test_analysis_utils_in1d_events(self):  # check compiled get_in1d_sorted function
         event_numbers = np.array([[0, 0, 2, 2, 2, 4, 5, 5, 6, 7, 7, 7, 8], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]], dtype=np.int64)
         event_numbers_2 = np.array([1, 1, 1, 2, 2, 2, 4, 4, 4, 7], dtype=np.int64)
@@ -133,6 +168,157 @@ class TestAnalysisUtils(unittest.TestCase):
                 pass
             self.assertTrue(exception_ok & np.all(array == array_fast))
 
+    def test_event_index(self):  # check the event number index and the data selection with it
+        np.random.seed(0)
+        hits = np.zeros(20000, dtype=[('event_number', np.int64), ('column', np.uint16)])
+        hits['event_number'] = np.sort(np.random.randint(0, 10000, size=hits.shape[0]))
+        with tb.open_file(os.path.join(self.tmp_dir, 'event_index.h5'), 'w') as out_file_h5:
+            table = out_file_h5.create_table(out_file_h5.root, name='Hits', obj=hits[:15000])
+            self.assertIsNone(analysis_utils.get_event_index(table))
+            analysis_utils.create_event_index(table, step=100)
+            table.append(hits[15000:])  # index does not cover appended rows
+            for event_number in (-1, 0, 1, 17, 5000, hits['event_number'][15000], 9999, 10000):
+                for side in ('left', 'right'):
+                    self.assertEqual(analysis_utils.get_row_of_event(table, event_number, side=side, event_index=analysis_utils.get_event_index(table)),
+                                     np.searchsorted(hits['event_number'], event_number, side=side))
+            event_numbers, step = analysis_utils.create_event_index(table)  # update index
+            self.assertEqual(step, 100)
+            self.assertListEqual(event_numbers.tolist(), hits['event_number'][::100].tolist())
+
+            # data selection has to be the same as without index
+            for try_speedup in (False, True):
+                for start_event_number, stop_event_number in ((None, None), (hits['event_number'][5000], None), (hits['event_number'][5000], hits['event_number'][12345]), (None, 777)):
+                    data = np.concatenate([chunk for chunk, _ in analysis_utils.data_aligned_at_events(table, start_event_number=start_event_number, stop_event_number=stop_event_number, chunk_size=1000, try_speedup=try_speedup)])
+                    np.testing.assert_array_equal(data, analysis_utils.get_data_in_event_range(hits, start_event_number, stop_event_number))
+
+        with tb.open_file(os.path.join(self.tmp_dir, 'event_index.h5'), 'r') as in_file_h5:  # index is stored in the file
+            event_numbers, _ = analysis_utils.get_event_index(in_file_h5.root.Hits)
+            self.assertListEqual(event_numbers.tolist(), hits['event_number'][::100].tolist())
+            self.assertEqual(len(in_file_h5.list_nodes(in_file_h5.root)), 1)  # hidden node
+
+        with tb.open_file(os.path.join(self.tmp_dir, 'event_index.h5'), 'r+') as out_file_h5:  # recreated table with the same name and the same last event number
+            out_file_h5.remove_node(out_file_h5.root, 'Hits')
+            hits_new = hits.copy()
+            hits_new['event_number'][:10000] = np.sort(np.random.randint(0, hits['event_number'][10000], size=10000))
+            table = out_file_h5.create_table(out_file_h5.root, name='Hits', obj=hits_new)
+            self.assertIsNone(analysis_utils.get_event_index(table))
+            event_numbers, _ = analysis_utils.create_event_index(table, step=100)
+            self.assertListEqual(event_numbers.tolist(), hits_new['event_number'][::100].tolist())
+            self.assertIsNotNone(analysis_utils.get_event_index(table))
+
+    def test_data_aligned_at_events_prefetch(self):  # check that reading ahead does not change the returned chunks
+        np.random.seed(0)
+        hits = np.zeros(20000, dtype=[('event_number', np.int64), ('column', np.uint16)])
+        hits['event_number'] = np.sort(np.random.randint(0, 10000, size=hits.shape[0]))
+        hits['column'] = np.arange(hits.shape[0])
+        with tb.open_file(os.path.join(self.tmp_dir, 'prefetch.h5'), 'w') as out_file_h5:
+            table = out_file_h5.create_table(out_file_h5.root, name='Hits', obj=hits, filters=tb.Filters(complib='blosc', complevel=5))
+            for start_event_number, stop_event_number, start_index in ((None, None, None), (hits['event_number'][5000], None, None), (hits['event_number'][5000], hits['event_number'][12345], None), (None, 777, None), (None, None, 3333)):
+                for chunk_size in (100, 999, 30000):
+                    chunks = list(analysis_utils.data_aligned_at_events(table, start_event_number=start_event_number, stop_event_number=stop_event_number, start_index=start_index, chunk_size=chunk_size))
+                    for prefetch in (1, 3):
+                        chunks_prefetched = list(analysis_utils.data_aligned_at_events(table, start_event_number=start_event_number, stop_event_number=stop_event_number, start_index=start_index, chunk_size=chunk_size, prefetch=prefetch))
+                        self.assertEqual(len(chunks), len(chunks_prefetched))
+                        for (chunk, index), (chunk_prefetched, index_prefetched) in zip(chunks, chunks_prefetched):
+                            np.testing.assert_array_equal(chunk, chunk_prefetched)
+                            self.assertEqual(index, index_prefetched)
+
+            # every prefetched read starts at the event aligned start of the returned chunk
+            with mock.patch.object(analysis_utils, '_read_locked', side_effect=analysis_utils._read_locked) as read_locked:
+                chunks_prefetched = list(analysis_utils.data_aligned_at_events(table, chunk_size=999, prefetch=2))
+            self.assertListEqual([call[1]['start'] for call in read_locked.call_args_list][:len(chunks_prefetched)], [0] + [index for _, index in chunks_prefetched[:-1]])
+
+            n_threads = threading.active_count()
+            for _ in analysis_utils.data_aligned_at_events(table, chunk_size=100, prefetch=2):  # stop early, the reading thread has to stop
+                break
+            self.assertEqual(threading.active_count(), n_threads)
+
+    def test_correlation_band(self):  # check the band-limited correlation against the full correlation histogram
+        np.random.seed(0)
+        cluster_1 = np.zeros(5000, dtype=tb.dtype_from_descr(data_struct.ClusterInfoTable))
+        cluster_2 = np.zeros(5000, dtype=tb.dtype_from_descr(data_struct.ClusterInfoTable))
+        for cluster in (cluster_1, cluster_2):
+            cluster['event_number'] = np.sort(np.random.randint(0, 2000, size=cluster.shape[0]))
+        cluster_1['mean_column'] = np.random.uniform(0.5, 80.5, size=cluster_1.shape[0])
+        cluster_1['mean_row'] = np.random.uniform(0.5, 336.5, size=cluster_1.shape[0])
+        cluster_2['mean_column'] = np.random.uniform(0.5, 40.5, size=cluster_2.shape[0])
+        cluster_2['mean_row'] = np.random.uniform(0.5, 336.5, size=cluster_2.shape[0])
+
+        column_corr_hist, row_corr_hist = np.zeros((40, 80), dtype=np.int), np.zeros((336, 336), dtype=np.int)
+        analysis_utils.correlate_cluster_on_event_number(cluster_1, cluster_2, column_corr_hist, row_corr_hist)
+
+        band_width = 5
+        column_band_start = analysis_utils.get_correlation_band_start(n_pixel_dut=40, n_pixel_ref=80, pixel_size_dut=500.0, pixel_size_ref=250.0, band_width=band_width, offset=100.0)
+        row_band_start = analysis_utils.get_correlation_band_start(n_pixel_dut=336, n_pixel_ref=336, pixel_size_dut=50.0, pixel_size_ref=50.0, band_width=band_width, slope=-1.0)
+        self.assertListEqual(column_band_start[:3].tolist(), [-4, -2, 0])  # ref = 100 + (dut - 20 * 500), band center at 2 * index + 1
+        self.assertListEqual(row_band_start[:2].tolist(), [330, 329])  # inverted
+        column_corr_band, row_corr_band = np.zeros((40, 2 * band_width + 1), dtype=np.int), np.zeros((336, 2 * band_width + 1), dtype=np.int)
+        overflow = np.zeros(2, dtype=np.int64)
+        analysis_utils.correlate_cluster_on_event_number_band(cluster_1, cluster_2, column_corr_band, row_corr_band, column_band_start, row_band_start, overflow)
+
+        with tb.open_file(os.path.join(self.tmp_dir, 'correlation_band.h5'), 'w') as out_file_h5:
+            for name, band, band_start, hist, index in (('CorrelationColumn_1_0', column_corr_band, column_band_start, column_corr_hist, 0), ('CorrelationRow_1_0', row_corr_band, row_band_start, row_corr_hist, 1)):
+                node = out_file_h5.create_carray(out_file_h5.root, name=name, obj=band)
+                node.attrs.band_start = band_start
+                node.attrs.n_pixel_ref = hist.shape[1]
+                dense = analysis_utils.get_correlation_histogram(node)
+                # Histogram entries inside the band are identical, all others are counted in the overflow
+                ref_index = np.arange(hist.shape[1])[np.newaxis, :]
+                in_band = np.logical_and(ref_index >= band_start[:, np.newaxis], ref_index <= band_start[:, np.newaxis] + 2 * band_width)
+                np.testing.assert_array_equal(dense, np.where(in_band, hist, 0))
+                self.assertEqual(overflow[index], hist[~in_band].sum())
+                self.assertEqual(band.sum() + overflow[index], hist.sum())
+
+    def test_fit_gauss_stack(self):  # check the batched Gauss fits against single fits with curve_fit
+        np.random.seed(0)
+        x = np.linspace(-50.0, 50.0, 201)
+        mu, sigma = np.random.uniform(-10.0, 10.0, size=50), np.random.uniform(2.0, 8.0, size=50)
+        data = np.random.poisson(100.0 * np.exp(-0.5 * ((x[np.newaxis, :] - mu[:, np.newaxis]) / sigma[:, np.newaxis]) ** 2) + 3.0).astype(np.float)
+        data[-1] = 0.0  # No data, fit fails
+        for fit_offset, function in ((False, analysis_utils.gauss), (True, analysis_utils.gauss_offset)):
+            coeff, cov, status = analysis_utils.fit_gauss_stack(x=x, data=data, fit_offset=fit_offset)
+            self.assertEqual(coeff.shape, (50, 4 if fit_offset else 3))
+            self.assertEqual(cov.shape, (50, 4 if fit_offset else 3, 4 if fit_offset else 3))
+            self.assertTrue(np.all(status[:-1] == 0))
+            self.assertEqual(status[-1], 2)
+            self.assertTrue(np.all(np.isnan(coeff[-1])))
+            for index in range(49):
+                p0 = [data[index].max(), mu[index], sigma[index]] + ([3.0] if fit_offset else [])
+                coeff_curve_fit, cov_curve_fit = curve_fit(function, x, data[index], p0=p0)
+                self.assertTrue(np.allclose(coeff[index], coeff_curve_fit, rtol=1e-3))
+                self.assertTrue(np.allclose(np.diag(cov[index]), np.diag(cov_curve_fit), rtol=1e-2))
+        # Fit with masked bins and one x array per histogram
+        mask = np.ones_like(data, dtype=np.bool)
+        mask[:, 20:40] = False
+        coeff_masked, _, status = analysis_utils.fit_gauss_stack(x=np.tile(x, (50, 1)), data=np.where(mask, data, 1000.0), mask=mask)
+        self.assertTrue(np.all(status[:-1] == 0))
+        for index in range(49):
+            coeff_curve_fit, _ = curve_fit(analysis_utils.gauss, x[mask[index]], data[index][mask[index]], p0=[data[index].max(), mu[index], sigma[index]])
+            self.assertTrue(np.allclose(coeff_masked[index], coeff_curve_fit, rtol=1e-3))
+
+    def test_hough_transform(self):  # check the Hough transformation against the nearest rho bin search
+        np.random.seed(0)
+        img = (np.random.uniform(size=(80, 120)) > 0.99).astype(np.int64)
+        img[np.arange(80), 10 + np.arange(80)] = 1  # line with x = y + 10
+        accumulator, thetas, rhos = analysis_utils.hough_transform(img, theta_res=0.5, rho_res=1.3)
+        y_idxs, x_idxs = np.nonzero(img)
+        rho_values = x_idxs[:, np.newaxis] * np.cos(thetas)[np.newaxis, :] + y_idxs[:, np.newaxis] * np.sin(thetas)[np.newaxis, :]
+        rho_idxs = np.abs(rhos[np.newaxis, np.newaxis, :] - rho_values[:, :, np.newaxis]).argmin(axis=2)
+        accumulator_search = np.zeros_like(accumulator)
+        np.add.at(accumulator_search, (rho_idxs, np.tile(np.arange(thetas.shape[0]), (x_idxs.shape[0], 1))), 1)
+        self.assertEqual(accumulator.sum(), img.sum() * thetas.shape[0])
+        self.assertLessEqual(np.abs(accumulator - accumulator_search).sum(), 10)  # Only rho values exactly in between two bins can differ
+        rho_idx, theta_idx = np.unravel_index(accumulator.argmax(), accumulator.shape)
+        self.assertLessEqual(abs(np.rad2deg(thetas[theta_idx]) + 45.0), 1.0)
+        self.assertLess(abs(rhos[rho_idx] - 10.0 * np.cos(np.deg2rad(45.0))), 1.3)
+        # Weighted with the image content
+        accumulator_weighted, _, _ = analysis_utils.hough_transform(img * 3, theta_res=0.5, rho_res=1.3, weighted=True)
+        self.assertTrue(np.allclose(accumulator_weighted, 3 * accumulator))
+        # Pixels given by their indices
+        accumulator_points, _, _ = analysis_utils.hough_transform_points(x_idxs=x_idxs, y_idxs=y_idxs, shape=img.shape, theta_res=0.5, rho_res=1.3)
+        np.testing.assert_array_equal(accumulator_points, accumulator)
+
+
 if __name__ == '__main__':
     import logging
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
@@ -4,6 +4,7 @@ import numpy as np
 
 import unittest
 
+from testbeam_analysis import dut_alignment
 from testbeam_analysis.tools import geometry_utils
 
 
@@ -99,6 +100,56 @@ class TestTrackAnalysis(unittest.TestCase):
                     self.assertTrue(np.allclose(y_old, y))
                     self.assertTrue(np.allclose(z_old, z))
 
+    def test_alignment_transformer(self):  # Compares the transformation of positions and errors to the transformation matrices
+        np.random.seed(0)
+        x, y, z = np.random.uniform(-1000., 1000., size=(3, 100))
+        x_err, y_err, z_err = np.random.uniform(1., 10., size=(3, 100))
+        alignment = dut_alignment._create_alignment_array(n_duts=2)
+        alignment['translation_x'], alignment['translation_y'], alignment['translation_z'] = (100., -20.), (-50., 30.), (0., 10000.)
+        alignment['alpha'], alignment['beta'], alignment['gamma'] = (0.1, np.pi), (-0.2, 0.01), (0.3, -1.)
+        transformer = geometry_utils.AlignmentTransformer(alignment=alignment)
+        for dut_index in range(2):
+            for inverse, transformation_matrix_function in ((False, geometry_utils.local_to_global_transformation_matrix), (True, geometry_utils.global_to_local_transformation_matrix)):
+                transformation_matrix = transformation_matrix_function(x=alignment[dut_index]['translation_x'],
+                                                                       y=alignment[dut_index]['translation_y'],
+                                                                       z=alignment[dut_index]['translation_z'],
+                                                                       alpha=alignment[dut_index]['alpha'],
+                                                                       beta=alignment[dut_index]['beta'],
+                                                                       gamma=alignment[dut_index]['gamma'])
+                rotation_matrix = transformation_matrix_function(x=0., y=0., z=0., alpha=alignment[dut_index]['alpha'], beta=alignment[dut_index]['beta'], gamma=alignment[dut_index]['gamma'])
+                self.assertTrue(np.allclose(transformer.get_transformation_matrix(dut_index=dut_index, inverse=inverse), transformation_matrix))
+                result = transformer.transform(x, y, z, dut_index=dut_index, hits_xerr=x_err, hits_yerr=y_err, hits_zerr=z_err, inverse=inverse)
+                expected = geometry_utils.apply_transformation_matrix(x, y, z, transformation_matrix) + geometry_utils.apply_transformation_matrix(x_err, y_err, z_err, rotation_matrix)
+                for result_values, expected_values in zip(result, expected):
+                    self.assertTrue(np.allclose(result_values, expected_values))
+
+    def test_apply_alignment_to_hits(self):  # Applies the alignment to the hit table and back and compares to the transformation of the hit arrays
+        np.random.seed(0)
+        n_hits = 100
+        hits = np.zeros(n_hits, dtype=[('event_number', np.int64)] + [('%s_dut_%d' % (name, dut_index), np.float64) for dut_index in range(2) for name in ('x', 'y', 'z', 'xerr', 'yerr', 'zerr')])
+        for dut_index in range(2):
+            for name in ('x', 'y', 'xerr', 'yerr', 'zerr'):
+                hits['%s_dut_%d' % (name, dut_index)] = np.random.uniform(1., 1000., n_hits)
+        alignment = dut_alignment._create_alignment_array(n_duts=2)
+        alignment['translation_x'], alignment['translation_y'], alignment['translation_z'] = (100., -20.), (-50., 30.), (0., 10000.)
+        alignment['alpha'], alignment['beta'], alignment['gamma'] = (0., 0.01), (0., -0.02), (0., 0.005)
+
+        hits_aligned = hits.copy()
+        geometry_utils.apply_alignment_to_hits(hits=hits_aligned, dut_index=1, alignment=alignment)
+        x, y, z = geometry_utils.apply_alignment(hits_x=hits['x_dut_1'], hits_y=hits['y_dut_1'], hits_z=hits['z_dut_1'], dut_index=1, alignment=alignment)
+        self.assertTrue(np.allclose(hits_aligned['x_dut_1'], x))
+        self.assertTrue(np.allclose(hits_aligned['y_dut_1'], y))
+        self.assertTrue(np.allclose(hits_aligned['z_dut_1'], z))
+        self.assertTrue(np.array_equal(hits_aligned['x_dut_0'], hits['x_dut_0']))  # Other DUTs are not changed
+
+        geometry_utils.apply_alignment_to_hits(hits=hits_aligned, dut_index=1, alignment=alignment, inverse=True)
+        for name in ('x', 'y', 'z'):
+            self.assertTrue(np.allclose(hits_aligned['%s_dut_1' % name], hits['%s_dut_1' % name]))
+
+        hits_aligned = hits.copy()
+        geometry_utils.apply_alignment_to_hits(hits=hits_aligned, dut_index=1, alignment=alignment, no_z=True)
+        self.assertTrue(np.array_equal(hits_aligned['z_dut_1'], hits['z_dut_1']))
+
 if __name__ == '__main__':
     import logging
     logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
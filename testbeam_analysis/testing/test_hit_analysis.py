@@ -130,6 +130,23 @@ class TestHitAnalysis(unittest.TestCase):
                                                             output_cluster_file, exact=False)
         self.assertTrue(data_equal, msg=error_msg)
 
+    def test_process_hit_files(self):  # check that processing several DUTs in parallel gives the same results as one after another
+        input_hits_files = [os.path.join(self.output_folder, 'Batch_Mimosa26_DUT0_small.h5'), os.path.join(self.output_folder, 'Batch_FEI4_DUT0_small.h5')]
+        shutil.copy(self.noisy_data_file, input_hits_files[0])
+        shutil.copy(self.data_file, input_hits_files[1])
+        mask_kwargs = [{'n_pixel': (1152, 576), 'threshold': 10.0, 'plot': False}, {'n_pixel': (80, 336), 'threshold': 10.0, 'plot': False}]
+        cluster_kwargs = [{'min_hit_charge': 1, 'max_hit_charge': 1, 'column_cluster_distance': 2, 'row_cluster_distance': 2, 'frame_cluster_distance': 1, 'plot': False},
+                          {'min_hit_charge': 0, 'max_hit_charge': 13, 'column_cluster_distance': 1, 'row_cluster_distance': 2, 'frame_cluster_distance': 2, 'plot': False}]
+        for i, input_hits_file in enumerate(input_hits_files):
+            output_mask_file = hit_analysis.generate_pixel_mask(input_hits_file=input_hits_file, output_mask_file=input_hits_file[:-3] + '_sequential_mask.h5', **mask_kwargs[i])
+            hit_analysis.cluster_hits(input_hits_file=input_hits_file, output_cluster_file=input_hits_file[:-3] + '_sequential_clustered.h5',
+                                      input_noisy_pixel_mask_file=output_mask_file, **cluster_kwargs[i])
+        for n_cores in (2, 4):  # 4 cores: the larger file is split into tasks
+            output_cluster_files = hit_analysis.process_hit_files(input_hits_files=input_hits_files, mask_kwargs=mask_kwargs, cluster_kwargs=cluster_kwargs, n_cores=n_cores)
+            for i, input_hits_file in enumerate(input_hits_files):
+                data_equal, error_msg = test_tools.compare_h5_files(input_hits_file[:-3] + '_sequential_clustered.h5', output_cluster_files[i])
+                self.assertTrue(data_equal, msg=error_msg)
+
 
 if __name__ == '__main__':
     import logging
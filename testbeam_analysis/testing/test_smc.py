@@ -0,0 +1,261 @@
+''' Script to check the split, map, combine (SMC) implementation.
+'''
+import os
+import shutil
+import tempfile
+
+import unittest
+
+import numpy as np
+import tables as tb
+
+from testbeam_analysis.tools import smc
+
+
+def _hits_table(n_events=10000, seed=0):
+    ''' Creates a hit table with a variable number of hits per event '''
+    np.random.seed(seed)
+    n_hits = np.random.randint(0, 5, size=n_events)
+    hits = np.zeros(np.sum(n_hits), dtype=[('event_number', np.int64),
+                                            ('column', np.uint16),
+                                            ('row', np.uint16)])
+    hits['event_number'] = np.repeat(np.arange(n_events), n_hits)
+    hits['column'] = np.random.randint(1, 81, size=hits.shape[0])
+    hits['row'] = np.random.randint(1, 337, size=hits.shape[0])
+    return hits
+
+
+def _select_func(data, threshold):
+    return data[data['column'] > threshold]
+
+
+def _hist_func(data):
+    return np.bincount(data['column'])
+
+
+def _hist_2d_func(data):
+    hist = np.zeros(shape=(data['column'].max() + 1, data['row'].max() + 1), dtype=np.uint32)
+    np.add.at(hist, (data['column'], data['row']), 1)
+    return hist
+
+
+def _multi_output_func(data):
+    return {'Selected': data, 'HistColumn': _hist_func(data)}
+
+
+def _hist_sum(out_file):
+    return {'n_entries': out_file.root.HistColumn[:].sum()}
+
+
+def _add_n_entries(data, n_entries):
+    data['row'] = n_entries
+    return data
+
+
+class TestSMC(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.hits = _hits_table()
+        cls.hit_file = os.path.join(cls.tmp_dir, 'hits.h5')
+        with tb.open_file(cls.hit_file, 'w') as out_file:
+            out_file.create_table(out_file.root, name='Hits', obj=cls.hits, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+
+    @classmethod
+    def tearDownClass(cls):
+        smc.shutdown_pool()
+        shutil.rmtree(cls.tmp_dir)
+
+    def test_table_output(self):  # Check that the table result does not depend on the number of cores
+        for n_cores in (1, 2, 3):
+            output_file = os.path.join(self.tmp_dir, 'table_%d.h5' % n_cores)
+            smc.SMC(table_file_in=self.hit_file,
+                    file_out=output_file,
+                    func=_select_func,
+                    func_kwargs={'threshold': 40},
+                    node_desc={'name': 'Selected'},
+                    align_at='event_number',
+                    n_cores=n_cores,
+                    chunk_size=1000)
+            with tb.open_file(output_file) as in_file:
+                result = in_file.root.Selected[:]
+            np.testing.assert_array_equal(result, _select_func(self.hits, 40))
+
+    def test_shared_memory_table_output(self):  # Check that the table result is the same when transferred by shared memory
+        for n_cores in (1, 2, 3):
+            for threshold in (40, 100):  # 100: empty result
+                output_file = os.path.join(self.tmp_dir, 'table_shm_%d.h5' % n_cores)
+                smc.SMC(table_file_in=self.hit_file,
+                        file_out=output_file,
+                        func=_select_func,
+                        func_kwargs={'threshold': threshold},
+                        node_desc={'name': 'Selected'},
+                        align_at='event_number',
+                        n_cores=n_cores,
+                        shared_memory=True,
+                        chunk_size=1000)
+                with tb.open_file(output_file) as in_file:
+                    result = in_file.root.Selected[:]
+                    self.assertEqual(in_file.root.Selected.filters.complib, 'blosc')
+                np.testing.assert_array_equal(result, _select_func(self.hits, threshold))
+
+    def test_hist_output(self):  # Check that the histogram result does not depend on the number of cores
+        for n_cores in (1, 2, 3):
+            output_file = os.path.join(self.tmp_dir, 'hist_%d.h5' % n_cores)
+            smc.SMC(table_file_in=self.hit_file,
+                    file_out=output_file,
+                    func=_hist_func,
+                    node_desc={'name': 'HistColumn'},
+                    n_cores=n_cores,
+                    chunk_size=1000)
+            with tb.open_file(output_file) as in_file:
+                result = in_file.root.HistColumn[:]
+            np.testing.assert_array_equal(result, _hist_func(self.hits))
+
+    def test_hist_output_declared_shape(self):  # Check the histogram result with a given output shape and different shapes per chunk
+        hist_2d = _hist_2d_func(self.hits)
+        for n_cores in (1, 2, 3):
+            for shape in (None, (81, 337)):
+                output_file = os.path.join(self.tmp_dir, 'hist_2d_%d.h5' % n_cores)
+                node_desc = {'name': 'HistOcc'}
+                if shape is not None:
+                    node_desc['shape'] = shape
+                smc.SMC(table_file_in=self.hit_file,
+                        file_out=output_file,
+                        func=_hist_2d_func,
+                        node_desc=node_desc,
+                        n_cores=n_cores,
+                        n_tasks=5,
+                        chunk_size=333)
+                with tb.open_file(output_file) as in_file:
+                    result = in_file.root.HistOcc[:]
+                np.testing.assert_array_equal(result, hist_2d)
+
+        with self.assertRaises(ValueError):  # Declared shape too small
+            smc.SMC(table_file_in=self.hit_file,
+                    file_out=os.path.join(self.tmp_dir, 'hist_2d_small.h5'),
+                    func=_hist_2d_func,
+                    node_desc={'name': 'HistOcc', 'shape': (10, 10)},
+                    n_cores=1,
+                    chunk_size=1000)
+
+    def test_task_splitting(self):  # Check that tasks do not split events and that the result does not depend on the number of tasks
+        for n_tasks in (1, 7, 100):
+            output_file = os.path.join(self.tmp_dir, 'tasks_%d.h5' % n_tasks)
+            s = smc.SMC(table_file_in=self.hit_file,
+                        file_out=output_file,
+                        func=_select_func,
+                        func_kwargs={'threshold': 0},
+                        node_desc={'name': 'Selected'},
+                        align_at='event_number',
+                        n_cores=2,
+                        n_tasks=n_tasks,
+                        chunk_size=100)
+            self.assertLessEqual(len(s.start_i), n_tasks)
+            self.assertEqual(s.start_i[0], 0)
+            self.assertEqual(s.stop_i[-1], self.hits.shape[0])
+            self.assertListEqual(s.start_i[1:], s.stop_i[:-1])
+            for index in s.start_i[1:]:
+                self.assertNotEqual(self.hits['event_number'][index - 1], self.hits['event_number'][index])
+            with tb.open_file(output_file) as in_file:
+                result = in_file.root.Selected[:]
+            np.testing.assert_array_equal(result, self.hits)
+
+    def test_function_chain(self):  # Check chained functions, several outputs and a barrier in one call
+        for n_cores in (1, 2):
+            for shared_memory in (False, True):
+                output_file = os.path.join(self.tmp_dir, 'chain_%d.h5' % n_cores)
+                smc.SMC(table_file_in=self.hit_file,
+                        file_out=output_file,
+                        func=[_select_func, _multi_output_func, smc.Barrier(_hist_sum, table='Selected'), _add_n_entries],
+                        func_kwargs=[{'threshold': 40}, {}, {}],
+                        node_desc={'outputs': {'HistColumn': {'shape': (81, )}}},
+                        align_at='event_number',
+                        n_cores=n_cores,
+                        shared_memory=shared_memory,
+                        chunk_size=1000)
+                selected = _select_func(self.hits, 40)
+                hist = np.bincount(selected['column'], minlength=81)
+                selected['row'] = hist.sum()
+                with tb.open_file(output_file) as in_file:
+                    self.assertEqual(sorted(node.name for node in in_file.root), ['HistColumn', 'Selected'])
+                    np.testing.assert_array_equal(in_file.root.Selected[:], selected)
+                    np.testing.assert_array_equal(in_file.root.HistColumn[:], hist)
+
+        with self.assertRaises(ValueError):  # Missing kwargs for the chain
+            smc.SMC(table_file_in=self.hit_file,
+                    file_out=os.path.join(self.tmp_dir, 'chain_fail.h5'),
+                    func=[_select_func, _hist_func],
+                    func_kwargs={'threshold': 40})
+
+    def test_thread_backend(self):  # Check that the results of worker threads are the same as of worker processes
+        hist_2d = _hist_2d_func(self.hits)
+        for n_cores in (1, 2, 3):
+            output_file = os.path.join(self.tmp_dir, 'threads_%d.h5' % n_cores)
+            smc.SMC(table_file_in=self.hit_file,
+                    file_out=output_file,
+                    func=[_select_func, _multi_output_func],
+                    func_kwargs=[{'threshold': 40}, {}],
+                    node_desc={'name': 'Selected'},
+                    align_at='event_number',
+                    n_cores=n_cores,
+                    backend='thread',
+                    chunk_size=1000)
+            selected = _select_func(self.hits, 40)
+            with tb.open_file(output_file) as in_file:
+                np.testing.assert_array_equal(in_file.root.Selected[:], selected)
+                np.testing.assert_array_equal(in_file.root.HistColumn[:], _hist_func(selected))
+                self.assertEqual(in_file.root.Selected.filters.complib, 'blosc')
+
+            smc.SMC(table_file_in=self.hit_file,
+                    file_out=output_file,
+                    func=_hist_2d_func,
+                    node_desc={'name': 'HistOcc'},
+                    n_cores=n_cores,
+                    n_tasks=5,
+                    backend='thread',
+                    chunk_size=333)
+            with tb.open_file(output_file) as in_file:
+                np.testing.assert_array_equal(in_file.root.HistOcc[:], hist_2d)
+
+        with self.assertRaises(ValueError):
+            smc.SMC(table_file_in=self.hit_file,
+                    file_out=os.path.join(self.tmp_dir, 'backend_fail.h5'),
+                    func=_hist_func,
+                    backend='gpu')
+
+    def test_tree_reduction(self):  # Check that pairs are summed as soon as both operands are set and that the tree does not depend on the order
+        def add(result_1, result_2, callback):
+            added.append(result_1 + result_2)
+            callback(result_1 + result_2)
+
+        for order in ([0, 1, 2, 3, 4], [4, 3, 2, 1, 0], [3, 0, 4, 2, 1]):
+            added = []
+            reduction = smc._TreeReduction(n_results=5, add=add)
+            for index in order:
+                reduction.set(index, 'abcde'[index])
+                if index == 3 and 2 in order[:order.index(3)]:
+                    self.assertIn('cd', added)  # Summed before all results are set
+            self.assertEqual(reduction.get(), 'abcde')
+            self.assertEqual(sorted(added), sorted(['ab', 'cd', 'abcd', 'abcde']))
+
+    def test_persistent_pool(self):  # Check that the worker pool is reused between calls
+        pool = smc.get_pool(2)
+        self.assertIs(pool, smc.get_pool(2))
+        small_pool = smc.get_pool(1)  # A smaller pool must not run more tasks at once than requested
+        self.assertIsNot(pool, small_pool)
+        self.assertEqual(small_pool._processes, 1)
+        self.assertIs(pool, smc.get_pool(2))
+        smc.shutdown_pool()
+        self.assertIsNot(pool, smc.get_pool(2))
+        thread_pool = smc.get_pool(2, backend='thread')
+        self.assertIsNot(pool, thread_pool)
+        self.assertIs(thread_pool, smc.get_pool(2, backend='thread'))
+
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - [%(levelname)-8s] (%(threadName)-10s) %(message)s")
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestSMC)
+    unittest.TextTestRunner(verbosity=2).run(suite)
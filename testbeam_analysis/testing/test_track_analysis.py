@@ -4,7 +4,10 @@ import os
 import shutil
 import unittest
 
+import numpy as np
+
 from testbeam_analysis import track_analysis
+from testbeam_analysis import dut_alignment
 from testbeam_analysis.tools import analysis_utils, test_tools
 
 testing_path = os.path.dirname(__file__)
@@ -54,6 +57,40 @@ class TestTrackAnalysis(unittest.TestCase):
                                                                                                         'fixtures/track_analysis/TrackCandidates_result.h5')),
                                                             os.path.join(self.output_folder, 'TrackCandidates_2.h5'))
         self.assertTrue(data_equal, msg=error_msg)
+        # Test 3: not aligned tracklets, the pre-alignment is applied when reading the data
+        dut_alignment.apply_alignment(input_hit_file=analysis_utils.get_data('fixtures/track_analysis/Tracklets_small.h5',
+                                                                             output=os.path.join(testing_path,
+                                                                                                 'fixtures/track_analysis/Tracklets_small.h5')),
+                                      input_alignment_file=analysis_utils.get_data('fixtures/track_analysis/Alignment_result.h5',
+                                                                                   output=os.path.join(testing_path,
+                                                                                                       'fixtures/track_analysis/Alignment_result.h5')),
+                                      output_hit_file=os.path.join(self.output_folder, 'Tracklets_not_aligned.h5'),
+                                      inverse=True,
+                                      force_prealignment=True)
+        track_analysis.find_tracks(input_tracklets_file=os.path.join(self.output_folder, 'Tracklets_not_aligned.h5'),
+                                   input_alignment_file=analysis_utils.get_data('fixtures/track_analysis/Alignment_result.h5',
+                                                                                output=os.path.join(testing_path,
+                                                                                                    'fixtures/track_analysis/Alignment_result.h5')),
+                                   output_track_candidates_file=os.path.join(self.output_folder, 'TrackCandidates_3.h5'),
+                                   align_hits=True,
+                                   force_prealignment=True)
+        data_equal, error_msg = test_tools.compare_h5_files(analysis_utils.get_data('fixtures/track_analysis/TrackCandidates_result.h5',
+                                                                                    output=os.path.join(testing_path,
+                                                                                                        'fixtures/track_analysis/TrackCandidates_result.h5')),
+                                                            os.path.join(self.output_folder, 'TrackCandidates_3.h5'), exact=False)
+        self.assertTrue(data_equal, msg=error_msg)
+
+    def test_dut_array(self):  # Check the (n_events x n_duts) arrays used in the track finding for adjacent and interleaved columns
+        for description in ([('event_number', '<i8'), ('x_dut_0', '<f8'), ('x_dut_1', '<f8'), ('x_dut_2', '<f8'), ('n_tracks', 'i1')],
+                            [('event_number', '<i8'), ('x_dut_0', '<f8'), ('n_tracks', 'i1'), ('x_dut_1', '<f8'), ('x_dut_2', '<f8')]):
+            data = np.zeros(5, dtype=description)
+            for dut_index in range(3):
+                data['x_dut_%d' % dut_index] = np.arange(5) + 10 * dut_index
+            array = track_analysis._get_dut_array(data, name='x', n_duts=3)
+            self.assertTrue(np.array_equal(array, np.column_stack([data['x_dut_%d' % dut_index] for dut_index in range(3)])))
+            self.assertEqual(np.may_share_memory(array, data), description[2][0] == 'x_dut_1')  # Only adjacent columns can be a view
+            array[1, 2] = -1.
+            self.assertEqual(data['x_dut_2'][1] == -1., description[2][0] == 'x_dut_1')
 
     def test_track_fitting(self):
         # Test 1: Fit DUTs and always exclude one DUT (normal mode for unbiased residuals and efficiency determination)
@@ -5,12 +5,19 @@ from __future__ import division
 import logging
 import os
 import errno
+import threading
+import uuid
+from functools import partial
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 import requests
 import progressbar
 import numpy as np
 import numexpr as ne
 import tables as tb
-from numba import njit
+from numba import njit, prange
 from scipy.interpolate import splrep, sproot
 from scipy import stats
 from scipy.optimize import curve_fit
@@ -23,8 +30,11 @@ from testbeam_analysis.cpp import data_struct
 # A public secret representing public, read only owncloud folder
 SCIBO_PUBLIC_FOLDER = 'NzfAx2zAQll5YXB'
 
+# HDF5 is not thread safe, file access of threads running in parallel is serialized
+hdf5_lock = threading.RLock()
 
-@njit
+
+@njit(nogil=True)
 def merge_on_event_number(data_1, data_2):
     """
     Merges the data_2 with data_1 on an event basis with all permutations
@@ -87,7 +97,7 @@ def merge_on_event_number(data_1, data_2):
     return result_1, result_2
 
 
-@njit
+@njit(nogil=True)
 def correlate_cluster_on_event_number(data_1, data_2, column_corr_hist, row_corr_hist):
     """Correlating the hit/cluster indices of two arrays on an event basis with all permutations.
     In other words: correlate all hit/cluster indices of particular event in data_2 with all hit/cluster indices of the same event in data_1.
@@ -134,7 +144,117 @@ def correlate_cluster_on_event_number(data_1, data_2, column_corr_hist, row_corr
                 break
 
 
-@njit
+@njit(nogil=True)
+def correlate_cluster_on_event_number_band(data_1, data_2, column_corr_band, row_corr_band, column_band_start, row_band_start, overflow):
+    """Same as correlate_cluster_on_event_number but only a band around the expected correlation line is histogrammed.
+
+    Row i of the band histogram holds the DUT index i, the band column j holds the reference index band_start[i] + j.
+    Correlations outside of the band are counted in the overflow array.
+
+    Parameters
+    ----------
+    data_1, data_2: np.recarray
+        Hit/cluster array. Must have event_number / mean_column / mean_row columns.
+    column_corr_band, row_corr_band: np.array
+        2D band correlation array with shape (n_pixel_dut, band size).
+    column_band_start, row_band_start: np.array
+        First reference index of the band for each DUT index.
+    overflow: np.array
+        Array with 2 entries, the number of column and row correlations outside of the band.
+
+    """
+    index_data_2 = 0
+    column_band_size = column_corr_band.shape[1]
+    row_band_size = row_corr_band.shape[1]
+
+    for index_data_1 in range(data_1.shape[0]):
+
+        while index_data_2 < data_2.shape[0] and data_2[index_data_2]['event_number'] < data_1[index_data_1]['event_number']:  # Catch up with outer loop
+            index_data_2 += 1
+
+        for event_index_data_2 in range(index_data_2, data_2.shape[0]):
+            if data_1[index_data_1]['event_number'] == data_2[event_index_data_2]['event_number']:
+                # Assuming value is an index, cluster index 1 from 0.5 to 1.4999, index 2 from 1.5 to 2.4999, etc.
+                column_index_dut_1 = int(np.floor(data_1[index_data_1]['mean_column'] - 0.5))
+                row_index_dut_1 = int(np.floor(data_1[index_data_1]['mean_row'] - 0.5))
+                column_index_dut_2 = int(np.floor(data_2[event_index_data_2]['mean_column'] - 0.5))
+                row_index_dut_2 = int(np.floor(data_2[event_index_data_2]['mean_row'] - 0.5))
+
+                if not (column_index_dut_1 >= 0 and row_index_dut_1 >= 0 and column_index_dut_2 >= 0 and row_index_dut_2 >= 0):
+                    raise ValueError('Column and/or row index is smaller than 0.5')
+
+                # Add correlation to band histogram or to overflow
+                column_band_index = column_index_dut_1 - column_band_start[column_index_dut_2]
+                if column_band_index >= 0 and column_band_index < column_band_size:
+                    column_corr_band[column_index_dut_2, column_band_index] += 1
+                else:
+                    overflow[0] += 1
+                row_band_index = row_index_dut_1 - row_band_start[row_index_dut_2]
+                if row_band_index >= 0 and row_band_index < row_band_size:
+                    row_corr_band[row_index_dut_2, row_band_index] += 1
+                else:
+                    overflow[1] += 1
+            else:
+                break
+
+
+def get_correlation_band_start(n_pixel_dut, n_pixel_ref, pixel_size_dut, pixel_size_ref, band_width, offset=0.0, slope=None):
+    '''Calculates the first reference index of the correlation band for each DUT index.
+
+    The band is centered around the expected correlation line ref = offset + slope * dut,
+    with positions in um and the origin in the center of the pixel matrix as used in the pre-alignment.
+
+    Parameters
+    ----------
+    n_pixel_dut, n_pixel_ref : uint
+        Number of pixels of the DUT and the reference DUT.
+    pixel_size_dut, pixel_size_ref : float
+        Pixel size of the DUT and the reference DUT in um.
+    band_width : uint
+        Number of reference pixels on each side of the expected correlation line.
+    offset : float
+        Offset of the expected correlation line in um.
+    slope : float
+        Slope of the expected correlation line. If None, the DUT is assumed to have the same orientation as the reference DUT.
+
+    Returns
+    -------
+    Array with the first reference index of the band for each DUT index.
+    '''
+    if slope is None:
+        slope = 1.0
+    x_dut = np.arange(n_pixel_dut, dtype=np.float64) + 0.5  # Index to position, pixel center
+    x_ref = (offset + slope * (x_dut - 0.5 * n_pixel_dut) * pixel_size_dut) / pixel_size_ref + 0.5 * n_pixel_ref
+    return np.floor(x_ref).astype(np.int64) - band_width
+
+
+def get_correlation_histogram(node):
+    '''Returns the dense 2D correlation histogram of a correlation node.
+
+    Band-limited correlation histograms (see dut_alignment.correlate_cluster) are expanded to the
+    full (n_pixel_dut, n_pixel_ref) shape, entries outside of the band are zero.
+
+    Parameters
+    ----------
+    node : pytables.CArray
+        Correlation histogram node.
+
+    Returns
+    -------
+    2D correlation histogram.
+    '''
+    data = node[:]
+    if 'band_start' not in node.attrs:
+        return data
+    band_start = node.attrs.band_start
+    hist = np.zeros(shape=(data.shape[0], node.attrs.n_pixel_ref), dtype=data.dtype)
+    ref_index = band_start[:, np.newaxis] + np.arange(data.shape[1])
+    selection = np.logical_and(ref_index >= 0, ref_index < hist.shape[1])
+    hist[np.nonzero(selection)[0], ref_index[selection]] = data[selection]
+    return hist
+
+
+@njit(nogil=True)
 def correlate_hits_on_event_range(hits, column_corr_hist, row_corr_hist,
                                   event_range):
     """Correlating the hit indices of different events in a certain range.
@@ -194,6 +314,29 @@ def get_max_events_in_both_arrays(events_one, events_two):
     return event_result[:count]
 
 
+def get_max_events_in_arrays(event_arrays):
+    """
+    Calculates the maximum count of events that exist in any of the arrays.
+
+    Same as calling get_max_events_in_both_arrays successively, but all arrays are merged at once.
+
+    Parameters
+    ----------
+    event_arrays : iterable of numpy arrays
+        One dimensional event number arrays with increasing event numbers.
+
+    Returns
+    -------
+    Array with increasing event numbers, each event number occurs as often as in the array with the most occurrences.
+    """
+    offsets = np.zeros(shape=(len(event_arrays) + 1,), dtype=np.int64)
+    offsets[1:] = np.cumsum([event_array.shape[0] for event_array in event_arrays])
+    events = np.ascontiguousarray(np.concatenate(event_arrays), dtype=np.int64)  # change memory alignement for c++ library
+    event_result = np.empty(shape=(events.shape[0],), dtype=np.int64)
+    count = analysis_functions.get_max_events_in_arrays(events, offsets, event_result)
+    return event_result[:count]
+
+
 def map_cluster(events, cluster):
     """
     Maps the cluster hits on events. Not existing cluster in events have all values set to 0 and column/row/charge set to nan.
@@ -229,6 +372,35 @@ def map_cluster(events, cluster):
     return mapped_cluster
 
 
+def map_cluster_arrays(events, clusters):
+    """
+    Maps the cluster of several cluster arrays on events in one traversal. Same as calling map_cluster for every cluster array.
+
+    Parameters
+    ----------
+    events : numpy array
+        One dimensional event number array with increasing event numbers.
+    clusters : iterable of np.recarray
+        Recarrays with cluster info. The event numbers are increasing.
+
+    Returns
+    -------
+    Cluster array with the shape (number of cluster arrays, length of the events array).
+
+    """
+    offsets = np.zeros(shape=(len(clusters) + 1,), dtype=np.int64)
+    offsets[1:] = np.cumsum([cluster.shape[0] for cluster in clusters])
+    cluster = np.ascontiguousarray(np.concatenate(clusters))
+    events = np.ascontiguousarray(events)
+    mapped_cluster = np.zeros((len(clusters), events.shape[0]), dtype=tb.dtype_from_descr(data_struct.ClusterInfoTable))
+    mapped_cluster['mean_column'] = np.nan
+    mapped_cluster['mean_row'] = np.nan
+    mapped_cluster['charge'] = np.nan
+    mapped_cluster = np.ascontiguousarray(mapped_cluster)
+    analysis_functions.map_cluster_arrays(events, cluster, offsets, mapped_cluster)
+    return mapped_cluster
+
+
 def get_events_in_both_arrays(events_one, events_two):
     """
     Calculates the events that exist in both arrays.
@@ -381,12 +553,183 @@ def get_data_in_event_range(array, event_start=None, event_stop=None, assume_sor
         return array[ne.evaluate('event_number >= event_start & event_number < event_stop')]
 
 
-def data_aligned_at_events(table, start_event_number=None, stop_event_number=None, start_index=None, stop_index=None, chunk_size=10000000, try_speedup=False, first_event_aligned=True, fail_on_missing_events=True):
+def _event_index_node_name(table):
+    return '_p_%s_event_index' % table.name
+
+
+def create_event_index(table, step=1000):
+    '''Creates or updates the event number index of a table with a sorted event_number column.
+
+    The index stores the event number of every step-th row in a hidden node next to the table. Thus the row of any
+    event number can be found with a binary search and one small read without scanning the data.
+    If a valid index exists already only the new rows are indexed, thus the index can be updated after appending data.
+    The index and the table are stamped with the same id. If the table is recreated the index does not match anymore
+    and is rebuilt.
+    If the file is opened read only the index is only returned and not stored.
+
+    Parameters
+    ----------
+    table : pytables.table
+        The data with event_number column.
+    step : int
+        Number of rows between two index entries. Only used for new indices.
+
+    Returns
+    -------
+    Tuple of the event numbers at every step-th row and the step.
+    '''
+    event_index = get_event_index(table)
+    writable = table._v_file.mode != 'r'
+    node_name = _event_index_node_name(table)
+
+    if event_index is None:  # Create new index
+        event_numbers = np.zeros(shape=(0,), dtype=table.coldtypes['event_number'])
+        n_rows_indexed = 0
+        if writable:
+            try:
+                table._v_file.remove_node(table._v_parent, node_name)
+            except tb.NoSuchNodeError:
+                pass
+            node = table._v_file.create_earray(table._v_parent, node_name, atom=tb.Atom.from_dtype(event_numbers.dtype), shape=(0,), title='Event number index of %s' % table.name, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+            node.attrs.table_id = table.attrs.event_index_id = uuid.uuid4().hex  # Identifies the indexed table
+    else:
+        event_numbers, step = event_index
+        n_rows_indexed = event_numbers.shape[0] * step
+
+    if n_rows_indexed < table.nrows:  # Index new rows
+        new_event_numbers = table.read(start=n_rows_indexed, stop=table.nrows, step=step, field='event_number')
+        event_numbers = np.concatenate((event_numbers, new_event_numbers))
+        if writable:
+            node = table._v_file.get_node(table._v_parent, node_name)
+            node.append(new_event_numbers)
+            node.attrs.step = step
+            node.attrs.n_rows = table.nrows
+
+    return event_numbers, step
+
+
+def get_event_index(table):
+    '''Returns the stored event number index of a table.
+
+    Parameters
+    ----------
+    table : pytables.table
+        The data with event_number column.
+
+    Returns
+    -------
+    Tuple of the event numbers at every step-th row and the step. None if no index exists or the index does not match the data,
+    e.g. if the table was recreated. The index might not cover rows appended after the index was created, use create_event_index to update it.
+    '''
+    try:
+        node = table._v_file.get_node(table._v_parent, _event_index_node_name(table))
+    except tb.NoSuchNodeError:
+        return None
+    step = node.attrs.step if 'step' in node.attrs else None
+    n_rows = node.attrs.n_rows if 'n_rows' in node.attrs else None
+    table_id = node.attrs.table_id if 'table_id' in node.attrs else None
+    if not step or n_rows is None or n_rows > table.nrows:  # Index empty or table shrunk
+        return None
+    if table_id is None or 'event_index_id' not in table.attrs or table.attrs.event_index_id != table_id:  # Index of another table with the same name
+        return None
+    event_numbers = node[:]
+    if not event_numbers.shape[0] or (event_numbers.shape[0] - 1) * step >= n_rows:
+        return None
+    # Cross check the last index entry with the data
+    if table.read(start=(event_numbers.shape[0] - 1) * step, stop=(event_numbers.shape[0] - 1) * step + 1, field='event_number')[0] != event_numbers[-1]:
+        return None
+    return event_numbers, step
+
+
+def get_row_of_event(table, event_number, side='left', event_index=None):
+    '''Returns the row of an event in a table with a sorted event_number column using the event number index.
+
+    Parameters
+    ----------
+    table : pytables.table
+        The data with event_number column.
+    event_number : int
+        The event number to search for.
+    side : 'left' or 'right'
+        If 'left', return the first row with event number >= event_number, if 'right' the first row with event number > event_number.
+    event_index : tuple
+        The event number index of the table. If None, it is created in memory if not existing.
+
+    Returns
+    -------
+    Row index.
+    '''
+    if event_index is None:
+        event_index = create_event_index(table)
+    event_numbers, step = event_index
+    index = np.searchsorted(event_numbers, event_number, side=side)
+    if index == 0:
+        return 0
+    # The row lies between the two index entries, rows after the index are also searched
+    start = (index - 1) * step + 1
+    stop = index * step if index < event_numbers.shape[0] else table.nrows
+    return start + np.searchsorted(table.read(start=start, stop=stop, field='event_number'), event_number, side=side)
+
+
+class _ChunkPrefetcher(object):
+    ''' Iterates over the chunks of a generator on a background thread.
+
+    The chunks are read (and decompressed) ahead of time and buffered, up to depth chunks, while the caller
+    processes the actual chunk. The generator has to read the data with hdf5_lock held.
+    '''
+
+    def __init__(self, chunks, depth):
+        self._queue = queue.Queue(maxsize=depth)
+        self._abort = threading.Event()
+        self._thread = threading.Thread(target=self._read_chunks, args=(chunks,), name='ChunkPrefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_chunks(self, chunks):
+        try:
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+        except Exception as e:  # forward error to the reading thread
+            self._put(e)
+            return
+        self._put(None)
+
+    def _put(self, item):
+        while not self._abort.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if item is None:
+                return
+            yield item
+
+    def close(self):
+        self._abort.set()
+        self._thread.join()
+
+
+def _read_locked(table, start, stop):
+    ''' Reads the table rows between start and stop with hdf5_lock held '''
+    with hdf5_lock:
+        return table.read(start=start, stop=stop)
+
+
+def data_aligned_at_events(table, start_event_number=None, stop_event_number=None, start_index=None, stop_index=None, chunk_size=10000000, try_speedup=False, first_event_aligned=True, fail_on_missing_events=True, prefetch=0):
     '''Takes the table with a event_number column and returns chunks with the size up to chunk_size. The chunks are chosen in a way that the events are not splitted.
     Additional parameters can be set to increase the readout speed. Events between a certain range can be selected.
     Also the start and the stop indices limiting the table size can be specified to improve performance.
     The event_number column must be sorted.
-    In case of try_speedup is True, it is important to create an index of event_number column with pytables before using this function. Otherwise the queries are slowed down.
+    If an event number index of the table exists (see create_event_index), it is used to locate the start and stop event numbers without scanning the data.
 
     Parameters
     ----------
@@ -403,8 +746,8 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
     chunk_size : int
         Maximum chunk size per read.
     try_speedup : bool
-        If True, try to reduce the index range to read by searching for the indices of start and stop event number. If these event numbers are usually
-        not in the data this speedup can even slow down the function!
+        If True, reduce the index range to read by searching for the indices of start and stop event number with the event number index.
+        If no index exists, it is created.
 
     The following parameters are not used when try_speedup is True:
 
@@ -413,6 +756,12 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
     fail_on_missing_events : bool
         If True, an error is given when start_event_number or stop_event_number is not part of the data.
 
+    prefetch : int
+        Number of chunks that are read ahead on a background thread while the caller processes the actual chunk.
+        Hides the time for reading and decompressing the data. If 0, the data is read when needed.
+        HDF5 is not thread safe: the background thread reads with hdf5_lock held and the caller has to hold
+        hdf5_lock for its own HDF5 file access while iterating.
+
     Returns
     -------
     Iterator of tuples
@@ -440,29 +789,38 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
     if stop_event_number is not None and start_event_number is not None and stop_event_number < start_event_number:
         raise ValueError('Invalid start/stop event number')
 
+    event_index = create_event_index(table) if try_speedup else get_event_index(table)
+
     # set start stop indices from the event numbers for fast read if possible; not possible if the given event number does not exist in the data stream
-    if try_speedup and table.colindexed["event_number"]:
+    if try_speedup:
         if start_event_number is not None:
-            start_condition = 'event_number==' + str(start_event_number)
-            start_indices = table.get_where_list(start_condition, start=start_index, stop=stop_index)
-            if start_indices.shape[0] != 0:  # set start index if possible
-                start_index = start_indices[0]
+            index = max(start_index, get_row_of_event(table, start_event_number, side='left', event_index=event_index))
+            if index < stop_index and table.read(start=index, stop=index + 1, field='event_number')[0] == start_event_number:  # set start index if possible
+                start_index = index
                 start_index_known = True
 
         if stop_event_number is not None:
-            stop_condition = 'event_number==' + str(stop_event_number)
-            stop_indices = table.get_where_list(stop_condition, start=start_index, stop=stop_index)
-            if stop_indices.shape[0] != 0:  # set the stop index if possible, stop index is excluded
-                stop_index = stop_indices[0]
+            index = max(start_index, get_row_of_event(table, stop_event_number, side='left', event_index=event_index))
+            if index < stop_index and table.read(start=index, stop=index + 1, field='event_number')[0] == stop_event_number:  # set the stop index if possible, stop index is excluded
+                stop_index = index
                 stop_index_known = True
+    elif event_index is not None:  # limit the range to read, the events are searched as without index
+        if stop_event_number is not None:
+            stop_index = min(stop_index, get_row_of_event(table, stop_event_number, side='left', event_index=event_index) + 1)  # include one row of the stop event to detect the end
 
     if start_index_known and stop_index_known and start_index + chunk_size >= stop_index:  # special case, one read is enough, data not bigger than one chunk and the indices are known
         yield table.read(start=start_index, stop=stop_index), stop_index
     else:  # read data in chunks, chunks do not divide events, abort if stop_event_number is reached
+        if stop_index_known:  # include the first row of the stop event to detect the end of the data
+            stop_index += 1
 
         # search for begin
         current_start_index = start_index
         if start_event_number is not None:
+            if event_index is not None and not start_index_known:  # skip the chunks before the start event
+                n_chunks = (get_row_of_event(table, start_event_number, side='left', event_index=event_index) - start_index) // chunk_size
+                if n_chunks > 0:
+                    current_start_index = start_index + n_chunks * chunk_size
             while current_start_index < stop_index:
                 current_stop_index = min(current_start_index + chunk_size, stop_index)
                 array_chunk = table.read(start=current_start_index, stop=current_stop_index)  # stop index is exclusive, so add 1
@@ -509,39 +867,53 @@ def data_aligned_at_events(table, start_event_number=None, stop_event_number=Non
                     break
 
         # data loop
-        while current_start_index < stop_index:
-            current_stop_index = min(current_start_index + chunk_size, stop_index)
-            array_chunk = table.read(start=current_start_index, stop=current_stop_index)  # stop index is exclusive, so add 1
-            first_event_in_chunk = array_chunk["event_number"][0]
-            last_event_in_chunk = array_chunk["event_number"][-1]
+        if prefetch > 0 and current_start_index < stop_index:  # the data loop runs on a background thread, thus every read starts at the next event aligned index
+            prefetcher = _ChunkPrefetcher(_read_aligned_chunks(read=partial(_read_locked, table), table_max_rows=table_max_rows, current_start_index=current_start_index, stop_index=stop_index, stop_event_number=stop_event_number, chunk_size=chunk_size), depth=prefetch)
+            try:
+                for data in prefetcher:
+                    yield data
+            finally:
+                prefetcher.close()
+        else:
+            for data in _read_aligned_chunks(read=table.read, table_max_rows=table_max_rows, current_start_index=current_start_index, stop_index=stop_index, stop_event_number=stop_event_number, chunk_size=chunk_size):
+                yield data
 
-            chunk_start_index = 0
 
-            if stop_event_number is None:
-                if current_stop_index == table_max_rows:
-                    chunk_stop_index = array_chunk.shape[0]
-                else:
-                    chunk_stop_index = np.searchsorted(array_chunk["event_number"], last_event_in_chunk, side='left')
-            else:
-                if last_event_in_chunk >= stop_event_number:
-                    chunk_stop_index = np.searchsorted(array_chunk["event_number"], stop_event_number, side='left')
-                elif current_stop_index == table_max_rows:  # this will also add the last event of the table
-                    chunk_stop_index = array_chunk.shape[0]
-                else:
-                    chunk_stop_index = np.searchsorted(array_chunk["event_number"], last_event_in_chunk, side='left')
+def _read_aligned_chunks(read, table_max_rows, current_start_index, stop_index, stop_event_number, chunk_size):
+    ''' Data loop of data_aligned_at_events, read is the function returning the data between two indices '''
+    while current_start_index < stop_index:
+        current_stop_index = min(current_start_index + chunk_size, stop_index)
+        array_chunk = read(start=current_start_index, stop=current_stop_index)  # stop index is exclusive, so add 1
+        first_event_in_chunk = array_chunk["event_number"][0]
+        last_event_in_chunk = array_chunk["event_number"][-1]
 
-            nrows = chunk_stop_index - chunk_start_index
-            if nrows == 0:
-                if array_chunk.shape[0] == chunk_size and first_event_in_chunk == last_event_in_chunk:
-                    raise ValueError('Chunk size too small to fit event. Data corruption possible. Increase chunk size to read full event.')
-                elif chunk_start_index == 0:  # not increasing current_start_index
-                    return
-                elif stop_event_number is not None and last_event_in_chunk >= stop_event_number:
-                    return
+        chunk_start_index = 0
+
+        if stop_event_number is None:
+            if current_stop_index == table_max_rows:
+                chunk_stop_index = array_chunk.shape[0]
+            else:
+                chunk_stop_index = np.searchsorted(array_chunk["event_number"], last_event_in_chunk, side='left')
+        else:
+            if last_event_in_chunk >= stop_event_number:
+                chunk_stop_index = np.searchsorted(array_chunk["event_number"], stop_event_number, side='left')
+            elif current_stop_index == table_max_rows:  # this will also add the last event of the table
+                chunk_stop_index = array_chunk.shape[0]
             else:
-                yield array_chunk[chunk_start_index:chunk_stop_index], current_start_index + nrows + chunk_start_index
+                chunk_stop_index = np.searchsorted(array_chunk["event_number"], last_event_in_chunk, side='left')
+
+        nrows = chunk_stop_index - chunk_start_index
+        if nrows == 0:
+            if array_chunk.shape[0] == chunk_size and first_event_in_chunk == last_event_in_chunk:
+                raise ValueError('Chunk size too small to fit event. Data corruption possible. Increase chunk size to read full event.')
+            elif chunk_start_index == 0:  # not increasing current_start_index
+                return
+            elif stop_event_number is not None and last_event_in_chunk >= stop_event_number:
+                return
+        else:
+            yield array_chunk[chunk_start_index:chunk_stop_index], current_start_index + nrows + chunk_start_index
 
-            current_start_index = current_start_index + nrows + chunk_start_index  # events fully read, increase start index and continue reading
+        current_start_index = current_start_index + nrows + chunk_start_index  # events fully read, increase start index and continue reading
 
 
 def fix_event_alignment(event_numbers, ref_column, column, ref_row, row, ref_charge, charge, error=3., n_bad_events=5, n_good_events=3, correlation_search_range=2000, good_events_search_range=10):
@@ -647,6 +1019,187 @@ def get_median_from_histogram(counts, bin_positions):
     return np.median(np.repeat(bin_positions, counts))
 
 
+def fit_gauss_stack(x, data, p0=None, mask=None, fit_offset=False, max_iterations=1000, tolerance=1.49012e-8):
+    ''' Fits a Gauss (+ offset) to each row of a stack of histograms at once. The least squares fits
+    are done with a compiled Levenberg-Marquardt algorithm, the covariance matrices are scaled
+    with the reduced chi2 like scipy.optimize.curve_fit does.
+
+    Parameters
+    ----------
+    x : array
+        Bin positions. One array for all histograms or one row per histogram.
+    data : array
+        The histograms, one histogram per row.
+    p0 : array
+        Start values (A, mu, sigma) or (A, mu, sigma, offset) with one row per histogram.
+        If None the start values are deduced from the moments of the histograms.
+    mask : array
+        Boolean array with the shape of data. Only bins that are True are used in the fit. If None all bins are used.
+    fit_offset : bool
+        If True a Gauss + offset (see gauss_offset) is fitted, otherwise a Gauss (see gauss).
+    max_iterations : uint
+        Maximum number of iterations per fit.
+    tolerance : float
+        The fit is converged if the relative change of the chi2 is below this value.
+
+    Returns
+    -------
+    coeff, cov, status : array
+        Fit parameters and covariance matrices of each histogram and the status of each fit:
+        0: converged, 1: maximum number of iterations reached, 2: failed (not enough data points, singular matrix).
+        Parameters and covariance matrices of failed fits are NaN.
+    '''
+    data = np.atleast_2d(data).astype(np.float64)
+    n_rows = data.shape[0]
+    x = np.ascontiguousarray(np.broadcast_to(x, data.shape), dtype=np.float64)
+    if mask is None:
+        mask = np.ones(data.shape, dtype=np.bool_)
+    else:
+        mask = np.ascontiguousarray(np.broadcast_to(mask, data.shape), dtype=np.bool_)
+    n_parameters = 4 if fit_offset else 3
+
+    if p0 is None:  # Start values from the moments of the histograms
+        weights = np.where(mask, data, 0.0)
+        offset = np.array([np.median(data[row][mask[row]]) if np.any(mask[row]) else 0.0 for row in range(n_rows)]) if fit_offset else np.zeros(n_rows)
+        weights_sum = weights.sum(axis=1)
+        weights_sum[weights_sum == 0] = 1.0
+        mean = (weights * x).sum(axis=1) / weights_sum
+        rms = np.sqrt((weights * np.square(x - mean[:, np.newaxis])).sum(axis=1) / weights_sum)
+        p0 = np.column_stack((weights.max(axis=1) - offset, mean, rms, offset)[:n_parameters])
+    coeff = np.array(np.atleast_2d(p0), dtype=np.float64)
+    if coeff.shape != (n_rows, n_parameters):
+        raise ValueError('Start values have to have the shape (%d, %d)' % (n_rows, n_parameters))
+    cov = np.full(shape=(n_rows, n_parameters, n_parameters), fill_value=np.nan, dtype=np.float64)
+    status = np.zeros(shape=(n_rows,), dtype=np.uint8)
+
+    _fit_gauss_stack(x, data, mask, coeff, cov, status, max_iterations, tolerance)
+
+    return coeff, cov, status
+
+
+@njit(nogil=True)
+def _get_gauss_normal_equations(x, y, mask, p, jtj, jtr):
+    ''' Calculates the chi2 of a Gauss (+ offset) and the normal equations J^T J and J^T r of the least squares problem. '''
+    n_parameters = p.shape[0]
+    jacobian = np.empty(n_parameters)
+    jtj[:] = 0.0
+    jtr[:] = 0.0
+    chi2 = 0.0
+    for i in range(x.shape[0]):
+        if not mask[i]:
+            continue
+        dx = x[i] - p[1]
+        exponential = np.exp(-dx ** 2 / (2.0 * p[2] ** 2))
+        residual = y[i] - p[0] * exponential
+        jacobian[0] = exponential
+        jacobian[1] = p[0] * exponential * dx / p[2] ** 2
+        jacobian[2] = p[0] * exponential * dx ** 2 / p[2] ** 3
+        if n_parameters == 4:
+            residual -= p[3]
+            jacobian[3] = 1.0
+        chi2 += residual ** 2
+        for j in range(n_parameters):
+            jtr[j] += jacobian[j] * residual
+            for k in range(n_parameters):
+                jtj[j, k] += jacobian[j] * jacobian[k]
+    return chi2
+
+
+@njit(nogil=True)
+def _invert_matrix(matrix, inverse):
+    ''' Inverts a small matrix by Gauss-Jordan elimination with partial pivoting. Returns False if the matrix is singular. '''
+    n = matrix.shape[0]
+    a = matrix.copy()
+    inverse[:] = 0.0
+    for i in range(n):
+        inverse[i, i] = 1.0
+    for column in range(n):
+        pivot = column
+        for row in range(column + 1, n):
+            if abs(a[row, column]) > abs(a[pivot, column]):
+                pivot = row
+        if a[pivot, column] == 0.0 or not np.isfinite(a[pivot, column]):
+            return False
+        for k in range(n):
+            a[column, k], a[pivot, k] = a[pivot, k], a[column, k]
+            inverse[column, k], inverse[pivot, k] = inverse[pivot, k], inverse[column, k]
+        scale = a[column, column]
+        for k in range(n):
+            a[column, k] /= scale
+            inverse[column, k] /= scale
+        for row in range(n):
+            if row != column:
+                factor = a[row, column]
+                for k in range(n):
+                    a[row, k] -= factor * a[column, k]
+                    inverse[row, k] -= factor * inverse[column, k]
+    return True
+
+
+@njit(nogil=True)
+def _fit_gauss_stack(x, data, mask, coeff, cov, status, max_iterations, tolerance):
+    ''' Levenberg-Marquardt fit of a Gauss (+ offset) to each row of data. The start values
+    in coeff are overwritten with the fit results. '''
+    n_parameters = coeff.shape[1]
+    jtj = np.empty((n_parameters, n_parameters))
+    jtr = np.empty(n_parameters)
+    jtj_new = np.empty((n_parameters, n_parameters))
+    jtr_new = np.empty(n_parameters)
+    damped = np.empty((n_parameters, n_parameters))
+    inverse = np.empty((n_parameters, n_parameters))
+    for row in range(data.shape[0]):
+        n_points = 0
+        for i in range(data.shape[1]):
+            if mask[row, i]:
+                n_points += 1
+        p = coeff[row].copy()
+        if n_points <= n_parameters or p[2] == 0.0 or not np.all(np.isfinite(p)):
+            status[row] = 2
+            coeff[row, :] = np.nan
+            continue
+
+        chi2 = _get_gauss_normal_equations(x[row], data[row], mask[row], p, jtj, jtr)
+        damping = 1e-3
+        status[row] = 1
+        for _ in range(max_iterations):
+            step_accepted = False
+            while damping < 1e10:  # Increase the damping until the step reduces the chi2
+                damped[:] = jtj
+                for j in range(n_parameters):
+                    damped[j, j] += damping * (jtj[j, j] if jtj[j, j] > 0.0 else 1.0)
+                if _invert_matrix(damped, inverse):
+                    p_new = p + np.dot(inverse, jtr)
+                    if p_new[2] != 0.0:
+                        chi2_new = _get_gauss_normal_equations(x[row], data[row], mask[row], p_new, jtj_new, jtr_new)
+                        if chi2_new <= chi2:
+                            step_accepted = True
+                            break
+                damping *= 10.0
+            if not step_accepted:  # No step reduces the chi2 anymore, thus the minimum is reached
+                status[row] = 0
+                break
+            chi2_change = chi2 - chi2_new
+            p[:] = p_new
+            chi2 = chi2_new
+            jtj[:] = jtj_new
+            jtr[:] = jtr_new
+            damping = max(damping / 10.0, 1e-10)
+            if chi2_change <= tolerance * chi2:
+                status[row] = 0
+                break
+
+        if not _invert_matrix(jtj, inverse):
+            status[row] = 2
+            coeff[row, :] = np.nan
+            continue
+        if p[2] < 0.0:  # The model only depends on sigma squared, the sign of sigma is arbitrary
+            p[2] = -p[2]
+            inverse[2, :] = -inverse[2, :]
+            inverse[:, 2] = -inverse[:, 2]
+        coeff[row, :] = p
+        cov[row, :, :] = inverse * chi2 / (n_points - n_parameters)
+
+
 def get_mean_efficiency(array_pass, array_total, method=0):
     ''' Function to calculate the mean and the error of the efficiency using different approaches.
     No good approach was found.
@@ -871,9 +1424,10 @@ def fit_residuals(hist, edges, label="", title="", output_pdf=None, gui=False, f
     bin_center = (edges[1:] + edges[:-1]) / 2.0
     hist_mean = get_mean_from_histogram(hist, bin_center)
     hist_std = get_rms_from_histogram(hist, bin_center)
-    try:
-        fit, cov = curve_fit(gauss, bin_center, hist, p0=[np.amax(hist), hist_mean, hist_std])
-    except RuntimeError:
+    coeff, cov, status = fit_gauss_stack(x=bin_center, data=hist, p0=[[np.amax(hist), hist_mean, hist_std]])
+    if status[0] == 0:
+        fit, cov = coeff[0], cov[0]
+    else:  # fit failed
         fit, cov = [np.amax(hist), hist_mean, hist_std], np.full((3, 3), np.nan)
 
     testbeam_analysis.tools.plot_utils.plot_residuals(
@@ -924,35 +1478,70 @@ def fit_residuals_vs_position(hist, xedges, yedges, xlabel="", ylabel="", title=
     return fit, cov
 
 
-def hough_transform(img, theta_res=1.0, rho_res=1.0, return_edges=False):
-    thetas = np.linspace(-90.0, 0.0, np.ceil(90.0/theta_res) + 1)
+def hough_transform(img, theta_res=1.0, rho_res=1.0, return_edges=False, weighted=False):
+    ''' Hough transformation of the non-zero pixels of an image.
+
+    Parameters
+    ----------
+    img : array
+        2D image.
+    theta_res : float
+        Resolution of the angle theta in degree.
+    rho_res : float
+        Resolution of the distance rho in pixels.
+    return_edges : bool
+        If True, the bin edges of the accumulator are returned additionally.
+    weighted : bool
+        If True, the pixels are weighted with the image content, otherwise each non-zero pixel counts once.
+    '''
+    y_idxs, x_idxs = np.nonzero(img)
+    return hough_transform_points(x_idxs=x_idxs,
+                                  y_idxs=y_idxs,
+                                  shape=img.shape,
+                                  weights=img[y_idxs, x_idxs] if weighted else None,
+                                  theta_res=theta_res,
+                                  rho_res=rho_res,
+                                  return_edges=return_edges)
+
+
+def hough_transform_points(x_idxs, y_idxs, shape, weights=None, theta_res=1.0, rho_res=1.0, return_edges=False):
+    ''' Hough transformation of pixels given by their indices, see hough_transform().
+
+    Parameters
+    ----------
+    x_idxs, y_idxs : array
+        Column and row indices of the pixels.
+    shape : tuple
+        Shape of the image.
+    weights : array
+        Weights of the pixels. If None, each pixel counts once.
+    theta_res : float
+        Resolution of the angle theta in degree.
+    rho_res : float
+        Resolution of the distance rho in pixels.
+    return_edges : bool
+        If True, the bin edges of the accumulator are returned additionally.
+    '''
+    thetas = np.linspace(-90.0, 0.0, int(np.ceil(90.0/theta_res)) + 1)
     thetas = np.concatenate((thetas, -thetas[len(thetas)-2::-1]))
     thetas = np.deg2rad(thetas)
-    width, height = img.shape
+    width, height = shape
     diag_len = np.sqrt((width - 1)**2 + (height - 1)**2)
-    q = np.ceil(diag_len/rho_res)
+    q = int(np.ceil(diag_len/rho_res))
     nrhos = 2 * q + 1
     rhos = np.linspace(-q * rho_res, q * rho_res, nrhos)
 
     cos_t = np.cos(thetas)
     sin_t = np.sin(thetas)
 
-    accumulator = np.zeros((rhos.size, thetas.size), dtype=np.int)
-    y_idxs, x_idxs = np.nonzero(img)
-
-    @njit
-    def loop(accumulator, x_idxs, y_idxs, thetas, rhos, sin_t, cos_t):
-
-        for i in range(len(x_idxs)):
-            x = x_idxs[i]
-            y = y_idxs[i]
+    if weights is not None:
+        weights = np.asarray(weights).astype(np.float64)
+        accumulator = np.zeros((rhos.size, thetas.size), dtype=np.float64)
+    else:
+        weights = np.ones_like(x_idxs, dtype=np.int64)
+        accumulator = np.zeros((rhos.size, thetas.size), dtype=np.int64)
 
-            for theta_idx in range(thetas.size):
-                #rho_idx = np.around(x * cos_t[theta_idx] + y * sin_t[theta_idx]) + diag_len
-                rhoVal = x * cos_t[theta_idx] + y * sin_t[theta_idx]
-                rho_idx = (np.abs(rhos - rhoVal)).argmin()
-                accumulator[rho_idx, theta_idx] += 1
-    loop(accumulator, x_idxs, y_idxs, thetas, rhos, sin_t, cos_t)
+    _fill_hough_accumulator(accumulator, x_idxs, y_idxs, weights, sin_t, cos_t, q, rho_res)
 
     if return_edges:
         thetas_diff = thetas[1] - thetas[0]
@@ -966,6 +1555,17 @@ def hough_transform(img, theta_res=1.0, rho_res=1.0, return_edges=False):
         return accumulator, thetas, rhos  # return histogram and bin centers
 
 
+@njit(parallel=True, nogil=True)
+def _fill_hough_accumulator(accumulator, x_idxs, y_idxs, weights, sin_t, cos_t, q, rho_res):
+    ''' Fills the Hough accumulator. The thetas are processed in parallel, the rho bin is calculated directly
+    from the rho value since the rhos are equidistant from -q * rho_res to q * rho_res. '''
+    for theta_idx in prange(cos_t.shape[0]):
+        for i in range(x_idxs.shape[0]):
+            rho_val = x_idxs[i] * cos_t[theta_idx] + y_idxs[i] * sin_t[theta_idx]
+            rho_idx = int(np.ceil(rho_val / rho_res + q - 0.5))  # Nearest rho bin, lower bin for rho values exactly in between
+            accumulator[rho_idx, theta_idx] += weights[i]
+
+
 def get_data(path, output=None, fail_on_overwrite=False):
     ''' Downloads data (eg. for examples, fixtures).
     
@@ -58,11 +58,12 @@ def combine_hit_files(hit_files, combined_file, event_number_offsets=None,
                     hits_out.append(hits)
                 last_event_number = hits[-1]['event_number']
                 used_event_number_offsets.append(event_number_offset)
+        analysis_utils.create_event_index(hits_out)
 
     return used_event_number_offsets
 
 
-@njit()
+@njit(nogil=True)
 def _delete_events(data, fraction):
     result = np.zeros_like(data)
     index_result = 0
@@ -102,6 +103,7 @@ def reduce_hit_files(hit_files, fraction=10, chunk_size=10000000):
                 for hits, _ in analysis_utils.data_aligned_at_events(
                         in_file.root.Hits, chunk_size=chunk_size):
                     hits_out.append(_delete_events(hits, fraction))
+                analysis_utils.create_event_index(hits_out)
 
 
 def select_hits(hit_file, max_hits=None, condition=None, track_quality=None,
@@ -176,6 +178,8 @@ def select_hits(hit_file, max_hits=None, condition=None, track_quality=None,
 
                     hits_out.append(hits)
                     progress_bar.update(i)
+                if 'event_number' in hits_out.colnames:
+                    analysis_utils.create_event_index(hits_out)
                 progress_bar.finish()
 
 
@@ -7,6 +7,7 @@ import logging
 
 import tables as tb
 import numpy as np
+from numba import njit
 
 
 def get_plane_normal(direction_vector_1, direction_vector_2):
@@ -407,6 +408,7 @@ def apply_alignment(hits_x, hits_y, hits_z, dut_index,
     transformed according to the slopes and offsets.
     If both are given alignment data is taken.
     The transformation can be inverted.
+    To transform many chunks of hits use AlignmentTransformer, that calculates the transformation matrices only once.
 
     Parameters
     ---------
@@ -428,92 +430,204 @@ def apply_alignment(hits_x, hits_y, hits_z, dut_index,
     hits_x, hits_y, hits_z : array
         Array with transformed hit positions.
     '''
-    if (alignment is None and prealignment is None) or \
-       (alignment is not None and prealignment is not None):
-        raise RuntimeError('Neither pre-alignment or alignment data given.')
-
-    if alignment is not None:
-        if inverse:
-            logging.debug('Transform hit position into the local coordinate '
-                          'system using alignment data')
-            transformation_matrix = global_to_local_transformation_matrix(
-                x=alignment[dut_index]['translation_x'],
-                y=alignment[dut_index]['translation_y'],
-                z=alignment[dut_index]['translation_z'],
-                alpha=alignment[dut_index]['alpha'],
-                beta=alignment[dut_index]['beta'],
-                gamma=alignment[dut_index]['gamma'])
-            rotation_matrix = global_to_local_transformation_matrix(
-                x=0.,
-                y=0.,
-                z=0.,
-                alpha=alignment[dut_index]['alpha'],
-                beta=alignment[dut_index]['beta'],
-                gamma=alignment[dut_index]['gamma'])
-        else:
-            logging.debug('Transform hit position into the global coordinate '
-                          'system using alignment data')
-            transformation_matrix = local_to_global_transformation_matrix(
-                x=alignment[dut_index]['translation_x'],
-                y=alignment[dut_index]['translation_y'],
-                z=alignment[dut_index]['translation_z'],
-                alpha=alignment[dut_index]['alpha'],
-                beta=alignment[dut_index]['beta'],
-                gamma=alignment[dut_index]['gamma'])
-            rotation_matrix = local_to_global_transformation_matrix(
-                x=0.,
-                y=0.,
-                z=0.,
-                alpha=alignment[dut_index]['alpha'],
-                beta=alignment[dut_index]['beta'],
-                gamma=alignment[dut_index]['gamma'])
-
-        hits_x, hits_y, hits_z = apply_transformation_matrix(
-            x=hits_x,
-            y=hits_y,
-            z=hits_z,
-            transformation_matrix=transformation_matrix)
+    return AlignmentTransformer(alignment=alignment, prealignment=prealignment).transform(hits_x=hits_x,
+                                                                                          hits_y=hits_y,
+                                                                                          hits_z=hits_z,
+                                                                                          dut_index=dut_index,
+                                                                                          hits_xerr=hits_xerr,
+                                                                                          hits_yerr=hits_yerr,
+                                                                                          hits_zerr=hits_zerr,
+                                                                                          inverse=inverse)
 
-        if hits_xerr is not None and hits_yerr is not None and hits_zerr is not None:
-            # Errors need only rotation but no translation
-            hits_xerr, hits_yerr, hits_zerr = apply_transformation_matrix(
-                x=hits_xerr,
-                y=hits_yerr,
-                z=hits_zerr,
-                transformation_matrix=rotation_matrix)
 
-    else:
-        c0_column = prealignment[dut_index]['column_c0']
-        c1_column = prealignment[dut_index]['column_c1']
-        c0_row = prealignment[dut_index]['row_c0']
-        c1_row = prealignment[dut_index]['row_c1']
-        z = prealignment[dut_index]['z']
-
-        if inverse:
-            logging.debug('Transform hit position into the local coordinate '
-                          'system using pre-alignment data')
-            hits_x = (hits_x - c0_column) / c1_column
-            hits_y = (hits_y - c0_row) / c1_row
-            hits_z -= z
+def apply_alignment_to_hits(hits, dut_index, alignment=None, prealignment=None, inverse=False, no_z=False):
+    ''' Applies the transformation according to the alignment data to the hits (positions and errors) of one DUT
+    in a hit table (e.g. merged cluster, tracklets or track candidates) in place.
 
-            if hits_xerr is not None and hits_yerr is not None and hits_zerr is not None:
-                hits_xerr = hits_xerr / c1_column
-                hits_yerr = hits_yerr / c1_row
-        else:
-            logging.debug('Transform hit position into the global coordinate '
-                          'system using pre-alignment data')
-            hits_x = c1_column * hits_x + c0_column
-            hits_y = c1_row * hits_y + c0_row
-            hits_z += z
+    Parameters
+    ---------
+    hits : array
+        Structured array with the hit columns (x_dut_0, xerr_dut_0, ...).
+    dut_index : int
+        Index of the DUT to transform.
+    alignment : array
+        Alignment information with rotations and translations.
+    prealignment : array
+        Pre-alignment information with offsets and slopes.
+    inverse : bool
+        Apply inverse transformation if True.
+    no_z : bool
+        If True, do not change the z position.
+    '''
+    AlignmentTransformer(alignment=alignment, prealignment=prealignment).transform_hits(hits=hits, dut_index=dut_index, inverse=inverse, no_z=no_z)
+
+
+class AlignmentTransformer(object):
+    ''' Transforms hits of the DUTs between the local and the global coordinate system according to the alignment data.
+
+    The transformation matrices (and their inverse) are calculated only once for each DUT and applied with a compiled loop.
+    Thus one transformer should be used for all data chunks of an analysis.
+
+    Parameters
+    ---------
+    alignment : array
+        Alignment information with rotations and translations.
+    prealignment : array
+        Pre-alignment information with offsets and slopes.
+    '''
+
+    def __init__(self, alignment=None, prealignment=None):
+        if (alignment is None and prealignment is None) or \
+           (alignment is not None and prealignment is not None):
+            raise RuntimeError('Neither pre-alignment or alignment data given.')
+        self.alignment = alignment
+        self.prealignment = prealignment
+        self._transformation_matrices = {}
+
+    def get_transformation_matrix(self, dut_index, inverse=False):
+        ''' Returns the transformation matrix (4 x 4) of a DUT from the local to the global coordinate system
+        (or from the global to the local coordinate system if inverse is True).
+        '''
+        if self.alignment is None:
+            raise RuntimeError('Transformation matrices need alignment data.')
+        try:
+            return self._transformation_matrices[(dut_index, inverse)]
+        except KeyError:
+            if inverse:
+                transformation_matrix = global_to_local_transformation_matrix(
+                    x=self.alignment[dut_index]['translation_x'],
+                    y=self.alignment[dut_index]['translation_y'],
+                    z=self.alignment[dut_index]['translation_z'],
+                    alpha=self.alignment[dut_index]['alpha'],
+                    beta=self.alignment[dut_index]['beta'],
+                    gamma=self.alignment[dut_index]['gamma'])
+            else:
+                transformation_matrix = local_to_global_transformation_matrix(
+                    x=self.alignment[dut_index]['translation_x'],
+                    y=self.alignment[dut_index]['translation_y'],
+                    z=self.alignment[dut_index]['translation_z'],
+                    alpha=self.alignment[dut_index]['alpha'],
+                    beta=self.alignment[dut_index]['beta'],
+                    gamma=self.alignment[dut_index]['gamma'])
+            self._transformation_matrices[(dut_index, inverse)] = transformation_matrix
+            return transformation_matrix
+
+    def transform(self, hits_x, hits_y, hits_z, dut_index, hits_xerr=None, hits_yerr=None, hits_zerr=None, inverse=False):
+        ''' Takes hits with errors of one DUT and applies the transformation. See apply_alignment for details.
+
+        Returns
+        -------
+        hits_x, hits_y, hits_z : array
+            Array with transformed hit positions.
+        '''
+        if self.alignment is not None:
+            if inverse:
+                logging.debug('Transform hit position into the local coordinate '
+                              'system using alignment data')
+            else:
+                logging.debug('Transform hit position into the global coordinate '
+                              'system using alignment data')
+            transformation_matrix = self.get_transformation_matrix(dut_index=dut_index, inverse=inverse)
+
+            hits_x, hits_y, hits_z = np.atleast_1d(hits_x), np.atleast_1d(hits_y), np.atleast_1d(hits_z)
+            hits_x_transformed, hits_y_transformed, hits_z_transformed = np.empty(hits_x.shape), np.empty(hits_x.shape), np.empty(hits_x.shape)
+            _apply_transformation_matrix(hits_x, hits_y, hits_z, transformation_matrix, True, hits_x_transformed, hits_y_transformed, hits_z_transformed)
+            hits_x, hits_y, hits_z = hits_x_transformed, hits_y_transformed, hits_z_transformed
 
             if hits_xerr is not None and hits_yerr is not None and hits_zerr is not None:
-                hits_xerr = c1_column * hits_xerr
-                hits_yerr = c1_row * hits_yerr
+                # Errors need only rotation but no translation
+                hits_xerr, hits_yerr, hits_zerr = np.atleast_1d(hits_xerr), np.atleast_1d(hits_yerr), np.atleast_1d(hits_zerr)
+                hits_xerr_transformed, hits_yerr_transformed, hits_zerr_transformed = np.empty(hits_xerr.shape), np.empty(hits_xerr.shape), np.empty(hits_xerr.shape)
+                _apply_transformation_matrix(hits_xerr, hits_yerr, hits_zerr, transformation_matrix, False, hits_xerr_transformed, hits_yerr_transformed, hits_zerr_transformed)
+                hits_xerr, hits_yerr, hits_zerr = hits_xerr_transformed, hits_yerr_transformed, hits_zerr_transformed
 
-    if hits_xerr is not None and hits_yerr is not None and hits_zerr is not None:
-        return hits_x, hits_y, hits_z, hits_xerr, hits_yerr, hits_zerr
+        else:
+            c0_column = self.prealignment[dut_index]['column_c0']
+            c1_column = self.prealignment[dut_index]['column_c1']
+            c0_row = self.prealignment[dut_index]['row_c0']
+            c1_row = self.prealignment[dut_index]['row_c1']
+            z = self.prealignment[dut_index]['z']
+
+            if inverse:
+                logging.debug('Transform hit position into the local coordinate '
+                              'system using pre-alignment data')
+                hits_x = (hits_x - c0_column) / c1_column
+                hits_y = (hits_y - c0_row) / c1_row
+                hits_z -= z
+
+                if hits_xerr is not None and hits_yerr is not None and hits_zerr is not None:
+                    hits_xerr = hits_xerr / c1_column
+                    hits_yerr = hits_yerr / c1_row
+            else:
+                logging.debug('Transform hit position into the global coordinate '
+                              'system using pre-alignment data')
+                hits_x = c1_column * hits_x + c0_column
+                hits_y = c1_row * hits_y + c0_row
+                hits_z += z
+
+                if hits_xerr is not None and hits_yerr is not None and hits_zerr is not None:
+                    hits_xerr = c1_column * hits_xerr
+                    hits_yerr = c1_row * hits_yerr
 
-    return hits_x, hits_y, hits_z
+        if hits_xerr is not None and hits_yerr is not None and hits_zerr is not None:
+            return hits_x, hits_y, hits_z, hits_xerr, hits_yerr, hits_zerr
+
+        return hits_x, hits_y, hits_z
+
+    def transform_hits(self, hits, dut_index, inverse=False, no_z=False):
+        ''' Applies the transformation to the hits (positions and errors) of one DUT in a hit table
+        (e.g. merged cluster, tracklets or track candidates) in place.
+
+        Parameters
+        ---------
+        hits : array
+            Structured array with the hit columns (x_dut_0, xerr_dut_0, ...).
+        dut_index : int
+            Index of the DUT to transform.
+        inverse : bool
+            Apply inverse transformation if True.
+        no_z : bool
+            If True, do not change the z position.
+        '''
+        if self.alignment is not None:  # Transform the columns in place without temporary arrays
+            transformation_matrix = self.get_transformation_matrix(dut_index=dut_index, inverse=inverse)
+            _apply_transformation_matrix(hits['x_dut_%d' % dut_index], hits['y_dut_%d' % dut_index], hits['z_dut_%d' % dut_index], transformation_matrix, True,
+                                         hits['x_dut_%d' % dut_index], hits['y_dut_%d' % dut_index], np.empty(hits.shape[0]) if no_z else hits['z_dut_%d' % dut_index])
+            _apply_transformation_matrix(hits['xerr_dut_%d' % dut_index], hits['yerr_dut_%d' % dut_index], hits['zerr_dut_%d' % dut_index], transformation_matrix, False,
+                                         hits['xerr_dut_%d' % dut_index], hits['yerr_dut_%d' % dut_index], hits['zerr_dut_%d' % dut_index])
+        else:
+            (hits['x_dut_%d' % dut_index],
+             hits['y_dut_%d' % dut_index],
+             hit_z,
+             hits['xerr_dut_%d' % dut_index],
+             hits['yerr_dut_%d' % dut_index],
+             hits['zerr_dut_%d' % dut_index]) = self.transform(
+                hits_x=hits['x_dut_%d' % dut_index],
+                hits_y=hits['y_dut_%d' % dut_index],
+                hits_z=hits['z_dut_%d' % dut_index],
+                hits_xerr=hits['xerr_dut_%d' % dut_index],
+                hits_yerr=hits['yerr_dut_%d' % dut_index],
+                hits_zerr=hits['zerr_dut_%d' % dut_index],
+                dut_index=dut_index,
+                inverse=inverse)
+            if not no_z:
+                hits['z_dut_%d' % dut_index] = hit_z
+
+
+@njit(nogil=True)
+def _apply_transformation_matrix(x, y, z, transformation_matrix, translate, x_out, y_out, z_out):
+    ''' Applies the transformation matrix (4 x 4) to the positions x, y, z and writes the result to x_out, y_out, z_out.
+    The output arrays can be the input arrays. If translate is False only the rotation is applied (e.g. for errors).
+    '''
+    if translate:
+        t_x, t_y, t_z = transformation_matrix[0, 3], transformation_matrix[1, 3], transformation_matrix[2, 3]
+    else:
+        t_x, t_y, t_z = 0., 0., 0.
+    for i in range(x.shape[0]):
+        x_i, y_i, z_i = x[i], y[i], z[i]
+        x_out[i] = transformation_matrix[0, 0] * x_i + transformation_matrix[0, 1] * y_i + transformation_matrix[0, 2] * z_i + t_x
+        y_out[i] = transformation_matrix[1, 0] * x_i + transformation_matrix[1, 1] * y_i + transformation_matrix[1, 2] * z_i + t_y
+        z_out[i] = transformation_matrix[2, 0] * x_i + transformation_matrix[2, 1] * y_i + transformation_matrix[2, 2] * z_i + t_z
 
 
 def merge_alignment_parameters(old_alignment, new_alignment, mode='relative',
@@ -288,7 +288,7 @@ def _smooth_update(transition_matrix, filtered_state,
     return smoothed_state, smoothed_state_covariance, kalman_smoothing_gain
 
 
-@njit
+@njit(nogil=True)
 def _smooth(transition_matrices, filtered_states,
             filtered_state_covariances, predicted_states,
             predicted_state_covariances):
@@ -672,7 +672,7 @@ def plot_prealignment_fit(x, mean_fitted, mask, fit_fn, fit, pcov, chi2, mean_er
         output_pdf.savefig(fig)
 
 
-def plot_hough(x, data, accumulator, offset, slope, theta_edges, rho_edges, n_pixel_ref, n_pixel_dut, pixel_size_ref, pixel_size_dut, ref_name, dut_name, prefix, output_pdf=None, gui=False, figs=None):
+def plot_hough(x, dut_indices, ref_indices, accumulator, offset, slope, theta_edges, rho_edges, n_pixel_ref, n_pixel_dut, pixel_size_ref, pixel_size_dut, ref_name, dut_name, prefix, output_pdf=None, gui=False, figs=None):
     if not output_pdf and not gui:
         return
     capital_prefix = prefix
@@ -704,7 +704,10 @@ def plot_hough(x, data, accumulator, offset, slope, theta_edges, rho_edges, n_pi
     ax = fig.add_subplot(111)
     fit_legend_entry = 'Hough: $c_0+c_1*x$\n$c_0=%.1e$\n$c_1=%.1e$' % (offset, slope)
     ax.plot(x, testbeam_analysis.tools.analysis_utils.linear(x, offset, slope), linestyle=':', color="darkorange", label=fit_legend_entry)
-    ax.imshow(data, interpolation="none", origin="lower", aspect=aspect, cmap='Greys')
+    ax.plot(dut_indices, ref_indices, linestyle='None', marker='s', markersize=1, color='black')  # Selected correlation maxima
+    ax.set_xlim(-0.5, n_pixel_dut - 0.5)
+    ax.set_ylim(-0.5, n_pixel_ref - 0.5)
+    ax.set_aspect(aspect)
     ax.set_title("Correlation of %s: %s vs. %s" % (prefix + "s", ref_name, dut_name))
     ax.set_xlabel("%s %s" % (capital_prefix, dut_name))
     ax.set_ylabel("%s %s" % (capital_prefix, ref_name))
@@ -747,7 +750,7 @@ def plot_correlations(input_correlation_file, output_pdf_file=None, pixel_size=N
                         column = False
                 except AttributeError:
                     continue
-                data = node[:]
+                data = testbeam_analysis.tools.analysis_utils.get_correlation_histogram(node)
 
                 if np.all(data <= 0):
                     logging.warning('All correlation entries for %s are zero, do not create plots', str(node.name))
@@ -824,11 +827,9 @@ def plot_events(input_tracks_file, event_range=(0, 100), dut=None, n_tracks=None
                     if node.name != 'Tracks_DUT_%d' % dut:
                         continue
 
-                table = node[:]
-
-                n_duts = sum(['charge' in col for col in table.dtype.names])
-                array = table[:]
+                n_duts = sum(['charge' in col for col in node.dtype.names])
                 if n_tracks is not None:
+                    array = node.read(stop=n_tracks + 1)  # Enough rows to get the first n_tracks tracks
                     index_stop = 0
                     event_start = array['event_number'][0]
                     while index_stop <= n_tracks:
@@ -840,8 +841,11 @@ def plot_events(input_tracks_file, event_range=(0, 100), dut=None, n_tracks=None
                                 index_stop -= 1
                             break
                     tracks = testbeam_analysis.tools.analysis_utils.get_data_in_event_range(array, event_start, event_stop)
-                else:
-                    tracks = testbeam_analysis.tools.analysis_utils.get_data_in_event_range(array, event_range[0], event_range[-1])
+                else:  # Read only the rows of the event range with the event number index
+                    event_index = testbeam_analysis.tools.analysis_utils.create_event_index(node)
+                    start_index = testbeam_analysis.tools.analysis_utils.get_row_of_event(node, event_range[0], side='left', event_index=event_index)
+                    stop_index = testbeam_analysis.tools.analysis_utils.get_row_of_event(node, event_range[-1], side='left', event_index=event_index)
+                    tracks = node.read(start=start_index, stop=stop_index)
                 if tracks.shape[0] == 0:
                     logging.warning('No tracks in event selection, cannot plot events!')
                     return
@@ -21,7 +21,7 @@ from numba import njit
 import math
 import pylandau
 
-from testbeam_analysis.tools import geometry_utils
+from testbeam_analysis.tools import analysis_utils, geometry_utils
 
 
 logging.basicConfig(
@@ -468,6 +468,9 @@ class SimulateData(object):
         if n_events * self.tracks_per_event > 100000:
             progress_bar.finish()
 
+        for hit_table in hit_tables:  # Index event numbers for fast access
+            analysis_utils.create_event_index(hit_table)
+
         for output_file in output_files:
             output_file.close()
 
@@ -2,15 +2,162 @@
 from __future__ import division
 
 import os
+import atexit
+import hashlib
 import shutil
 import tempfile
+import threading
 from collections import Iterable
+from functools import partial
 from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 
 import dill
 import numpy as np
 import tables as tb
 
+from testbeam_analysis.tools import analysis_utils
+
+
+# Process wide worker pools shared by all SMC calls, created on first use
+# (backend name, number of workers): pool
+_pools = {}
+
+# Process pools summing the histogram files, separate from the worker pools
+# number of workers: pool
+_reducer_pools = {}
+
+# HDF5 is not thread safe, file access of worker threads is serialized
+_hdf5_lock = analysis_utils.hdf5_lock
+
+# Worker side cache of deserialized functions, keyed by the payload hash
+_function_cache = {}
+_function_cache_size = 32
+
+
+def _arena_dir():
+    ''' Directory for memory mapped result files, shared memory if available '''
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None  # Default temporary directory
+
+
+class _RawTable(object):
+    ''' Table like buffer appending uncompressed data to a memory mapped file.
+
+    Used to transfer table results from the workers without HDF5
+    compression. The file is read back with numpy.memmap.
+    '''
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self._file = tempfile.NamedTemporaryFile(delete=False,
+                                                 dir=_arena_dir(),
+                                                 suffix='.raw')
+        self.name = self._file.name
+
+    def append(self, data):
+        data.astype(self.dtype, copy=False).tofile(self._file)
+
+    def close(self):
+        self._file.close()
+
+
+class _MemoryTable(object):
+    ''' Table like buffer keeping the appended data in memory.
+
+    Used to transfer table results from worker threads without copying
+    the data through files.
+    '''
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+        self.data = []
+
+    def append(self, data):
+        self.data.append(data.astype(self.dtype, copy=False))
+
+    def close(self):
+        pass
+
+
+def get_pool(n_cores=None, backend='process'):
+    ''' Return the persistent worker pool.
+
+    The pool is created on first use and reused by all following calls
+    with the same backend and number of workers to avoid the overhead of
+    forking, importing and jitting for every call. One pool is kept for
+    each number of workers, thus a pool never runs more tasks at once
+    than requested.
+
+    Parameters
+    ----------
+    n_cores : integer, None
+        Number of workers. If None use all available cores.
+    backend : string
+        'process' for a pool of worker processes, 'thread' for a pool of
+        worker threads.
+    '''
+
+    if backend not in ('process', 'thread'):
+        raise ValueError('Unknown backend %s' % backend)
+
+    if not n_cores:
+        n_cores = cpu_count()
+
+    pool = _pools.get((backend, n_cores))
+    if pool is None:
+        if backend == 'process':
+            pool = Pool(n_cores)
+        else:
+            pool = ThreadPool(n_cores)
+        _pools[(backend, n_cores)] = pool
+
+    return pool
+
+
+def _get_reducer_pool(n_cores):
+    ''' Return the persistent process pool summing the histogram files.
+
+    The sums are not queued behind the tasks of the worker pool, thus they
+    can run while the workers are still busy.
+    '''
+
+    pool = _reducer_pools.get(n_cores)
+    if pool is None:
+        pool = Pool(n_cores)
+        _reducer_pools[n_cores] = pool
+
+    return pool
+
+
+def shutdown_pool(backend=None):
+    ''' Close the persistent worker pools and wait for the workers to exit.
+
+    Is called automatically at interpreter exit. The next call to get_pool()
+    creates a new pool.
+
+    Parameters
+    ----------
+    backend : string, None
+        Backend of the pool to close. If None close all pools. The pools
+        summing the histograms are closed with the process pools.
+    '''
+
+    for pool_backend, n_cores in list(_pools):
+        if backend is None or pool_backend == backend:
+            pool = _pools.pop((pool_backend, n_cores))
+            pool.close()
+            pool.join()
+    if backend in (None, 'process'):
+        for n_cores in list(_reducer_pools):
+            pool = _reducer_pools.pop(n_cores)
+            pool.close()
+            pool.join()
+
+
+atexit.register(shutdown_pool)
+
 
 def apply_async(pool, fun, args=None, **kwargs):
     ''' Run fun(*args, **kwargs) in different process.
@@ -18,28 +165,185 @@ def apply_async(pool, fun, args=None, **kwargs):
     fun can be a complex function since pickling is not done with the
     cpickle module as multiprocessing.apply_async would do, but with
     the more powerfull dill serialization.
-    Additionally kwargs can be given and args can be given'''
-    payload = dill.dumps((fun, args, kwargs))
-    return pool.apply_async(_run_with_dill, (payload,))
-
-
-def _run_with_dill(payload):
+    Additionally kwargs can be given and args can be given.
+    The function is serialized separately from the arguments, thus the
+    workers can reuse already deserialized functions.'''
+    return _apply_async(pool, fun, args, kwargs)
+
+
+def _apply_async(pool, fun, args, kwargs, callback=None):
+    ''' apply_async with a callback called with the result in the result
+    handler thread of the pool. '''
+    fun_payload = dill.dumps(fun)
+    payload = dill.dumps((args, kwargs))
+    return pool.apply_async(_run_with_dill, (fun_payload, payload),
+                            callback=callback)
+
+
+def _load_function(fun_payload):
+    ''' Deserialize a dill function payload, cached per worker process. '''
+    key = hashlib.sha1(fun_payload).hexdigest()
+    try:
+        return _function_cache[key]
+    except KeyError:
+        if len(_function_cache) >= _function_cache_size:
+            _function_cache.clear()
+        fun = dill.loads(fun_payload)
+        _function_cache[key] = fun
+        return fun
+
+
+def _run_with_dill(fun_payload, payload):
     ''' Unpickle payload with dill.
 
-    The payload is the function plus arguments and keyword arguments.
+    The fun_payload is the function, the payload are the arguments
+    and keyword arguments.
     '''
-    fun, args, kwargs = dill.loads(payload)
+    fun = _load_function(fun_payload)
+    args, kwargs = dill.loads(payload)
     if args:
         return fun(*args, **kwargs)
     else:
         return fun(**kwargs)
 
 
+class Barrier(object):
+    ''' Barrier stage in a chain of SMC functions.
+
+    The functions before the barrier are applied on the full input table
+    and their results are combined. Then func is called with the opened
+    output file and has to return a dict with keyword arguments for the
+    functions after the barrier, e.g. values from global statistics. The
+    functions after the barrier are applied in a second pass on the output
+    table and replace it.
+
+    Parameters
+    ----------
+    func : function
+        Function called with the pytables output file. Returns a dict or None.
+    table : string, None
+        Output table the functions after the barrier are applied on. If None
+        the default output node name is used.
+    '''
+
+    def __init__(self, func, table=None):
+        self.func = func
+        self.table = table
+
+
+class _TaskOutput(object):
+    ''' Result of one named output of a task, possibly still pending '''
+
+    def __init__(self, result, name):
+        self.result = result
+        self.name = name
+
+    def get(self):
+        return _get_result(self.result)[self.name]
+
+
+def _get_result(result):
+    ''' Return result, wait for it if the job is pending '''
+    if hasattr(result, 'get') and not isinstance(result, dict):
+        return result.get()
+    return result
+
+
+class _TreeReduction(object):
+    ''' Sums results pairwise in a fixed binary tree while the tasks run.
+
+    The tree is given by the task order, thus the result does not depend on
+    the order the tasks finish. The results are set from the callbacks of
+    the finished jobs and a pair is summed as soon as both operands are
+    available.
+
+    Parameters
+    ----------
+    n_results : integer
+        Number of results to sum.
+    add : function
+        Called with the two operands and a callback. Has to call the
+        callback with the sum, directly or by the pending job it returns.
+    '''
+
+    def __init__(self, n_results, add):
+        self._add = add
+        self._lock = threading.Lock()
+        self._values = {}  # Tree node: operand waiting for its sibling
+        self._jobs = []  # Pending add jobs
+        self._result = None
+        self._error = None
+
+        # Nodes 0 ... n_results - 1 are the results, the inner nodes are
+        # negative. Stack of (tree level, node); equal levels are summed
+        self._children = {}  # Inner node: operand nodes
+        self._parent = {}
+        stack = []
+        for node in range(n_results):
+            level = 0
+            while stack and stack[-1][0] == level:
+                node = self._add_node(stack.pop()[1], node)
+                level += 1
+            stack.append((level, node))
+
+        node = stack.pop()[1]
+        while stack:
+            node = self._add_node(stack.pop()[1], node)
+
+    def _add_node(self, node_1, node_2):
+        node = -1 - len(self._children)
+        self._children[node] = (node_1, node_2)
+        self._parent[node_1] = node
+        self._parent[node_2] = node
+        return node
+
+    def set(self, node, value):
+        ''' Sets the value of a node and sums it with its sibling if
+        available. Errors are raised in get(). '''
+        try:
+            with self._lock:
+                parent = self._parent.get(node)
+                if parent is None:  # Root node
+                    self._result = value
+                    return
+                self._values[node] = value
+                node_1, node_2 = self._children[parent]
+                if node_1 not in self._values or node_2 not in self._values:
+                    return
+                value_1 = self._values.pop(node_1)
+                value_2 = self._values.pop(node_2)
+            job = self._add(value_1, value_2, partial(self.set, parent))
+            if job is not None:
+                with self._lock:
+                    self._jobs.append(job)
+        except Exception as e:  # Callbacks must not raise in the pool
+            with self._lock:
+                if self._error is None:
+                    self._error = e
+
+    def get(self):
+        ''' Waits for the pending add jobs and returns the sum.
+
+        All results have to be set before.
+        '''
+        while True:
+            with self._lock:
+                jobs, self._jobs = self._jobs, []
+            if not jobs:
+                break
+            for job in jobs:  # Callbacks are done when get() returns
+                job.get()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
 class SMC(object):
 
     def __init__(self, table_file_in, file_out,
                  func, func_kwargs={}, node_desc={}, table=None,
-                 align_at=None, n_cores=None, chunk_size=1000000):
+                 align_at=None, n_cores=None, n_tasks=None,
+                 shared_memory=False, backend='process', chunk_size=1000000):
         ''' Apply a function to a pytable on multiple cores in chunks.
 
             Parameters
@@ -48,10 +352,18 @@ class SMC(object):
                 File name of the file with the table.
             file_out : string
                 File name with the resulting table/histogram.
-            func : function
-                Function to be applied on table chunks.
-            func_kwargs : dict
-                Additional kwargs to pass to worker function
+            func : function, list
+                Function to be applied on table chunks. A list of functions
+                is applied as a chain: each function is called with the
+                result of the previous one while the chunk is in memory.
+                The chain can contain Barrier objects for stages that need
+                results of the complete table.
+                A function can return a dict to create several named output
+                nodes (tables and histograms) in one pass.
+            func_kwargs : dict, list
+                Additional kwargs to pass to worker function. For a chain of
+                functions a list with one dict per function (Barriers
+                excluded) has to be given.
             node_desc : dict
                 Output table/array parameters for pytables. Can be empty.
                 Name/Filters/Title values are deduced from the input table
@@ -63,6 +375,14 @@ class SMC(object):
                 Would create an output node with the name test, the title and
                 filters as the input table and the data type is deduced from 
                 the calculated data.
+
+                For histograms the output shape can be declared with the
+                'shape' key. Then the histograms are not resized and
+                histograms larger than this shape raise an exception.
+
+                Parameters of named outputs can be set with the 'outputs'
+                key, e.g. node_desc = {'outputs': {'Hist': {'shape': (10,)}}}.
+                Filters and title are taken from node_desc if not defined.
             table : string, iterable of strings, None
                 string: Table name. Needed if multiple tables exists in file.
                 iterable of strings: possible table names. First existing table
@@ -74,17 +394,37 @@ class SMC(object):
             n_cores : integer, None
                 How many cores to use. If None use all available cores.
                 If 1 multithreading is disabled, useful for debuging.
+            n_tasks : integer, None
+                Number of tasks the data is split into. Tasks are pulled by
+                idle workers from a shared queue to balance uneven load. If
+                None use several tasks per core and not more than chunk_size
+                rows per task.
+            shared_memory : bool
+                If True, table results are not stored in temporary HDF5
+                files but transferred uncompressed in memory mapped files
+                (in shared memory if available). They are written only once
+                into the output file in task order while the other tasks
+                are still running. Histograms are not affected.
+            backend : string
+                'process': the tasks run in worker processes, the results are
+                transferred in temporary files.
+                'thread': the tasks run in worker threads of this process and
+                the results are kept in memory. Only reasonable if the
+                functions release the GIL, e.g. numba functions compiled with
+                nogil=True. The file access is serialized. shared_memory is
+                not used.
             chunk_size : int
                 Chunk size of the data when reading from file.
 
             Notes:
             ------
             It follows the split, apply, combine paradigm:
-            - split: data is splitted into chunks for multiple processes for
-              speed increase
-            - map: the function is called on each chunk. If the chunk per core
-              is still too large to fit in memory it is chunked further. The
-              result is written to a table per core.
+            - split: data is splitted into many small tasks for multiple
+              processes for speed increase
+            - map: the function is called on each chunk. Idle workers take
+              the next task. If the data of a task is still too large to fit
+              in memory it is chunked further. The result is written to a
+              table per task.
             - combine: the tables are merged into one result table or one
                        result histogram depending on the output data format
             '''
@@ -93,16 +433,24 @@ class SMC(object):
         self.table_file_in = table_file_in
         self.file_out = file_out
         self.n_cores = n_cores
+        self.n_tasks = n_tasks
+        self.shared_memory = shared_memory
+        self.backend = backend
         self.align_at = align_at
-        self.func = func
-        self.node_desc = node_desc
+        self.node_desc = dict(node_desc)
         self.chunk_size = chunk_size
-        self.func_kwargs = func_kwargs
+
+        if self.backend not in ('process', 'thread'):
+            raise ValueError('Unknown backend %s' % self.backend)
 
         if self.align_at and self.align_at != 'event_number':
             raise NotImplementedError('Data alignment is only supported '
                                       'on event_number')
 
+        # Split function chain at the barriers into stages
+        self.stages = self._get_stages(func, func_kwargs)
+        _, self.func, self.func_kwargs = self.stages[0]
+
         # Get the table node name
         with tb.open_file(table_file_in) as in_file:
             if not table:  # Find the table node
@@ -114,7 +462,7 @@ class SMC(object):
                             raise RuntimeError('No table node defined and '
                                                'multiple nodes found in file')
                 self.node_name = node.name
-            elif isinstance(table, Iterable):  # possible names
+            elif isinstance(table, Iterable) and not isinstance(table, str):  # possible names
                 self.node_name = None
                 for node_cand in table:
                     try:
@@ -145,204 +493,666 @@ class SMC(object):
             if self.n_rows < 2. * self.chunk_size:
                 self.n_cores = 1
 
+        if not self.n_tasks:
+            if self.n_cores == 1:  # No load balancing needed
+                self.n_tasks = 1
+            else:  # Several tasks per core, not larger than one chunk
+                self.n_tasks = max(4 * self.n_cores,
+                                   int(np.ceil(self.n_rows / self.chunk_size)))
+        self.n_tasks = max(1, min(self.n_tasks, self.n_rows))
+
         # The three main steps
         self._split()
         self._map()
         self._combine()
 
+        # Stages after barriers work on the combined output
+        for barrier, funcs, funcs_kwargs in self.stages[1:]:
+            self._run_barrier(barrier, funcs, funcs_kwargs)
+
+    @staticmethod
+    def _get_stages(func, func_kwargs):
+        ''' Splits the function chain at the barriers.
+
+        Returns a list of tuples with the barrier (None for the first stage),
+        the functions and the function kwargs of each stage.
+        '''
+
+        if isinstance(func, (list, tuple)):
+            funcs = list(func)
+        else:
+            funcs = [func]
+
+        n_funcs = sum(1 for f in funcs if not isinstance(f, Barrier))
+        if isinstance(func_kwargs, dict):
+            if n_funcs > 1 and func_kwargs:
+                raise ValueError('A list of func_kwargs has to be given '
+                                 'for a chain of functions')
+            func_kwargs = [func_kwargs] * n_funcs
+        func_kwargs = list(func_kwargs)
+        if len(func_kwargs) != n_funcs:
+            raise ValueError('The number of func_kwargs does not match the '
+                             'number of functions')
+
+        stages = [(None, [], [])]
+        for f in funcs:
+            if isinstance(f, Barrier):
+                stages.append((f, [], []))
+            else:
+                stages[-1][1].append(f)
+                stages[-1][2].append(func_kwargs.pop(0))
+
+        if any(not stage_funcs for _, stage_funcs, _ in stages):
+            raise ValueError('Every stage needs at least one function')
+
+        return stages
+
     def _split(self):
         self.start_i, self.stop_i = self._get_split_indeces()
         assert len(self.start_i) == len(self.stop_i)
 
     def _map(self):
+        self.pool = None
+        in_memory = self.backend == 'thread'
+
+        # Results of the finished tasks and the running histogram sums,
+        # set from the callbacks of the jobs
+        self._finished = {}
+        self._reductions = {}
+        self._reduction_lock = threading.Lock()
+
         if self.n_cores == 1:
-            self.tmp_files = [self._work(self.table_file_in,
-                                         self.node_name,
-                                         self.func,
-                                         self.func_kwargs,
-                                         self.node_desc,
-                                         self.start_i[0],
-                                         self.stop_i[0],
-                                         self.chunk_size)]
+            self.results = [self._work(self.table_file_in,
+                                       self.node_name,
+                                       self.func,
+                                       self.func_kwargs,
+                                       self.node_desc,
+                                       start_i,
+                                       stop_i,
+                                       self.chunk_size,
+                                       self.shared_memory,
+                                       in_memory)
+                            for start_i, stop_i in zip(self.start_i,
+                                                       self.stop_i)]
+            self._finished = dict(enumerate(self.results))
+        elif in_memory:
+            # Run function in parallel on the persistent thread pool,
+            # no serialization needed
+            self.pool = get_pool(self.n_cores, backend='thread')
+            self.results = []
+            for index, (start_i, stop_i) in enumerate(zip(self.start_i, self.stop_i)):
+                job = self.pool.apply_async(SMC._work,
+                                            kwds={'table_file_in': self.table_file_in,
+                                                  'node_name': self.node_name,
+                                                  'func': self.func,
+                                                  'func_kwargs': self.func_kwargs,
+                                                  'node_desc': self.node_desc,
+                                                  'start_i': start_i,
+                                                  'stop_i': stop_i,
+                                                  'chunk_size': self.chunk_size,
+                                                  'in_memory': True},
+                                            callback=partial(self._task_done, index))
+                self.results.append(job)
         else:
-            # Run function in parallel
-            pool = Pool(self.n_cores)
-
-            jobs = []
-            for i in range(self.n_cores):
-                job = apply_async(pool=pool,
-                                  fun=self._work,
-                                  table_file_in=self.table_file_in,
-                                  node_name=self.node_name,
-                                  func=self.func,
-                                  func_kwargs=self.func_kwargs,
-                                  node_desc=self.node_desc,
-                                  start_i=self.start_i[i],
-                                  stop_i=self.stop_i[i],
-                                  chunk_size=self.chunk_size
-                                  )
-                jobs.append(job)
-
-            # Gather results
-            self.tmp_files = []
-            for job in jobs:
-                self.tmp_files.append(job.get())
+            # Run function in parallel on the persistent pool
+            self.pool = get_pool(self.n_cores)
+
+            # Serialize the functions only once, workers cache them
+            func = dill.dumps(self.func)
+
+            # All tasks are queued at once, idle workers take the next task.
+            # The results are combined in task order while tasks still run.
+            self.results = []
+            for index, (start_i, stop_i) in enumerate(zip(self.start_i, self.stop_i)):
+                job = _apply_async(pool=self.pool,
+                                   fun=SMC._work,
+                                   args=None,
+                                   kwargs={'table_file_in': self.table_file_in,
+                                           'node_name': self.node_name,
+                                           'func': func,
+                                           'func_kwargs': self.func_kwargs,
+                                           'node_desc': self.node_desc,
+                                           'start_i': start_i,
+                                           'stop_i': stop_i,
+                                           'chunk_size': self.chunk_size,
+                                           'shared_memory': self.shared_memory},
+                                   callback=partial(self._task_done, index))
+                self.results.append(job)
+
+    @staticmethod
+    def _work(table_file_in, node_name, func, func_kwargs,
+              node_desc, start_i, stop_i, chunk_size, shared_memory=False,
+              in_memory=False):
+        ''' Defines the work per worker.
 
-            pool.close()
-            pool.join()
+        Reads data, applies the functions and stores data in chunks into
+        tables or histograms. The functions can be given as dill payload.
+
+        Returns a dict with the output node names as keys. The values are
+        the file names of the temporary HDF5 files or, for tables with
+        shared_memory set, tuples with the raw file name and the data type.
+        If in_memory is set, the values are the histograms and the tables
+        as _MemoryTable.
+        '''
 
-            del pool
+        if not callable(func) and not isinstance(func, list):
+            func = _load_function(func)
+        if callable(func):
+            func, func_kwargs = [func], [func_kwargs]
 
-    def _work(self, table_file_in, node_name, func, func_kwargs,
-              node_desc, start_i, stop_i, chunk_size):
-        ''' Defines the work per worker.
+        outputs = {}  # Output node name: table or histogram
+        output_files = {}  # Output node name: temporary HDF5 file
 
-        Reads data, applies the function and stores data in chunks into a table
-        or a histogram.
+        def open_output(name):
+            output_file = tempfile.NamedTemporaryFile(delete=False)
+            output_file.close()
+            output_files[name] = tb.open_file(output_file.name, 'w')
+            return output_files[name]
+
+        def create_table(name, desc, description):
+            if in_memory:
+                if not isinstance(description, np.dtype):
+                    description = tb.description.dtype_from_descr(description)
+                return _MemoryTable(description)
+            if shared_memory:
+                if not isinstance(description, np.dtype):
+                    description = tb.description.dtype_from_descr(description)
+                return _RawTable(description)
+            out_file = open_output(name)
+            desc = dict((k, v) for k, v in desc.items() if k != 'description')
+            return out_file.create_table(out_file.root,
+                                         description=description,
+                                         **desc)
+
+        try:
+            # Create result tables with specified data format
+            # From given pytables tables description
+            for name in SMC._output_names(node_desc):
+                desc = SMC._output_desc(node_desc, name)
+                if 'description' in desc:
+                    outputs[name] = create_table(name, desc,
+                                                 desc['description'])
+
+            with _hdf5_lock:
+                in_file = tb.open_file(table_file_in, 'r')
+            try:
+                node = in_file.get_node(in_file.root, node_name)
+                chunks = SMC._chunks_at_event(table=node,
+                                              start_index=start_i,
+                                              stop_index=stop_i,
+                                              chunk_size=chunk_size)
+
+                while True:
+                    with _hdf5_lock:  # Only reading is serialized
+                        data = next(chunks, None)
+                    if data is None:
+                        break
+                    data = data[0]
+
+                    # Apply function chain on the chunk
+                    data_ret = data
+                    for f, f_kwargs in zip(func, func_kwargs):
+                        data_ret = f(data_ret, **f_kwargs)
+                    if not isinstance(data_ret, dict):  # Single output
+                        data_ret = {node_desc['name']: data_ret}
+
+                    for name, data_out in data_ret.items():
+                        SMC._add_output(outputs, name, data_out,
+                                        SMC._output_desc(node_desc, name),
+                                        create_table)
+            finally:
+                with _hdf5_lock:
+                    in_file.close()
+
+            if in_memory:  # Results are returned directly
+                return outputs
+
+            results = {}
+            for name, out in outputs.items():
+                if isinstance(out, _RawTable):  # HDF5 file not needed
+                    out.close()
+                    results[name] = (out.name, out.dtype)
+                    continue
+                if isinstance(out, np.ndarray):  # Store histogram to file
+                    out_file = open_output(name)
+                    hist_desc = dict((k, v) for k, v in
+                                     SMC._output_desc(node_desc, name).items()
+                                     if k != 'shape')
+                    hist = out_file.create_carray(out_file.root,
+                                                  atom=tb.Atom.from_dtype(out.dtype),
+                                                  shape=out.shape,
+                                                  **hist_desc)
+                    hist[:] = out
+                results[name] = output_files[name].filename
+        finally:
+            for out_file in output_files.values():
+                out_file.close()
+
+        return results
+
+    @staticmethod
+    def _add_output(outputs, name, data, desc, create_table):
+        ''' Adds the data of one chunk to the named output.
+
+        Tables are appended, histograms are summed up.
         '''
 
-        with tb.open_file(table_file_in, 'r') as in_file:
-            node = in_file.get_node(in_file.root, node_name)
+        out = outputs.get(name)
+
+        # Create table if not existing
+        # Extract table description from returned data
+        if out is None:
+            if data.dtype.names:  # Recarray thus table needed
+                out = create_table(name, desc, data.dtype)
+            # Create histogram if data is not a table
+            elif desc.get('shape') is not None:  # Shape is known
+                out = np.zeros(shape=desc['shape'], dtype=data.dtype)
+            else:  # Copy needed for reshape
+                outputs[name] = data.copy()
+                return
+            outputs[name] = out
+
+        if not isinstance(out, np.ndarray):
+            out.append(data)  # Tables are appended
+        elif desc.get('shape') is not None:
+            SMC._add_hist_data(out, data)
+        else:
+            # Check if array needs to be enlarged
+            shape = tuple(max(d_h, d_d) for d_h, d_d in
+                          zip(out.shape, data.shape))
+            if shape != out.shape:
+                dt = np.result_type(out.dtype, data.dtype)
+                hist = np.zeros(shape=shape, dtype=dt)
+                SMC._add_hist_data(hist, out)
+                outputs[name] = out = hist
+
+            SMC._add_hist_data(out, data)
+
+    @staticmethod
+    def _output_names(node_desc):
+        ''' Output node names with parameters given in node_desc '''
+        return [node_desc['name']] + [name for name in
+                                      node_desc.get('outputs', {})
+                                      if name != node_desc['name']]
+
+    @staticmethod
+    def _output_desc(node_desc, name):
+        ''' Pytables parameters for the output node with the given name.
+
+        The default output uses node_desc, other named outputs only take
+        the filters and title of node_desc.
+        '''
 
-            output_file = tempfile.NamedTemporaryFile(delete=False)
-            with tb.open_file(output_file.name, 'w') as out_file:
-                # Create result table with specified data format
-                # From given pytables tables description
-                if 'description' in node_desc:
-                    table_out = out_file.create_table(out_file.root,
-                                                      **node_desc)
-                # Data format unknown and has to be determined later
-                # and thus the table has to be created later
-                else:
-                    table_out = None
-                # Create result histogram
-                hist_out = None
-
-                for data, _ in self._chunks_at_event(table=node,
-                                                     start_index=start_i,
-                                                     stop_index=stop_i,
-                                                     chunk_size=chunk_size):
-
-                    data_ret = func(data, **func_kwargs)
-                    # Create table if not existing
-                    # Extract table description from returned data
-                    if not table_out:
-                        if data_ret.dtype.names:  # Recarray thus table needed
-                            dcr = data_ret.dtype
-                            table_out = out_file.create_table(out_file.root,
-                                                              description=dcr,
-                                                              **node_desc)
-                        # Create histogram if data is not a table
-                        elif hist_out is None:
-                            # Copy needed for reshape
-                            hist_out = data_ret.copy()
-                            continue
-
-                    if table_out is not None:
-                        table_out.append(data_ret)  # Tables are appended
-                    else:
-                        # Check if array needs to be enlarged
-                        shape = []
-                        # Loop over dimension
-                        for i in range(len(hist_out.shape)):
-                            if hist_out.shape[i] < data_ret.shape[i]:
-                                shape.append(data_ret.shape[i])
-                            else:
-                                shape.append(hist_out.shape[i])
-
-                        hist_out.resize(shape)
-
-                        # Add array, ignore size
-                        data_ret.resize(hist_out.shape)
-                        hist_out += data_ret
-
-                if hist_out is not None:
-                    # Store histogram to file
-                    dt = hist_out.dtype
-                    out = out_file.create_carray(out_file.root,
-                                                 atom=tb.Atom.from_dtype(dt),
-                                                 shape=hist_out.shape,
-                                                 **node_desc)
-                    out[:] = hist_out
-
-        return output_file.name
+        if name == node_desc['name']:
+            desc = dict((k, v) for k, v in node_desc.items()
+                        if k != 'outputs')
+        else:
+            desc = dict((k, v) for k, v in node_desc.items()
+                        if k in ('filters', 'title'))
+        desc.update(node_desc.get('outputs', {}).get(name, {}))
+        desc['name'] = name
+        return desc
 
     def _combine(self):
-        # Try to set output node name if defined
-        try:
-            node_name = self.node_desc['name']
-        except KeyError:
-            # Output node name set to input node name
-            node_name = self.node_name
-
-        # Check data type to decide on combine procedure
-        data_type = 'table'
-        with tb.open_file(self.tmp_files[0], 'r') as in_file:
-            node = in_file.get_node(in_file.root, node_name)
-            if type(node) is tb.carray.CArray:
-                data_type = 'array'
-
-        if data_type == 'table':
-            # Use first tmp file as result file
-            shutil.move(self.tmp_files[0], self.file_out)
-
-            with tb.open_file(self.file_out, 'r+') as out_file:
-                node = out_file.get_node(out_file.root, node_name)
-                for f in self.tmp_files[1:]:
-                    with tb.open_file(f) as in_file:
-                        tmp_node = in_file.get_node(in_file.root, node_name)
-                        for i in range(0, tmp_node.shape[0], self.chunk_size):
-                            node.append(tmp_node[i: i + self.chunk_size])
-                    os.remove(f)
-        else:  # TODO: solution without having all hists in RAM
-            # Only one file, merging not needed
-            if len(self.tmp_files) == 1:
-                shutil.move(self.tmp_files[0], self.file_out)   
+        first = _get_result(self.results[0])
+
+        # Sum the histograms while the tasks are still running
+        hist_names = [name for name in first if self._is_hist(first[name],
+                                                              name)]
+        self._start_reductions(hist_names)
+
+        if self.backend == 'thread':  # No file access while tasks are running
+            for result in self.results:
+                _get_result(result)
+
+        # Tables first, they can be written while tasks are still running
+        names = sorted(first, key=lambda name: (name in hist_names, name))
+
+        mode = 'w'  # First output creates the output file
+        tables = []
+        for name in names:
+            results = [first[name]] + [_TaskOutput(result, name)
+                                       for result in self.results[1:]]
+            if self._is_raw(first[name]):
+                self._write_raw_tables(results, name, mode)
+                tables.append(name)
+            elif name not in hist_names:
+                self._append_tables(results, name, mode)
+                tables.append(name)
             else:  # Several files, merge them by adding up
-                with tb.open_file(self.file_out, 'w') as out_file:
-                    hist_data = None
-                    for f in self.tmp_files:
-                        with tb.open_file(f) as in_file:
-                            tmp_data = in_file.get_node(in_file.root, node_name)[:]
-                            if hist_data is None:
-                                # Copy needed for reshape
-                                hist_data = tmp_data.copy()
-                            else:
-                                # Check if array needs to be enlarged
-                                shape = []
-                                # Loop over dimension
-                                for i in range(len(hist_data.shape)):
-                                    if hist_data.shape[i] < tmp_data.shape[i]:
-                                        shape.append(tmp_data.shape[i])
-                                    else:
-                                        shape.append(hist_data.shape[i])
-        
-                                hist_data.resize(shape)
-        
-                                # Add array, ignore size
-                                tmp_data.resize(hist_data.shape)
-                                hist_data += tmp_data
-                        os.remove(f)
-    
-                    dt = hist_data.dtype
-                    out = out_file.create_carray(out_file.root,
-                                                 atom=tb.Atom.from_dtype(dt),
-                                                 shape=hist_data.shape,
-                                                 **self.node_desc)
-                    out[:] = hist_data
+                hist = self._reduce_hists(name)
+                if isinstance(hist, np.ndarray):
+                    self._store_hist(hist, name, mode)
+                else:
+                    self._store_node(hist, name, mode)
+            mode = 'a'
+
+        # Index event numbers of the result tables for fast access
+        with tb.open_file(self.file_out, 'r+') as out_file:
+            for name in tables:
+                node = out_file.get_node(out_file.root, name)
+                if 'event_number' in node.colnames:
+                    analysis_utils.create_event_index(node)
+
+    def _run_barrier(self, barrier, funcs, funcs_kwargs):
+        ''' Applies the functions after a barrier on the output table.
+
+        The barrier function gets the combined output and returns additional
+        keyword arguments for the functions.
+        '''
+
+        with tb.open_file(self.file_out, 'r') as out_file:
+            barrier_kwargs = barrier.func(out_file)
+        if barrier_kwargs:
+            funcs_kwargs = [dict(f_kwargs, **barrier_kwargs)
+                            for f_kwargs in funcs_kwargs]
+
+        table = barrier.table if barrier.table else self.node_desc['name']
+        output_file = tempfile.NamedTemporaryFile(delete=False)
+        output_file.close()
+        SMC(table_file_in=self.file_out,
+            file_out=output_file.name,
+            func=funcs,
+            func_kwargs=funcs_kwargs,
+            node_desc=self.node_desc if table == self.node_desc['name'] else {'name': table},
+            table=table,
+            align_at=self.align_at,
+            n_cores=self.n_cores,
+            shared_memory=self.shared_memory,
+            backend=self.backend,
+            chunk_size=self.chunk_size)
+
+        # Copy the other output nodes to the new output file
+        with tb.open_file(output_file.name, 'r+') as new_file:
+            with tb.open_file(self.file_out, 'r') as out_file:
+                for node in out_file.root:
+                    if node.name not in new_file.root:
+                        node._f_copy(newparent=new_file.root, recursive=True)
+        shutil.move(output_file.name, self.file_out)
+
+    def _append_tables(self, results, name, mode):
+        ''' Appends the temporary tables to the output table in task order '''
+
+        first_file = _get_result(results[0])
+        if mode == 'w':  # Use first tmp file as result file
+            shutil.move(first_file, self.file_out)
+        else:
+            self._store_node(first_file, name, mode)
+
+        with tb.open_file(self.file_out, 'r+') as out_file:
+            node = out_file.get_node(out_file.root, name)
+            for result in results[1:]:
+                f = _get_result(result)
+                with tb.open_file(f) as in_file:
+                    tmp_node = in_file.get_node(in_file.root, name)
+                    for i in range(0, tmp_node.shape[0], self.chunk_size):
+                        node.append(tmp_node[i: i + self.chunk_size])
+                os.remove(f)
+
+    def _store_node(self, file_name, name, mode):
+        ''' Moves the node of the temporary file to the output file '''
+
+        if mode == 'w':
+            shutil.move(file_name, self.file_out)
+            return
+
+        with tb.open_file(self.file_out, 'r+') as out_file:
+            with tb.open_file(file_name, 'r') as in_file:
+                in_file.get_node(in_file.root, name)._f_copy(
+                    newparent=out_file.root)
+        os.remove(file_name)
+
+    def _store_hist(self, hist, name, mode):
+        ''' Stores the histogram in the output file '''
+
+        hist_desc = dict((k, v) for k, v in
+                         self._output_desc(self.node_desc, name).items()
+                         if k != 'shape')
+        with tb.open_file(self.file_out, mode) as out_file:
+            hist_out = out_file.create_carray(out_file.root,
+                                              atom=tb.Atom.from_dtype(hist.dtype),
+                                              shape=hist.shape,
+                                              **hist_desc)
+            hist_out[:] = hist
+
+    def _is_raw(self, result):
+        ''' Check if the result is an uncompressed memory mapped or in memory table '''
+        return isinstance(result, (tuple, _MemoryTable))
+
+    def _write_raw_tables(self, results, name, mode):
+        ''' Appends the memory mapped tables to the output table.
+
+        The results are written in task order. The output file is the only
+        file the data is compressed into.
+
+        Parameters
+        ----------
+        results : list
+            Tuples of file name and data type, _MemoryTable or pending jobs
+            returning them.
+        name : string
+            Output node name.
+        mode : string
+            File mode to open the output file.
+        '''
+
+        desc = self._output_desc(self.node_desc, name)
+        with tb.open_file(self.file_out, mode) as out_file:
+            table_out = None
+            for result in results:
+                result = _get_result(result)
+                if isinstance(result, _MemoryTable):
+                    file_name, dt = None, result.dtype
+                else:
+                    file_name, dt = result
+                if table_out is None:
+                    if 'description' in desc:
+                        table_out = out_file.create_table(out_file.root,
+                                                          **desc)
+                    else:
+                        table_out = out_file.create_table(out_file.root,
+                                                          description=dt,
+                                                          **desc)
+                if file_name is None:
+                    for data in result.data:
+                        table_out.append(data)
+                elif os.path.getsize(file_name):  # Empty files cannot be mapped
+                    data = np.memmap(file_name, dtype=dt, mode='r')
+                    for i in range(0, data.shape[0], self.chunk_size):
+                        table_out.append(data[i:i + self.chunk_size])
+                    del data
+                if file_name is not None:
+                    os.remove(file_name)
+
+    def _is_hist(self, result, name):
+        ''' Check if the result node in the file is a histogram '''
+        if self._is_raw(result):
+            return False
+        if isinstance(result, np.ndarray):
+            return True
+        with tb.open_file(result, 'r') as in_file:
+            node = in_file.get_node(in_file.root, name)
+            return type(node) is tb.carray.CArray
+
+    def _task_done(self, index, result):
+        ''' Callback of the finished tasks, adds the histograms to the sums '''
+        with self._reduction_lock:
+            self._finished[index] = result
+            reductions = list(self._reductions.items())
+        for name, reduction in reductions:
+            reduction.set(index, result[name])
+
+    def _start_reductions(self, names):
+        ''' Starts summing the histograms with the given names.
+
+        The histograms are summed pairwise in a fixed binary tree, thus the
+        result does not depend on the order the workers finish. A pair is
+        summed as soon as both histograms are available. Histogram files are
+        summed on a separate reducer pool, thus the sums do not wait behind
+        the queued tasks.
+        '''
+
+        pool = None
+        if self.pool is not None and self.backend == 'process':
+            pool = _get_reducer_pool(self.n_cores)
+
+        for name in names:
+            reduction = _TreeReduction(n_results=len(self.results),
+                                       add=partial(self._add_hist_results,
+                                                   name, pool))
+            with self._reduction_lock:
+                self._reductions[name] = reduction
+                finished = list(self._finished.items())
+            for index, result in finished:  # Tasks finished before
+                reduction.set(index, result[name])
+
+    def _add_hist_results(self, name, pool, result_1, result_2, callback):
+        ''' Sums two histogram results and calls callback with the sum.
+
+        Histograms in memory are summed directly, histogram files on the
+        pool if given.
+
+        Returns
+        -------
+        The pending job or None.
+        '''
+
+        if isinstance(result_1, np.ndarray):  # In memory
+            callback(SMC._add_hist_arrays(result_1, result_2))
+            return None
+        kwargs = {'file_1': result_1,
+                  'file_2': result_2,
+                  'node_name': name,
+                  'node_desc': self._output_desc(self.node_desc, name),
+                  'chunk_size': self.chunk_size}
+        if pool is None:
+            callback(SMC._add_hists(**kwargs))
+            return None
+        return _apply_async(pool=pool,
+                            fun=SMC._add_hists,
+                            args=None,
+                            kwargs=kwargs,
+                            callback=callback)
+
+    def _reduce_hists(self, name):
+        ''' Waits for the histogram sum of the given name.
+
+        Returns
+        -------
+        File name of the file with the summed histogram or the histogram.
+        '''
+
+        for result in self.results:  # Raise the errors of the tasks
+            _get_result(result)
+        return self._reductions[name].get()
+
+    @staticmethod
+    def _add_hists(file_1, file_2, node_name, node_desc, chunk_size):
+        ''' Adds the histograms of two files block wise.
+
+        Only blocks of about chunk_size entries are in memory. The sum is
+        stored in one of the files if the shape allows it, the other file
+        is deleted.
+
+        Returns
+        -------
+        File name of the file with the summed histogram.
+        '''
+
+        with tb.open_file(file_1, 'r') as in_file_1:
+            with tb.open_file(file_2, 'r') as in_file_2:
+                node_1 = in_file_1.get_node(in_file_1.root, node_name)
+                node_2 = in_file_2.get_node(in_file_2.root, node_name)
+                shape = tuple(max(d_1, d_2) for d_1, d_2 in zip(node_1.shape,
+                                                                node_2.shape))
+                dt = np.result_type(node_1.dtype, node_2.dtype)
+                shape_1, dt_1 = node_1.shape, node_1.dtype
+                shape_2, dt_2 = node_2.shape, node_2.dtype
+
+        # Add in place if one histogram can hold the sum
+        if shape == shape_1 and dt == dt_1:
+            file_out, file_in = file_1, file_2
+        elif shape == shape_2 and dt == dt_2:
+            file_out, file_in = file_2, file_1
+        else:  # Create new histogram with the final shape
+            output_file = tempfile.NamedTemporaryFile(delete=False)
+            output_file.close()
+            file_out, file_in = output_file.name, None
+            hist_desc = dict((k, v) for k, v in node_desc.items()
+                             if k != 'shape')
+            hist_desc['name'] = node_name
+            with tb.open_file(file_out, 'w') as out_file:
+                out_file.create_carray(out_file.root,
+                                       atom=tb.Atom.from_dtype(dt),
+                                       shape=shape,
+                                       **hist_desc)
+            for f in (file_1, file_2):
+                SMC._add_hist_file(file_out, f, node_name, chunk_size)
+                os.remove(f)
+            return file_out
+
+        SMC._add_hist_file(file_out, file_in, node_name, chunk_size)
+        os.remove(file_in)
+        return file_out
+
+    @staticmethod
+    def _add_hist_file(file_out, file_in, node_name, chunk_size):
+        ''' Adds the histogram of file_in to the histogram of file_out.
+
+        The histogram in file_out must be at least as large in every
+        dimension. The data is read and written in blocks along the first
+        dimension.
+        '''
+
+        with tb.open_file(file_out, 'r+') as out_file:
+            with tb.open_file(file_in, 'r') as in_file:
+                node_out = out_file.get_node(out_file.root, node_name)
+                node_in = in_file.get_node(in_file.root, node_name)
+                if not node_in.shape:  # Scalar histogram
+                    node_out[...] = node_out[...] + node_in[...]
+                    return
+                # Number of first dimension entries per block
+                n_block = max(1, chunk_size // max(1, int(np.prod(node_in.shape[1:]))))
+                for start in range(0, node_in.shape[0], n_block):
+                    stop = min(start + n_block, node_in.shape[0])
+                    selection = ((slice(start, stop),) +
+                                 tuple(slice(0, d) for d in node_in.shape[1:]))
+                    node_out[selection] = node_out[selection] + node_in[start:stop]
+
+    @staticmethod
+    def _add_hist_arrays(hist_1, hist_2):
+        ''' Adds two histograms, the result has the larger shape '''
+        shape = tuple(max(d_1, d_2) for d_1, d_2 in zip(hist_1.shape,
+                                                        hist_2.shape))
+        dt = np.result_type(hist_1.dtype, hist_2.dtype)
+        if hist_1.shape == shape and hist_1.dtype == dt:
+            hist, data = hist_1, hist_2
+        elif hist_2.shape == shape and hist_2.dtype == dt:
+            hist, data = hist_2, hist_1
+        else:
+            hist = np.zeros(shape=shape, dtype=dt)
+            SMC._add_hist_data(hist, hist_1)
+            data = hist_2
+        SMC._add_hist_data(hist, data)
+        return hist
+
+    @staticmethod
+    def _add_hist_data(hist, data):
+        ''' Adds the histogram data to the histogram with larger or equal shape '''
+        if any(d_d > d_h for d_d, d_h in zip(data.shape, hist.shape)):
+            raise ValueError('Histogram shape %s exceeds the declared shape %s'
+                             % (str(data.shape), str(hist.shape)))
+        hist[tuple(slice(0, d) for d in data.shape)] += data
 
     def _get_split_indeces(self):
-        ''' Calculates the data range for each core.
+        ''' Calculates the data range for each task.
 
             Return two lists with start/stop indeces.
             Stop indeces are exclusive.
         '''
 
-        core_chunk_size = self.n_rows // self.n_cores
-        start_indeces = list(range(0,
-                                   self.n_rows,
-                                   core_chunk_size)
-                             [:self.n_cores])
+        start_indeces = [i * self.n_rows // self.n_tasks
+                         for i in range(self.n_tasks)]
 
         if not self.align_at:
             stop_indeces = start_indeces[1:]
@@ -352,8 +1162,15 @@ class SMC(object):
 
         stop_indeces.append(self.n_rows)  # Last index always table size
 
-        assert len(stop_indeces) == self.n_cores
-        assert len(start_indeces) == self.n_cores
+        # Remove empty tasks, e.g. events spanning several tasks
+        indeces = [(start, stop) for start, stop in zip(start_indeces,
+                                                         stop_indeces)
+                   if start < stop]
+        if not indeces:  # Keep one task for empty tables
+            indeces = [(0, self.n_rows)]
+        start_indeces, stop_indeces = [list(i) for i in zip(*indeces)]
+
+        assert len(stop_indeces) == len(start_indeces)
 
         return start_indeces, stop_indeces
 
@@ -361,20 +1178,41 @@ class SMC(object):
         ''' Get closest index where the alignment column changes '''
 
         next_indeces = []
-        for index in indeces[1:]:
-            with tb.open_file(self.table_file_in) as in_file:
-                node = in_file.get_node(in_file.root, self.node_name)
-                values = node[index:index + self.chunk_size][self.align_at]
-                value = values[0]
-                for i, v in enumerate(values):
-                    if v != value:
-                        next_indeces.append(index + i)
-                        break
-                    value = v
+        with tb.open_file(self.table_file_in) as in_file:
+            node = in_file.get_node(in_file.root, self.node_name)
+            event_index = None
+            if self.align_at == 'event_number':
+                event_index = analysis_utils.get_event_index(node)
+            for index in indeces[1:]:
+                # Indeces must not decrease
+                if next_indeces and index < next_indeces[-1]:
+                    index = next_indeces[-1]
+                next_index = self.n_rows
+                if index >= self.n_rows:
+                    pass
+                elif event_index is not None:  # Search without reading data
+                    value = node.read(start=index, stop=index + 1,
+                                      field=self.align_at)[0]
+                    next_index = analysis_utils.get_row_of_event(
+                        node, value, side='right', event_index=event_index)
+                else:
+                    start = index
+                    while start < self.n_rows:
+                        values = node.read(start=start,
+                                           stop=start + self.chunk_size,
+                                           field=self.align_at)
+                        # Search for next value, same as in _chunks_at_event
+                        i = np.searchsorted(values, values[0], side='right')
+                        if i < values.shape[0]:
+                            next_index = start + i
+                            break
+                        start += values.shape[0]
+                next_indeces.append(next_index)
 
         return next_indeces
 
-    def _chunks_at_event(self, table, start_index=None, stop_index=None,
+    @staticmethod
+    def _chunks_at_event(table, start_index=None, stop_index=None,
                          chunk_size=10000000):
         '''Takes the table with a event_number column and returns chunks.
 
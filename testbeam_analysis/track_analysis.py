@@ -22,7 +22,7 @@ from testbeam_analysis.tools import geometry_utils
 from testbeam_analysis.tools import kalman
 
 
-def find_tracks(input_tracklets_file, input_alignment_file, output_track_candidates_file, min_cluster_distance=False, chunk_size=1000000):
+def find_tracks(input_tracklets_file, input_alignment_file, output_track_candidates_file, min_cluster_distance=False, align_hits=False, force_prealignment=False, chunk_size=1000000):
     '''Takes first DUT track hit and tries to find matching hits in subsequent DUTs.
     The output is the same array with resorted hits into tracks. A track quality is set to
     be able to cut on good (less scattered) tracks.
@@ -47,6 +47,12 @@ def find_tracks(input_tracklets_file, input_alignment_file, output_track_candida
         e.g.: For two devices: min_cluster_distance = (50, 250)
         If false the cluster distance is not considered.
         The events where any plane does have hits < min_cluster_distance is flagged with n_tracks = -1
+    align_hits : bool
+        If True, the hits of the input file (e.g. the merged cluster file) are not aligned yet and the alignment is applied
+        when reading the data. This avoids to write an aligned copy of the input file with apply_alignment.
+        If no alignment data is available the pre-alignment is used.
+    force_prealignment : bool
+        If True, use pre-alignment for align_hits, even if alignment data is availale.
     chunk_size : uint
         Chunk size of the data when reading from file.
     '''
@@ -78,64 +84,64 @@ def find_tracks(input_tracklets_file, input_alignment_file, output_track_candida
                 column_sigma[index] = correlations[index]['column_sigma']
                 row_sigma[index] = correlations[index]['row_sigma']
 
+        if align_hits:  # Alignment to apply to the hits on the fly
+            if not force_prealignment and 'Alignment' in in_file_h5.root:
+                logging.info('Use alignment data')
+                transformer = geometry_utils.AlignmentTransformer(alignment=in_file_h5.root.Alignment[:])
+            else:
+                logging.info('Use pre-alignment data')
+                transformer = geometry_utils.AlignmentTransformer(prealignment=in_file_h5.root.PreAlignment[:])
+
     def work(tracklets_data_chunk):
         ''' Track finding per cpu core '''
-        # Prepare hit data for track finding, create temporary arrays for x, y, z position and charge data
-        # This is needed to call a numba jitted function, since the number of DUTs is not fixed and thus the data format
-        x = tracklets_data_chunk['x_dut_0']
-        y = tracklets_data_chunk['y_dut_0']
-        z = tracklets_data_chunk['z_dut_0']
-        x_err = tracklets_data_chunk['xerr_dut_0']
-        y_err = tracklets_data_chunk['yerr_dut_0']
-        z_err = tracklets_data_chunk['zerr_dut_0']
-        charge = tracklets_data_chunk['charge_dut_0']
-        n_hits = tracklets_data_chunk['n_hits_dut_0']
-        for dut_index in range(1, n_duts):
-            x = np.column_stack((x, tracklets_data_chunk['x_dut_%d' % (dut_index)]))
-            y = np.column_stack((y, tracklets_data_chunk['y_dut_%d' % (dut_index)]))
-            z = np.column_stack((z, tracklets_data_chunk['z_dut_%d' % (dut_index)]))
-            x_err = np.column_stack((x_err, tracklets_data_chunk['xerr_dut_%d' % (dut_index)]))
-            y_err = np.column_stack((y_err, tracklets_data_chunk['yerr_dut_%d' % (dut_index)]))
-            z_err = np.column_stack((z_err, tracklets_data_chunk['zerr_dut_%d' % (dut_index)]))
-            charge = np.column_stack((charge, tracklets_data_chunk['charge_dut_%d' % (dut_index)]))
-            n_hits = np.column_stack((n_hits, tracklets_data_chunk['n_hits_dut_%d' % (dut_index)]))
-
-        event_number = tracklets_data_chunk['event_number']
-        track_quality = np.zeros_like(tracklets_data_chunk['track_quality'])
-        n_tracks = tracklets_data_chunk['n_tracks']
+        if align_hits:
+            for dut_index in range(n_duts):
+                transformer.transform_hits(hits=tracklets_data_chunk, dut_index=dut_index)
+
+        # Prepare hit data for track finding, the numba jitted function needs (n_events x n_duts) arrays for x, y, z position and charge data
+        # since the number of DUTs is not fixed. These arrays are views into the track candidates to resort the data in place without copying.
+        track_candidates = np.ascontiguousarray(tracklets_data_chunk)
+        hit_arrays = {}
+        for name in ('x', 'y', 'z', 'xerr', 'yerr', 'zerr', 'charge', 'n_hits'):
+            hit_arrays[name] = _get_dut_array(track_candidates, name=name, n_duts=n_duts)
+        track_candidates['track_quality'] = 0
 
         # Perform the track finding with jitted loop
-        _find_tracks_loop(event_number=event_number,
-                          x=x,
-                          y=y,
-                          z=z,
-                          x_err=x_err,
-                          y_err=y_err,
-                          z_err=z_err,
-                          charge=charge,
-                          n_hits=n_hits,
-                          track_quality=track_quality,
-                          n_tracks=n_tracks,
+        _find_tracks_loop(event_number=track_candidates['event_number'],
+                          x=hit_arrays['x'],
+                          y=hit_arrays['y'],
+                          z=hit_arrays['z'],
+                          x_err=hit_arrays['xerr'],
+                          y_err=hit_arrays['yerr'],
+                          z_err=hit_arrays['zerr'],
+                          charge=hit_arrays['charge'],
+                          n_hits=hit_arrays['n_hits'],
+                          track_quality=track_candidates['track_quality'],
+                          n_tracks=track_candidates['n_tracks'],
                           column_sigma=column_sigma,
                           row_sigma=row_sigma,
                           min_cluster_distance=min_cluster_distance)
 
-        # Merge result data from arrays into one recarray
-        combined = np.column_stack((event_number, x, y, z, charge, n_hits, track_quality, n_tracks, x_err, y_err, z_err))
-        return np.core.records.fromarrays(combined.transpose(), dtype=tracklets_data_chunk.dtype)
-    
+        # Copy result data into the track candidates if the array is not a view
+        for name, hit_array in hit_arrays.items():
+            if not np.may_share_memory(hit_array, track_candidates):
+                for dut_index in range(n_duts):
+                    track_candidates['%s_dut_%d' % (name, dut_index)] = hit_array[:, dut_index]
+        return track_candidates
+
     smc.SMC(table_file_in=input_tracklets_file,
             file_out=output_track_candidates_file,
             func=work,
             node_desc={'name':'TrackCandidates',
                         'title':'Track candidates'},
-            # Apply track finding on tracklets or track candidates
-            table=['Tracklets', 'TrackCandidates'],
+            # Apply track finding on tracklets or track candidates, not aligned merged cluster are aligned on the fly
+            table=['Tracklets', 'TrackCandidates', 'MergedCluster'] if align_hits else ['Tracklets', 'TrackCandidates'],
             align_at='event_number',
+            backend='thread',  # Track finding is a nogil numba function, avoid copying the large tracklets to processes
             chunk_size=chunk_size)
 
 
-def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_file, fit_duts=None, selection_hit_duts=None, selection_fit_duts=None, exclude_dut_hit=True, selection_track_quality=1, pixel_size=None, n_pixels=None, beam_energy=None, material_budget=None, add_scattering_plane=False, max_tracks=None, force_prealignment=False, use_correlated=False, min_track_distance=False, keep_data=False, method='Fit', full_track_info=False, chunk_size=1000000):
+def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_file, fit_duts=None, selection_hit_duts=None, selection_fit_duts=None, exclude_dut_hit=True, selection_track_quality=1, pixel_size=None, n_pixels=None, beam_energy=None, material_budget=None, add_scattering_plane=False, max_tracks=None, force_prealignment=False, align_hits=False, use_correlated=False, min_track_distance=False, keep_data=False, method='Fit', full_track_info=False, chunk_size=1000000):
     '''Fits either a line through selected DUT hits for selected DUTs (method=Fit) or uses a Kalman Filter to build tracks (method=Kalman).
     The selection criterion for the track candidates to fit is the track quality and the maximum number of hits per event.
     The fit is done for specified DUTs only (fit_duts). This DUT is then not included in the fit (include_duts).
@@ -172,6 +178,9 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
         Take only events with tracks <= max_tracks. If None, take any event.
     force_prealignment : bool
         If True, use pre-alignment, even if alignment data is availale.
+    align_hits : bool
+        If True, the hits of the track candidates are not aligned yet and the (pre-)alignment is applied when reading the data.
+        This avoids to write an aligned copy of the track candidates file with apply_alignment.
     selection_track_quality : uint, iterable
         One number valid for all DUTs or an iterable with a number for each DUT.
         0: All tracks with hits in DUT and references are taken
@@ -245,6 +254,12 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
             n_duts = alignment.shape[0]
             z_positions = alignment['translation_z']
 
+    if align_hits:
+        if use_prealignment:
+            transformer = geometry_utils.AlignmentTransformer(prealignment=prealignment)
+        else:
+            transformer = geometry_utils.AlignmentTransformer(alignment=alignment)
+
     if fit_duts is None:
         fit_duts = range(n_duts)  # standard setting: fit tracks for all DUTs
     elif not isinstance(fit_duts, Iterable):
@@ -444,10 +459,11 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
 
         tracks_array = create_results_array(good_track_candidates, slopes, actual_offsets, chi2s, n_duts, good_track_selection, track_candidates_chunk)
 
-        try:  # Check if table exists already, than append data
-            tracklets_table = out_file_h5.get_node('/Tracks_DUT_%d' % fit_dut)
-        except tb.NoSuchNodeError:  # Table does not exist, thus create new
-            tracklets_table = out_file_h5.create_table(out_file_h5.root, name='Tracks_DUT_%d' % fit_dut, description=np.zeros((1,), dtype=tracks_array.dtype).dtype, title='Tracks fitted for DUT_%d' % fit_dut, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        with analysis_utils.hdf5_lock:  # The next track candidates are read at the same time
+            try:  # Check if table exists already, than append data
+                tracklets_table = out_file_h5.get_node('/Tracks_DUT_%d' % fit_dut)
+            except tb.NoSuchNodeError:  # Table does not exist, thus create new
+                tracklets_table = out_file_h5.create_table(out_file_h5.root, name='Tracks_DUT_%d' % fit_dut, description=np.zeros((1,), dtype=tracks_array.dtype).dtype, title='Tracks fitted for DUT_%d' % fit_dut, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
 
         # Remove tracks that are too close when extrapolated to the actual DUT
         # All merged track are signaled by n_tracks = -1
@@ -458,7 +474,8 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
             logging.info('Removed %d merged tracks (%1.1f%%)', np.count_nonzero(~selection), float(np.count_nonzero(~selection)) / selection.shape[0] * 100.)
             tracks_array = tracks_array[selection]
 
-        tracklets_table.append(tracks_array)
+        with analysis_utils.hdf5_lock:
+            tracklets_table.append(tracks_array)
 
         # Plot chi2 distribution
         plot_utils.plot_track_chi2(chi2s=chi2s, fit_dut=fit_dut, output_pdf=output_pdf)
@@ -548,10 +565,11 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
         else:
             tracks_array = create_results_array(good_track_candidates, slopes, actual_offsets, chi2s, n_duts, good_track_selection, track_candidates_chunk)
 
-        try:  # Check if table exists already, than append data
-            tracklets_table = out_file_h5.get_node('/Kalman_Tracks_DUT_%d' % fit_dut)
-        except tb.NoSuchNodeError:  # Table does not exist, thus create new
-            tracklets_table = out_file_h5.create_table(out_file_h5.root, name='Kalman_Tracks_DUT_%d' % fit_dut, description=np.zeros((1,), dtype=tracks_array.dtype).dtype, title='Tracks fitted for DUT_%d_with_Kalman_Filter' % fit_dut, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        with analysis_utils.hdf5_lock:  # The next track candidates are read at the same time
+            try:  # Check if table exists already, than append data
+                tracklets_table = out_file_h5.get_node('/Kalman_Tracks_DUT_%d' % fit_dut)
+            except tb.NoSuchNodeError:  # Table does not exist, thus create new
+                tracklets_table = out_file_h5.create_table(out_file_h5.root, name='Kalman_Tracks_DUT_%d' % fit_dut, description=np.zeros((1,), dtype=tracks_array.dtype).dtype, title='Tracks fitted for DUT_%d_with_Kalman_Filter' % fit_dut, filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
 
         # Remove tracks that are too close when extrapolated to the actual DUT
         # All merged track are signaled by n_tracks = -1
@@ -562,7 +580,8 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
             logging.info('Removed %d merged tracks (%1.1f%%)', np.count_nonzero(~selection), float(np.count_nonzero(~selection)) / selection.shape[0] * 100.)
             tracks_array = tracks_array[selection]
 
-        tracklets_table.append(tracks_array)
+        with analysis_utils.hdf5_lock:
+            tracklets_table.append(tracks_array)
 
         # Plot chi2 distribution
         plot_utils.plot_track_chi2(chi2s=chi2s, fit_dut=fit_dut, output_pdf=output_pdf)
@@ -636,7 +655,10 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
                     progress_bar = progressbar.ProgressBar(widgets=['', progressbar.Percentage(), ' ', progressbar.Bar(marker='*', left='|', right='|'), ' ', progressbar.AdaptiveETA()], maxval=in_file_h5.root.TrackCandidates.shape[0], term_width=80)
                     progress_bar.start()
 
-                    for track_candidates_chunk, index_candidates in analysis_utils.data_aligned_at_events(in_file_h5.root.TrackCandidates, chunk_size=chunk_size):
+                    for track_candidates_chunk, index_candidates in analysis_utils.data_aligned_at_events(in_file_h5.root.TrackCandidates, chunk_size=chunk_size, prefetch=1):
+                        if align_hits:  # Transform the hits on the fly
+                            for dut_index in range(n_duts):
+                                transformer.transform_hits(hits=track_candidates_chunk, dut_index=dut_index)
 
                         # Select tracks based on the dut that are required to have a hit (dut_selection) with a certain quality (track_quality)
                         n_tracks = track_candidates_chunk.shape[0]
@@ -754,6 +776,19 @@ def fit_tracks(input_track_candidates_file, input_alignment_file, output_tracks_
 
 
 # Helper functions that are not meant to be called directly during analysis
+def _get_dut_array(data, name, n_duts):
+    ''' Returns the columns name_dut_0 ... name_dut_n of the structured array as a (n_events x n_duts) array.
+    The array is a view into the data if the columns are adjacent in memory, otherwise a copy.
+    '''
+    dtype, offset = data.dtype.fields['%s_dut_0' % name][:2]
+    if data.flags['C_CONTIGUOUS'] and all(data.dtype.fields['%s_dut_%d' % (name, dut_index)][:2] == (dtype, offset + dut_index * dtype.itemsize) for dut_index in range(n_duts)):
+        return np.ndarray(shape=(data.shape[0], n_duts), dtype=dtype, buffer=data, offset=offset, strides=(data.dtype.itemsize, dtype.itemsize))
+    array = np.empty(shape=(data.shape[0], n_duts), dtype=dtype)
+    for dut_index in range(n_duts):
+        array[:, dut_index] = data['%s_dut_%d' % (name, dut_index)]
+    return array
+
+
 @njit
 def _set_dut_track_quality(dut_x, dut_y, curr_x, curr_y, track_quality, track_index, dut_index, dut_column_sigma, dut_row_sigma):
     # Set track quality of actual DUT from actual DUT hit
@@ -829,7 +864,7 @@ def _set_n_tracks(x, y, start_index, stop_index, n_tracks, n_actual_tracks, min_
         n_tracks[i] = n_actual_tracks
 
 
-@njit
+@njit(nogil=True)
 def _find_tracks_loop(event_number, x, y, z, x_err, y_err, z_err, charge, n_hits, track_quality, n_tracks, column_sigma, row_sigma, min_cluster_distance):
     ''' Complex loop to resort the tracklets array inplace to form track candidates. Each track candidate
     is given a quality identifier. Each hit is put to the best fitting track. Tracks are assumed to have
@@ -955,7 +990,7 @@ def _find_tracks_loop(event_number, x, y, z, x_err, y_err, z_err, charge, n_hits
                       n_duts=n_duts)
 
 
-@njit
+@njit(nogil=True)
 def _find_merged_tracks(tracks_array, min_track_distance):  # Check if several tracks are less than min_track_distance apart. Then exclude these tracks (set n_tracks = -1)
     i = 0
     for _ in range(0, tracks_array.shape[0]):